@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+    Benchmark of the PDFSort stages on a synthetic PDF corpus.
+
+    Generates a corpus of PDF files with a given number of files, pages per file,
+    format mix, nesting depth and file size, then times every stage:
+    glob, parse, classify, write and split (write with a page limit),
+    and find_fmt_batch() over an array of page sizes.
+    Results are saved as JSON and can be compared against a stored baseline.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import getopt
+import platform
+import tempfile
+
+try:
+    import numpy
+except ImportError:  # optional, the batch stage is skipped without it
+    numpy = None
+
+from pypdf import PdfWriter
+from pypdf.generic import ContentStream
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdfsort  # noqa: E402
+
+STAGES = ("glob", "parse", "classify", "write", "split")
+
+def make_corpus(
+    dirpath: str,
+    files: int = 100,
+    pages: int = 10,
+    formats: dict = None,
+    depth: int = 2,
+    file_size: int = 0,
+    seed: int = 0,
+) -> dict:
+    """
+    Generates a synthetic corpus of PDF files.
+
+    :param dirpath: str
+        The directory to write the corpus to.
+    :param files: int, optional
+        The number of PDF files.
+    :param pages: int, optional
+        The number of pages per file.
+    :param formats: dict, optional
+        Format mix, format names from `PaperSizes` as the keys and their weights as the values
+        (default is {"A4": 8, "A3": 1, "A1": 1}).
+    :param depth: int, optional
+        The nesting depth of subdirectories the files are spread over.
+    :param file_size: int, optional
+        The approximate size of each file in bytes, pages are padded with content to reach it.
+    :param seed: int, optional
+        Seed of the random generator, the same seed gives the same corpus.
+    :return: dict
+        Returns the corpus parameters and its total size in bytes.
+    """
+    formats = formats or {"A4": 8, "A3": 1, "A1": 1}
+    rng = random.Random(seed)
+    names = list(formats)
+    weights = [formats[name] for name in names]
+    pad = max(0, file_size // max(pages, 1) - 400)
+    total = 0
+    for i in range(files):
+        subdirs = [f"d{rng.randrange(4)}" for _ in range(depth)]
+        subdir = os.path.join(dirpath, *subdirs)
+        os.makedirs(subdir, exist_ok=True)
+        writer = PdfWriter()
+        for j in range(pages):
+            width, height = pdfsort.PaperSizes[rng.choices(names, weights)[0]]
+            if rng.random() < 0.2:
+                width, height = height, width
+            page = writer.add_blank_page(width, height)
+            if pad:
+                content = ContentStream(None, None)
+                # A unique header keeps the streams from being identical
+                content.set_data(b"%% %d %d " % (i, j) + b"0" * pad + b"\n")
+                page.replace_contents(content)
+        filename = os.path.join(subdir, f"file{i:06d}.pdf")
+        with open(filename, "wb") as f:
+            writer.write(f)
+        total += os.path.getsize(filename)
+    return {
+        "files": files,
+        "pages": pages,
+        "formats": formats,
+        "depth": depth,
+        "file_size": file_size,
+        "seed": seed,
+        "total_bytes": total,
+    }
+
+def run_stages(dirpath: str, jobs: int = 1, limit: int = 100) -> dict:
+    """
+    Times every stage of a PDFSort run over a corpus.
+
+    :param dirpath: str
+        The corpus directory.
+    :param jobs: int, optional
+        The number of worker processes for scanning and writing.
+    :param limit: int, optional
+        The page limit of the split stage.
+    :return: dict
+        Returns the stage names as the keys and their durations in seconds as the values.
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    file_paths = pdfsort.list_files_recursive(dirpath)
+    timings["glob"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scans = list(pdfsort.scan_pdf_files(file_paths, jobs))
+    timings["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pdfsort.bucket_pages_by_format(
+        pdfsort.PageRef(scan.path, i, box[0], box[1])
+        for scan in scans
+        for i, box in enumerate(scan.boxes)
+    )
+    timings["classify"] = time.perf_counter() - start
+
+    buckets = pdfsort.bucket_pages_by_format(pdfsort.iter_page_boxes(file_paths))
+    for stage, stage_limit in (("write", 0), ("split", limit)):
+        shutil.rmtree(pdfsort.output_dir, ignore_errors=True)
+        start = time.perf_counter()
+        pdfsort.write_fmt_files(buckets, stage_limit, jobs)
+        timings[stage] = time.perf_counter() - start
+    shutil.rmtree(pdfsort.output_dir, ignore_errors=True)
+    return timings
+
+def run_batch(count: int, formats: dict = None, seed: int = 0) -> float:
+    """
+    Times find_fmt_batch() over an array of page sizes.
+
+    :param count: int
+        The number of page sizes.
+    :param formats: dict, optional
+        Format mix as for make_corpus().
+    :param seed: int, optional
+        Seed of the random generator.
+    :return: float
+        Returns the duration in seconds.
+    """
+    formats = formats or {"A4": 8, "A3": 1, "A1": 1}
+    rng = numpy.random.default_rng(seed)
+    names = list(formats)
+    weights = numpy.array([formats[name] for name in names], dtype=float)
+    base = numpy.array([pdfsort.PaperSizes[name] for name in names], dtype=float)
+    sizes = base[rng.choice(len(names), count, p=weights / weights.sum())]
+    # Sizes as read from files are a little off the paper sizes, some pages are landscape
+    sizes += rng.random((count, 2)) * 0.4
+    landscape = rng.random(count) < 0.2
+    sizes[landscape] = sizes[landscape][:, ::-1]
+    start = time.perf_counter()
+    pdfsort.find_fmt_batch(sizes)
+    return time.perf_counter() - start
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compares stage timings against a baseline.
+
+    :param results: dict
+        The benchmark results.
+    :param baseline: dict
+        The stored baseline results.
+    :param threshold: float
+        Allowed slowdown as a fraction, 0.2 means 20% slower than the baseline.
+    :return: list
+        Returns a list of messages about the regressed stages, empty if there are none.
+    """
+    regressions = []
+    for stage in STAGES + ("batch",):
+        old = baseline["timings"].get(stage)
+        new = results["timings"].get(stage)
+        if old and new and new > old * (1 + threshold):
+            regressions.append(
+                f"{stage}: {new:.3f}s vs baseline {old:.3f}s (+{(new / old - 1):.0%})"
+            )
+    return regressions
+
+def usage():
+    """Show usage help screen and exit"""
+    cli_name = os.path.basename(sys.argv[0])
+    print(f'''
+    Benchmark of the PDFSort stages on a synthetic PDF corpus.
+
+    USAGE:
+        {cli_name} [options]
+
+    Options:
+        -h, --help          Shows this help message and exit
+        -f, --files N       Number of PDF files (default: 100)
+        -p, --pages N       Number of pages per file (default: 10)
+        -m, --mix SPEC      Format mix as FMT:WEIGHT,... (default: A4:8,A3:1,A1:1)
+        -d, --depth N       Nesting depth of subdirectories (default: 2)
+        -s, --size BYTES    Approximate size of each file (default: minimal)
+        -j, --jobs N        Worker processes for scanning and writing (default: 1)
+        -l, --limit N       Page limit of the split stage (default: 100)
+        -n, --batch N       Page sizes classified at once by find_fmt_batch(), needs NumPy,
+                            0 to skip (default: 10000000)
+        -r, --repeat N      Repeat the stages and keep the best timings (default: 3)
+        -o, --output FILE   Save the results as JSON
+        -b, --baseline FILE Compare the results against a JSON baseline
+        -t, --threshold X   Allowed slowdown against the baseline (default: 0.2)
+            --keep DIR      Generate the corpus into DIR and keep it
+    ''')
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(
+            sys.argv[1:],
+            "hf:p:m:d:s:j:l:n:r:o:b:t:",
+            [
+                "help", "files=", "pages=", "mix=", "depth=", "size=", "jobs=",
+                "limit=", "batch=", "repeat=", "output=", "baseline=", "threshold=", "keep=",
+            ],
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    params = {"files": 100, "pages": 10, "formats": None, "depth": 2, "file_size": 0}
+    jobs, limit, repeat, threshold = 1, 100, 3, 0.2
+    batch = 10000000
+    output = baseline = keep = None
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-f", "--files"):
+            params["files"] = int(arg)
+        elif opt in ("-p", "--pages"):
+            params["pages"] = int(arg)
+        elif opt in ("-m", "--mix"):
+            params["formats"] = {
+                name: float(weight)
+                for name, weight in (item.split(":") for item in arg.split(","))
+            }
+        elif opt in ("-d", "--depth"):
+            params["depth"] = int(arg)
+        elif opt in ("-s", "--size"):
+            params["file_size"] = int(arg)
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt in ("-l", "--limit"):
+            limit = int(arg)
+        elif opt in ("-n", "--batch"):
+            batch = int(arg)
+        elif opt in ("-r", "--repeat"):
+            repeat = max(1, int(arg))
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-b", "--baseline"):
+            baseline = arg
+        elif opt in ("-t", "--threshold"):
+            threshold = float(arg)
+        elif opt == "--keep":
+            keep = arg
+
+    corpus_dir = keep or tempfile.mkdtemp(prefix="pdfsort-bench-")
+    try:
+        start = time.perf_counter()
+        corpus = make_corpus(corpus_dir, **params)
+        print(f"Corpus: {corpus['files']} files, {corpus['total_bytes']} bytes "
+              f"generated in {time.perf_counter() - start:.1f}s")
+
+        timings = {}
+        for _ in range(repeat):
+            stage_timings = run_stages(corpus_dir, jobs, limit)
+            if batch > 0 and numpy is not None:
+                stage_timings["batch"] = run_batch(batch, params["formats"])
+            for stage, seconds in stage_timings.items():
+                timings[stage] = min(seconds, timings.get(stage, seconds))
+    finally:
+        if keep is None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    results = {
+        "version": pdfsort.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "corpus": corpus,
+        "jobs": jobs,
+        "limit": limit,
+        "batch": batch if "batch" in timings else 0,
+        "repeat": repeat,
+        "timings": timings,
+        "peak_rss_mb": pdfsort.peak_memory_mb(),
+    }
+    pages = corpus["files"] * corpus["pages"]
+    for stage in STAGES:
+        print(f"{stage:>9} {timings[stage]:9.3f}s {pages / timings[stage]:12.0f} pages/s")
+    if "batch" in timings:
+        print(f"{'batch':>9} {timings['batch']:9.3f}s {batch / timings['batch']:12.0f} pages/s")
+    if results["peak_rss_mb"] is not None:
+        print(f"Peak RSS: {results['peak_rss_mb']:.1f} MiB")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold)
+        for message in regressions:
+            print(f"Regression: {message}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -19,18 +19,140 @@
 
 """
 import os
-import glob
-from pypdf import PdfReader, PdfWriter
+import io
+import re
+import asyncio
+import csv
+import json
+import time
+import queue
+import shutil
+import mmap
+import fnmatch
+import heapq
+import hashlib
+import string
+import pstats
+import sqlite3
+import cProfile
+import threading
+import multiprocessing
+import tracemalloc
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import groupby
+from typing import Iterator, NamedTuple
+from pypdf import PdfReader, PdfWriter, __version__ as pypdf_version
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NullObject, StreamObject
 
 import sys
 import getopt
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import numpy
+except ImportError:  # optional, used by find_fmt_batch() only
+    numpy = None
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:  # optional, used by load_paper_sizes() for TOML files only
+        tomllib = None
+
 __version__ = '0.1.0'
 
 input_dir: str = os.path.abspath("./")
 output_dir: str = os.path.join(input_dir, os.path.basename(input_dir) + "-PDFs")
 
-PaperSizes = {  # add new: ensure that first number is <= second number
+MAX_OPEN_READERS: int = 8  # source files kept open at once while writing
+SCAN_CHUNKSIZE: int = 8  # half the files kept in flight per scanning worker, see _map_scans()
+OUTPUT_METADATA: dict = {"/Creator": "PDFSort", "/Producer": "PDFSort"}  # document info of every output file
+INDEX_FILENAME: str = ".pdfsort-index.sqlite"  # persistent scan index in the output dir
+BATCH_SIZE_RANGE: int = 1 << 20  # page sizes up to this are classified by find_fmt_batch() with numpy
+INDEX_VERSION: int = 2  # bump when the layout of the index records changes
+RAW_READ_SIZE: int = 4096  # bytes read at a time for a page tree node on the fast path
+MANIFEST_FILENAME: str = ".pdfsort-manifest.json"  # output files and their source pages
+MANIFEST_VERSION: int = 1
+JOURNAL_FILENAME: str = ".pdfsort-journal.jsonl"  # output files finished by a run in progress
+PARTIAL_SUFFIX: str = ".part"  # output files being written, renamed once complete
+QUARANTINE_FILENAME: str = ".pdfsort-quarantine.json"  # files left out of the last run and why
+REPORT_FORMATS: tuple = ("text", "json", "csv", "ndjson")  # -f, --format choices
+FMT_MEMO_SIZE: int = 4096  # distinct rounded page sizes memoized by find_fmt()
+WALK_QUEUE_SIZE: int = 256  # paths found ahead by each directory walker thread of iter_pdf_files()
+WORKER_POLL_INTERVAL: float = 0.1  # seconds between checks on a waiting worker thread or process
+SIZE_INDEX_BLOCK: int = 16  # paper sizes per block of PaperSizeIndex, skipped at once if too far off
+GROUP_KEYS: tuple = ("format", "orientation", "folder", "pages")  # --group-by choices
+PAGE_COUNT_RANGES: tuple = (1, 10, 100, 1000)  # upper bounds of the page count ranges of the pages key
+PAGE_ORDERS: tuple = ("path", "natural", "mtime")  # --order choices
+FMT_TOLERANCE: int = 2  # points a page may differ from a paper size (width + height) and still match it
+PDF_OBJ_OVERHEAD: int = 40  # bytes per object in an output file beyond its body (header, xref entry)
+OPTIMIZE_DEDUPE: int = 1  # --optimize: identical objects are written once
+OPTIMIZE_COMPRESS: int = 2  # --compress: page content streams are also recompressed
+KEEP_OBJECT_TYPES: tuple = ("/Catalog", "/Pages", "/Page", "/Annot")  # never merged, even if identical
+PIPELINE_QUEUE_SIZE: int = 16  # items waiting between two stages of run_pipeline()
+PREFETCH_THREADS: int = 4  # files read ahead at once by run_pipeline()
+DEDUPE_FILES: int = 1  # --dedupe: byte-identical input files are scanned once
+DEDUPE_PAGES: int = 2  # --dedupe-pages: pages showing the same content are also written once
+PARTIAL_HASH_SIZE: int = 64 * 1024  # bytes hashed to tell apart input files of the same size
+PLAN_SAMPLE_PAGES: int = 20  # pages written to memory by --plan to measure the write throughput
+PROFILE_TOP: int = 10  # slowest files, functions and allocation sites listed by --profile
+PROFILE_STAGES: tuple = ("discover", "prefetch", "parse", "classify", "report", "write")  # report order
+
+class PaperSizeDict(dict):
+    """
+    A dict of paper sizes which counts its modifications, so the lookup index
+    built from it is rebuilt when sizes are added, replaced or removed at runtime.
+    """
+
+    version: int = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self.version += 1
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self.version += 1
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self.version += 1
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
+PaperSizes = PaperSizeDict({  # [width, height] or [width, height, tolerance], width <= height
     "A0": [2384, 3370],
     "A1": [1684, 2384],
     "A2": [1190, 1684],
@@ -61,43 +183,437 @@ PaperSizes = {  # add new: ensure that first number is <= second number
     "Letter": [612, 792],
     "Legal": [612, 1008],
     "Ledger": [792, 1224],
-    "A4х3": [842, 1785],
-    "A4х4": [842, 2383],
-    "A4х5": [842, 2978],
-    "A4х6": [842, 3573],
-    "A4х7": [842, 4168],
-    "A4х8": [842, 4766],
-    "A4х9": [842, 5361],
-    "A3х3": [1190, 2526],
-    "A3х4": [1190, 3371],
-    "A3х5": [1190, 4213],
-    "A3х6": [1190, 5055],
-    "A3х7": [1190, 5897],
-    "A2х3": [1684, 3573],
-    "A2х4": [1684, 4766],
-    "A2х5": [1684, 5956],
-    "A1х3": [2384, 5055],
-    "A1х3": [2384, 6742],
-    "A0х2": [3370, 4768],
-    "A0х3": [3370, 7152],
-}
-
-def list_files_recursive(dirpath: str) -> list:
+    "A4x3": [842, 1785],
+    "A4x4": [842, 2383],
+    "A4x5": [842, 2978],
+    "A4x6": [842, 3573],
+    "A4x7": [842, 4168],
+    "A4x8": [842, 4766],
+    "A4x9": [842, 5361],
+    "A3x3": [1190, 2526],
+    "A3x4": [1190, 3371],
+    "A3x5": [1190, 4213],
+    "A3x6": [1190, 5055],
+    "A3x7": [1190, 5897],
+    "A2x3": [1684, 3573],
+    "A2x4": [1684, 4766],
+    "A2x5": [1684, 5956],
+    "A1x3": [2384, 5055],
+    "A1x4": [2384, 6742],
+    "A0x2": [3370, 4768],
+    "A0x3": [3370, 7152],
+})
+
+_BUILTIN_PAPER_SIZES = {name: list(wh) for name, wh in PaperSizes.items()}  # for `builtin = true` registries
+
+class PaperSizeIndex:
+    """
+    Nearest paper size lookup over a table of sizes sorted by width.
+    The distance is the sum of width and height differences, ties go to
+    the size defined first in the source dictionary. Every size matches pages
+    within its own tolerance (the third value of a size, `FMT_TOLERANCE` by default).
+    """
+
+    def __init__(self, sizes: dict):
+        self.sizes = sizes
+        self.version = getattr(sizes, "version", None)
+        self.entries = sorted(
+            (int(wh[0]), int(wh[1]), order, key, wh[2] if len(wh) > 2 else FMT_TOLERANCE)
+            for order, (key, wh) in enumerate(sizes.items())
+        )
+        self.widths = [entry[0] for entry in self.entries]
+        # Blocks of sizes in width order: (first entry, min width, max width, min height, max height)
+        self.blocks = []
+        for start in range(0, len(self.entries), SIZE_INDEX_BLOCK):
+            block = self.entries[start:start + SIZE_INDEX_BLOCK]
+            heights = [entry[1] for entry in block]
+            self.blocks.append((start, block[0][0], block[-1][0], min(heights), max(heights)))
+        self.block_widths = [block[2] for block in self.blocks]
+        self.max_tolerance = max((entry[4] for entry in self.entries), default=0)
+
+    def match(self, w1: int, h1: int) -> tuple:
+        """
+        Find the paper size a page matches: the closest size within its tolerance,
+        or the closest size if the page is within the tolerance of none.
+
+        :param w1: int
+            Width, not greater than height.
+        :param h1: int
+            Height.
+        :return: tuple
+            Returns (distance, paper size key, True if within the tolerance) tuple,
+            (None, None, False) for an empty table.
+        """
+        distance, key = self.nearest(w1, h1)
+        if key is None or distance <= self.tolerance(key):
+            return distance, key, key is not None
+        # A farther size may have a larger tolerance, only sizes
+        # within the largest tolerance by width alone are candidates
+        best = None
+        lo = bisect_left(self.widths, w1 - self.max_tolerance)
+        hi = bisect_right(self.widths, w1 + self.max_tolerance)
+        for width, height, order, other, tolerance in self.entries[lo:hi]:
+            candidate = (abs(w1 - width) + abs(h1 - height), order, other)
+            if candidate[0] <= tolerance and (best is None or candidate < best):
+                best = candidate
+        if best is None:
+            return distance, key, False
+        return best[0], best[2], True
+
+    def tolerance(self, key: str) -> int:
+        """The tolerance of a paper size."""
+        wh = self.sizes[key]
+        return wh[2] if len(wh) > 2 else FMT_TOLERANCE
+
+    def nearest(self, w1: int, h1: int) -> tuple:
+        """
+        Find the paper size closest to the given width and height.
+
+        :param w1: int
+            Width, not greater than height.
+        :param h1: int
+            Height.
+        :return: tuple
+            Returns (distance, paper size key) tuple, (None, None) for an empty table.
+        """
+        best = (float("inf"), 0, None)
+        entries, blocks = self.entries, self.blocks
+        hi = bisect_left(self.block_widths, w1)
+        lo = hi - 1
+        # Walk the blocks outwards from the closest width, the width gap alone
+        # is a lower bound of the distance, so stop once it exceeds the best one.
+        # Blocks whose range of heights is too far off are skipped unread
+        while lo >= 0 or hi < len(blocks):
+            gap_hi = max(0, blocks[hi][1] - w1, w1 - blocks[hi][2]) if hi < len(blocks) else None
+            gap_lo = max(0, blocks[lo][1] - w1, w1 - blocks[lo][2]) if lo >= 0 else None
+            if gap_lo is None or gap_hi is not None and gap_hi <= gap_lo:
+                block, gap = blocks[hi], gap_hi
+                hi += 1
+            else:
+                block, gap = blocks[lo], gap_lo
+                lo -= 1
+            if gap > best[0]:
+                break
+            start, _, _, min_height, max_height = block
+            if gap + max(0, min_height - h1, h1 - max_height) > best[0]:
+                continue
+            for width, height, order, key, _ in entries[start:start + SIZE_INDEX_BLOCK]:
+                candidate = (abs(w1 - width) + abs(h1 - height), order, key)
+                if candidate < best:
+                    best = candidate
+        if best[2] is None:
+            return None, None
+        return best[0], best[2]
+
+def _unique_keys(pairs: list) -> dict:
+    """json.load() hook which rejects duplicate keys instead of keeping the last one."""
+    result = {}
+    for key, value in pairs:
+        if key in result:
+            raise ValueError(f"duplicate key {key!r}")
+        result[key] = value
+    return result
+
+def _paper_size_entry(name: str, value, tolerance, source: str) -> list:
+    """Validate one paper size of a registry file, see load_paper_sizes()."""
+    if isinstance(value, dict):
+        unknown = set(value) - {"width", "height", "tolerance"}
+        if unknown or not {"width", "height"} <= set(value):
+            raise ValueError(f"{source}: {name}: expected width, height and optional tolerance keys")
+        value = [value["width"], value["height"], value.get("tolerance", tolerance)]
+    elif isinstance(value, list) and len(value) in (2, 3):
+        value = value + [tolerance] if len(value) == 2 else list(value)
+    else:
+        raise ValueError(f"{source}: {name}: expected [width, height] or [width, height, tolerance]")
+    if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value):
+        raise ValueError(f"{source}: {name}: sizes and tolerance must be numbers")
+    width, height, tol = value
+    if width <= 0 or height <= 0 or tol < 0:
+        raise ValueError(f"{source}: {name}: sizes must be positive and tolerance not negative")
+    if width > height:
+        raise ValueError(f"{source}: {name}: width {width} is greater than height {height}")
+    return [width, height, tol]
+
+def load_paper_sizes(path: str) -> PaperSizeDict:
+    """
+    Load a paper size registry from a TOML or JSON file (by the .toml extension).
+    Sizes are [width, height] or [width, height, tolerance] in points, width not
+    greater than height, or tables with width, height and tolerance keys.
+    They are given in a `sizes` table and/or `families` of sizes with their
+    own default `tolerance`, `builtin = true` starts from the built-in sizes.
+    Duplicate names and malformed sizes are rejected::
+
+        tolerance = 2
+        builtin = true
+
+        [families.rolls]
+        tolerance = 10
+        sizes = { "Roll 914x2000" = [2591, 5669] }
+
+    :param path: str
+        The registry filename.
+    :return: PaperSizeDict
+        Returns the validated paper sizes.
+    """
+    if path.lower().endswith(".toml"):
+        if tomllib is None:
+            raise ValueError(f"{path}: reading TOML needs Python 3.11+ or the tomli package")
+        with open(path, "rb") as f:
+            try:
+                # The TOML parser rejects duplicate keys itself
+                data = tomllib.load(f)
+            except tomllib.TOMLDecodeError as err:
+                raise ValueError(f"{path}: {err}")
+    else:
+        with open(path, encoding="utf-8") as f:
+            try:
+                data = json.load(f, object_pairs_hook=_unique_keys)
+            except ValueError as err:
+                raise ValueError(f"{path}: {err}")
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected a table at the top level")
+    unknown = set(data) - {"builtin", "tolerance", "sizes", "families"}
+    if unknown:
+        raise ValueError(f"{path}: unknown keys: {', '.join(sorted(unknown))}")
+
+    sizes = PaperSizeDict()
+    if data.get("builtin", False):
+        sizes.update((name, list(wh)) for name, wh in _BUILTIN_PAPER_SIZES.items())
+    tolerance = data.get("tolerance", FMT_TOLERANCE)
+    groups = [("sizes", data.get("sizes", {}), tolerance)]
+    for family, group in data.get("families", {}).items():
+        if not isinstance(group, dict) or set(group) - {"tolerance", "sizes"}:
+            raise ValueError(f"{path}: families.{family}: expected tolerance and sizes keys")
+        groups.append((f"families.{family}", group.get("sizes", {}), group.get("tolerance", tolerance)))
+    for source, group, group_tolerance in groups:
+        if not isinstance(group, dict):
+            raise ValueError(f"{path}: {source}: expected a table of sizes")
+        for name, value in group.items():
+            if name in sizes:
+                raise ValueError(f"{path}: {source}: {name} is defined twice")
+            sizes[name] = _paper_size_entry(name, value, group_tolerance, f"{path}: {source}")
+    if not sizes:
+        raise ValueError(f"{path}: no paper sizes defined")
+    return sizes
+
+def use_paper_sizes(sizes: dict):
+    """
+    Replace the content of the `PaperSizes` dictionary, the lookup index and the memo
+    of find_fmt() are rebuilt on the next lookup. Worker processes started afterwards
+    inherit the new sizes.
+
+    :param sizes: dict
+        Paper sizes, see load_paper_sizes().
+    """
+    PaperSizes.clear()
+    PaperSizes.update(sizes)
+
+_size_index = None
+
+def paper_size_index() -> PaperSizeIndex:
+    """
+    Get the lookup index of the `PaperSizes` dictionary, rebuilding it if the dictionary has changed.
+
+    :return: PaperSizeIndex
+        Returns the current paper size index.
+    """
+    global _size_index
+    if (
+        _size_index is None
+        or _size_index.sizes is not PaperSizes
+        or _size_index.version != getattr(PaperSizes, "version", None)
+    ):
+        _size_index = PaperSizeIndex(PaperSizes)
+        # Formats memoized for the previous sizes are no longer valid
+        info = _find_fmt_memo.cache_info()
+        _fmt_memo_totals[0] += info.hits
+        _fmt_memo_totals[1] += info.misses
+        _find_fmt_memo.cache_clear()
+    return _size_index
+
+_fmt_memo_totals = [0, 0]  # hits and misses of the memo generations cleared so far
+
+@lru_cache(maxsize=FMT_MEMO_SIZE)
+def _find_fmt_memo(width: int, height: int, portrait: bool, orient: bool) -> str:
+    """find_fmt_rounded() memoized on the rounded page size and orientation."""
+    return find_fmt_rounded(width, height, portrait, orient)
+
+def fmt_memo_stats() -> tuple:
+    """
+    Get the statistics of the find_fmt() memo in the current process.
+
+    :return: tuple
+        Returns (hits, misses) tuple.
+    """
+    info = _find_fmt_memo.cache_info()
+    return info.hits + _fmt_memo_totals[0], info.misses + _fmt_memo_totals[1]
+
+def get_output_dir(dirpath: str) -> str:
+    """
+    The output directory of an input directory, kept inside it.
+
+    :param dirpath: str
+        The input directory.
+    :return: str
+        Returns the output directory with full path.
+    """
+    dirpath = os.path.abspath(dirpath)
+    return os.path.join(dirpath, os.path.basename(dirpath) + "-PDFs")
+
+def init_dirs(dirpath: str) -> str:
+    """
+    Set the input directory and the output directory inside it
+    as the defaults of the functions which take no `dirpath`.
+
+    :param dirpath: str
+        The input directory.
+    :return: str
+        Returns the output directory with full path.
+    """
+    global input_dir
+    global output_dir
+    input_dir = os.path.abspath(dirpath)
+    output_dir = get_output_dir(input_dir)
+    return output_dir
+
+_WALK_DONE = object()  # end of a subtree marker passed by the walker threads of iter_pdf_files()
+
+def iter_pdf_files(
+    dirpath: str,
+    exclude: tuple = (),
+    skip: tuple = (),
+    hidden: bool = False,
+    jobs: int = 1,
+    stats: dict = None,
+) -> Iterator[str]:
+    """
+    Walk a directory tree with os.scandir() and yield PDF filenames as soon as they are found.
+    Entries of every directory are taken in name order, files before subdirectories.
+    With `jobs` > 1 the top-level subdirectories are walked by threads at once,
+    each passing its paths on through a bounded queue, they are yielded
+    in the same order as by a single walk.
+
+    :param dirpath: str
+        The directory to start find PDF files recursively with all nested subdirectories.
+    :param exclude: tuple, optional
+        Glob patterns of files and directories to leave out, matched against
+        the path relative to `dirpath` and against the name.
+    :param skip: tuple, optional
+        Directories with full paths to leave out, such as the output dir.
+    :param hidden: bool, optional
+        Also walk hidden files and directories (default is False).
+    :param jobs: int, optional
+        The number of threads walking the top-level subdirectories in parallel (default is 1).
+    :param stats: dict, optional
+        A dictionary to fill with stat results of the found files, taken from the directory entries.
+    :return: Iterator[str]
+        Yields PDF filenames with full paths.
+    """
+    root = os.path.abspath(dirpath)
+    skip = {os.path.abspath(path) for path in skip}
+
+    def entries(path: str) -> tuple:
+        files, dirs = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if not hidden and entry.name.startswith("."):
+                        continue
+                    rel = os.path.relpath(entry.path, root)
+                    if any(
+                        fnmatch.fnmatch(rel, pat) or fnmatch.fnmatch(entry.name, pat)
+                        for pat in exclude
+                    ):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            if entry.path not in skip:
+                                dirs.append(entry)
+                        elif entry.name.lower().endswith(".pdf"):
+                            if stats is not None:
+                                stats[entry.path] = entry.stat()
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        files.sort()
+        dirs.sort(key=lambda entry: entry.name)
+        return files, dirs
+
+    def walk(path: str) -> Iterator[str]:
+        visited = set()
+        stack = [path]
+        while stack:
+            files, dirs = entries(stack.pop())
+            yield from files
+            for entry in reversed(dirs):
+                if entry.is_symlink():
+                    # Follow links to directories, but only once
+                    real = os.path.realpath(entry.path)
+                    if real in visited:
+                        continue
+                    visited.add(real)
+                stack.append(entry.path)
+
+    if jobs > 1:
+        files, dirs = entries(root)
+        yield from files
+        stop = threading.Event()
+
+        def put(out: queue.Queue, item) -> bool:
+            # A walker waits for the consumer, unless it has stopped taking paths
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=WORKER_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def walk_into(path: str, out: queue.Queue):
+            try:
+                for filename in walk(path):
+                    if not put(out, filename):
+                        return
+            finally:
+                put(out, _WALK_DONE)
+
+        # Subtrees start in order, the one being yielded is always walked or done
+        queues = [queue.Queue(maxsize=WALK_QUEUE_SIZE) for _ in dirs]
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        futures = []
+        try:
+            for entry, out in zip(dirs, queues):
+                futures.append(executor.submit(walk_into, entry.path, out))
+            for out in queues:
+                for filename in iter(out.get, _WALK_DONE):
+                    yield filename
+        finally:
+            stop.set()
+            # Subtrees not started yet are not walked at all
+            # (shutdown(cancel_futures=True) needs Python 3.9)
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+    else:
+        yield from walk(root)
+
+def list_files_recursive(dirpath: str, exclude: tuple = (), hidden: bool = False) -> list:
     """
     Recursively get all PDF filenames with full path from a given directory.
+    The output directory is left out, so the files of previous runs are not taken as input.
 
     :param dirpath: str
         The directory to start find PDF files recursively with all nested subdirectories.
+    :param exclude: tuple, optional
+        Glob patterns of files and directories to leave out, see iter_pdf_files().
+    :param hidden: bool, optional
+        Also take hidden files and directories (default is False).
     :return: list
         Returns a list of PDF filenames with full paths.
     """
-    global input_dir
-    global output_dir
-    input_dir = os.path.abspath(dirpath)
-    output_dir = os.path.join(input_dir, os.path.basename(input_dir) + "-PDFs")
-    return glob.glob(
-        os.path.join(os.path.abspath(dirpath), "**", "*.[pP][dD][fF]"), recursive=True
-    )
+    return list(iter_pdf_files(dirpath, exclude, (init_dirs(dirpath),), hidden))
 
 def collect_pdf_content(file_paths: list) -> list:
     """
@@ -115,8 +631,995 @@ def collect_pdf_content(file_paths: list) -> list:
             all_pages.extend(reader.pages)
         except FileNotFoundError as err:
             print(f"Error: {err}\nFile ignored.")
+        except Exception as err:
+            print(f"Error: {file_path}: {type(err).__name__}: {err}\nFile ignored.")
     return all_pages
 
+def open_pdf(file_path: str, use_mmap: bool = False) -> PdfReader:
+    """
+    Open a PDF file for reading.
+    pypdf reads a whole file into memory when given its name, with `use_mmap`
+    the file is memory-mapped instead, so only the parts pypdf actually reads
+    are paged in by the OS and the rest of the file content is never copied.
+
+    :param file_path: str
+        A PDF filename with full path.
+    :param use_mmap: bool, optional
+        Memory-map the file (default is False).
+    :return: PdfReader
+        Returns the reader of the file.
+    """
+    if use_mmap:
+        with open(file_path, "rb") as f:
+            try:
+                # The mapping stays valid after the file is closed
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # an empty file can't be mapped
+                mapped = None
+        if mapped is not None:
+            try:
+                return PdfReader(mapped)
+            except BaseException:
+                mapped.close()
+                raise
+    return PdfReader(file_path)
+
+def close_pdf(reader: PdfReader):
+    """
+    Release the file content of a reader right away, without waiting for
+    the garbage collector (readers are kept alive by reference cycles).
+
+    :param reader: PdfReader
+        A reader opened with open_pdf().
+    """
+    if isinstance(reader.stream, mmap.mmap):
+        reader.stream.close()
+
+class PageRef(NamedTuple):
+    """A lightweight reference to a page: source file, page index and page size as displayed."""
+
+    path: str
+    index: int
+    width: float
+    height: float
+
+class FileScan(NamedTuple):
+    """
+    Result of scanning one PDF file: page boxes in page order
+    as (width, height, rotate, user unit) tuples and page counts per format.
+    """
+
+    path: str
+    boxes: list
+    formats: dict
+    error: str = ""
+    parse_time: float = 0.0
+    skipped_pages: int = 0  # pages of a file which failed, -1 if unknown
+
+_PDF_OBJ_RE = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj\s*<<")
+_PDF_TOKEN_RE = re.compile(rb"<<|>>|<[0-9A-Fa-f\s]*>|\(|%[^\r\n]*|/([^\s/\[\]()<>{}%]+)")
+_PDF_VALUE_RE = re.compile(
+    rb"\s*(?:\[([^\[\]]*)\]|(\d+)\s+(\d+)\s+R\b|([-+]?(?:\d+\.?\d*|\.\d+)))"
+)
+_PDF_REF_RE = re.compile(rb"(\d+)\s+(\d+)\s+R\b")
+_PAGE_TREE_KEYS = {b"Kids": "/Kids", b"Count": "/Count", b"MediaBox": "/MediaBox",
+                   b"Rotate": "/Rotate", b"UserUnit": "/UserUnit"}
+
+def _skip_pdf_string(data: bytes, pos: int) -> int:
+    """Return the position after a literal string whose opening bracket ends at `pos`, -1 if truncated."""
+    depth = 1
+    while depth:
+        if pos >= len(data):
+            return -1
+        char = data[pos:pos + 1]
+        if char == b"\\":
+            pos += 1
+        elif char == b"(":
+            depth += 1
+        elif char == b")":
+            depth -= 1
+        pos += 1
+    return pos
+
+def _raw_page_node(reader: PdfReader, ref: IndirectObject):
+    """
+    Read the page tree keys of a node straight from the file bytes, without building pypdf objects.
+    Returns a dict of raw values or None if the node is to be read by pypdf
+    (compressed object stream, indirect values, unexpected syntax).
+    """
+    if ref.generation == 0 and ref.idnum in reader.xref_objStm:
+        return None
+    offset = reader.xref.get(ref.generation, {}).get(ref.idnum)
+    if offset is None:
+        return None
+    stream = reader.stream
+    stream.seek(offset)
+    data = stream.read(RAW_READ_SIZE)
+    while b"endobj" not in data:
+        more = stream.read(RAW_READ_SIZE)
+        if not more or len(data) > 64 * RAW_READ_SIZE:
+            return None
+        data += more
+    match = _PDF_OBJ_RE.match(data)
+    if match is None or (int(match.group(1)), int(match.group(2))) != (ref.idnum, ref.generation):
+        return None
+
+    node = {}
+    pos = match.end()
+    depth = 1
+    while depth:
+        token = _PDF_TOKEN_RE.search(data, pos)
+        if token is None:
+            return None
+        pos = token.end()
+        if token.group(0) == b"<<":
+            depth += 1
+        elif token.group(0) == b">>":
+            depth -= 1
+        elif token.group(0) == b"(":
+            pos = _skip_pdf_string(data, pos)
+            if pos < 0:
+                return None
+        elif depth == 1 and token.group(1) in _PAGE_TREE_KEYS:
+            value = _PDF_VALUE_RE.match(data, pos)
+            if value is None or value.group(2) is not None:
+                return None  # an indirect value, let pypdf resolve it
+            pos = value.end()
+            key = _PAGE_TREE_KEYS[token.group(1)]
+            if value.group(1) is None:
+                node[key] = float(value.group(4))
+            elif key == "/Kids":
+                node[key] = [
+                    IndirectObject(int(idnum), int(generation), reader)
+                    for idnum, generation in _PDF_REF_RE.findall(value.group(1))
+                ]
+            elif b"R" in value.group(1):
+                return None
+            else:
+                node[key] = [float(v) for v in value.group(1).split()]
+    return node
+
+def _pypdf_page_node(reader: PdfReader, ref) -> dict:
+    """Read the page tree keys of a node through pypdf, in the same shape as _raw_page_node()."""
+    obj = ref.get_object()
+    node = {}
+    for key in _PAGE_TREE_KEYS.values():
+        if key in obj:
+            value = obj[key]
+            if key == "/Kids":
+                node[key] = list(value)
+            elif key == "/MediaBox":
+                node[key] = [float(v) for v in value]
+            else:
+                node[key] = float(value)
+    return node
+
+def read_page_boxes(reader: PdfReader) -> list:
+    """
+    Read the page boxes of a PDF document walking the page tree (/Pages -> /Kids)
+    and resolving only /MediaBox, /Rotate (both can be inherited from the tree) and /UserUnit.
+    Page tree nodes are read straight from the file bytes where possible,
+    page objects with their contents and resources are not built.
+
+    :param reader: PdfReader
+        An opened PDF document.
+    :return: list
+        Returns a list of (width, height, rotate, user unit) tuples in page order.
+    """
+    boxes = []
+    visited = set()
+    pages_root = reader.trailer["/Root"].raw_get("/Pages")
+    stack = [(pages_root, None, 0)]
+    count = None
+    while stack:
+        ref, mediabox, rotate = stack.pop()
+        if not isinstance(ref, IndirectObject) or (ref.idnum, ref.generation) in visited:
+            raise ValueError("Unexpected page tree node")
+        visited.add((ref.idnum, ref.generation))
+        node = _raw_page_node(reader, ref)
+        if node is None:
+            node = _pypdf_page_node(reader, ref)
+        if count is None:
+            count = int(node.get("/Count", -1))
+        mediabox = node.get("/MediaBox", mediabox)
+        rotate = int(node.get("/Rotate", rotate))
+        if "/Kids" in node:
+            for kid in reversed(node["/Kids"]):
+                stack.append((kid, mediabox, rotate))
+        else:
+            x1, y1, x2, y2 = mediabox
+            boxes.append((x2 - x1, y2 - y1, rotate, node.get("/UserUnit", 1.0)))
+    if len(boxes) != count:
+        raise ValueError("Page count mismatch in the page tree")
+    return boxes
+
+def scan_pdf_file(file_path: str, classify: bool = True, use_mmap: bool = False) -> FileScan:
+    """
+    Read the page boxes of one PDF file and count its pages for each format.
+    Runs in a worker process, so only plain picklable data is returned.
+
+    :param file_path: str
+        A PDF filename with full path.
+    :param classify: bool, optional
+        Count pages for each format (default is True), otherwise `formats` is left empty.
+    :param use_mmap: bool, optional
+        Memory-map the file instead of reading it into memory, see open_pdf().
+    :return: FileScan
+        Returns the scan result, with the `error` field set if the file can't be read.
+    """
+    start = time.perf_counter()
+    reader = None
+    try:
+        reader = open_pdf(file_path, use_mmap)
+        try:
+            boxes = read_page_boxes(reader)
+        except Exception:
+            # Broken page tree, let pypdf build the pages the full way
+            boxes = [
+                (
+                    float(pg.mediabox.width),
+                    float(pg.mediabox.height),
+                    int(pg.get("/Rotate", 0)),
+                    float(pg.get("/UserUnit", 1)),
+                )
+                for pg in reader.pages
+            ]
+    except FileNotFoundError as err:
+        return FileScan(file_path, [], {}, str(err), skipped_pages=-1)
+    except Exception as err:
+        # A broken or password protected file must not stop the run
+        return FileScan(
+            file_path,
+            [],
+            {},
+            f"{type(err).__name__}: {err}",
+            time.perf_counter() - start,
+            _declared_page_count(reader),
+        )
+    finally:
+        # A broken file must not keep its mapping in a long-lived worker
+        if reader is not None:
+            close_pdf(reader)
+    return FileScan(
+        file_path,
+        boxes,
+        count_formats(boxes) if classify else {},
+        parse_time=time.perf_counter() - start,
+    )
+
+def _declared_page_count(reader) -> int:
+    """The page count in the page tree root of a file which couldn't be scanned, -1 if unknown."""
+    try:
+        return int(reader.trailer["/Root"]["/Pages"]["/Count"])
+    except Exception:
+        return -1
+
+def count_formats(boxes: list) -> dict:
+    """
+    Count pages for each format from a list of page box sizes.
+
+    :param boxes: list
+        A list of (width, height, ...) tuples.
+    :return: dict
+        Returns the dictionary where page format as the key and
+        their amount as the value.
+    """
+    formats = {}
+    for box in boxes:
+        fmt = find_fmt(*effective_size(*box), False)
+        formats[fmt] = formats.get(fmt, 0) + 1
+    return formats
+
+def effective_size(width: float, height: float, rotate: int = 0, user_unit: float = 1.0) -> tuple:
+    """
+    The size of a page as displayed: the box scaled by /UserUnit (the size of the
+    default user space unit in points, used by large plotter drawings) and swapped
+    if /Rotate turns the page a quarter.
+
+    :param width: float
+        The page box width.
+    :param height: float
+        The page box height.
+    :param rotate: int, optional
+        The page /Rotate value in degrees.
+    :param user_unit: float, optional
+        The page /UserUnit value.
+    :return: tuple
+        Returns a (width, height) tuple in points.
+    """
+    width, height = width * user_unit, height * user_unit
+    return (height, width) if rotate % 180 == 90 else (width, height)
+
+def scan_pdf_files(
+    file_paths: list,
+    jobs: int = 1,
+    cache=None,
+    use_mmap: bool = False,
+    quarantine=None,
+    scanner=None,
+) -> Iterator[FileScan]:
+    """
+    Scan several PDF files, spreading them over a pool of `jobs` worker processes.
+    Results are yielded in the order of `file_paths` whatever the number of workers.
+
+    :param file_paths: list
+        A list of PDF filenames with full paths.
+    :param jobs: int, optional
+        The number of worker processes (default is 1, scan in the current process).
+    :param cache: ScanCache, optional
+        A persistent scan index, only new or changed files are parsed when given.
+    :param use_mmap: bool, optional
+        Memory-map the files instead of reading them into memory, see open_pdf().
+    :param quarantine: Quarantine, optional
+        Records the files which can't be read instead of only reporting them.
+    :param scanner: IsolatedScanner, optional
+        Scans every file in an isolated worker process under its time and memory limits.
+    :return: Iterator[FileScan]
+        Yields a FileScan for every readable file received from `file_paths` param.
+    """
+    if cache is None:
+        scans = _map_scans(file_paths, jobs, use_mmap, scanner)
+        yield from _skip_failed_scans(scans, quarantine)
+        return
+
+    # Every path gives exactly one scan, failed or not, so the paths seen
+    # are collected from the results instead of holding `file_paths`
+    seen = []
+    for scan in _map_scans(file_paths, jobs, use_mmap, scanner, cache):
+        seen.append(scan.path)
+        yield from _skip_failed_scans([scan], quarantine)
+    cache.evict(seen)
+
+def _map_scans(
+    file_paths: list, jobs: int, use_mmap: bool = False, scanner=None, cache=None
+) -> Iterator[FileScan]:
+    """
+    Run scan_pdf_file() over the files in order, in a process pool if `jobs` > 1.
+    Files are handed to the workers as they arrive and at most a bounded window
+    of them is scanned ahead of the consumer. Files found unchanged in the
+    `cache` skip the workers, parsed ones are stored in it.
+    """
+    if scanner is None and jobs <= 1:
+        for path in file_paths:
+            scan = cache.get(path) if cache is not None else None
+            if scan is None:
+                scan = scan_pdf_file(path, True, use_mmap)
+                if cache is not None:
+                    cache.put(scan)
+            yield scan
+        return
+
+    if scanner is not None:
+        # Each thread waits on its own isolated worker process
+        jobs = max(1, jobs)
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        scan_args = ()
+        scan_file = scanner.scan
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        scan_args = (False, use_mmap)
+        scan_file = scan_pdf_file
+    window = jobs * SCAN_CHUNKSIZE * 2
+    # Cached scans and futures of parsed ones, in the order of `file_paths`
+    pending = deque()
+
+    def result(item) -> FileScan:
+        if isinstance(item, FileScan):
+            return item
+        # Workers only parse, the pages are classified here through the
+        # format memo, which is cheaper than parsing by orders of magnitude
+        scan = item.result()
+        scan = scan._replace(formats=count_formats(scan.boxes))
+        if cache is not None:
+            cache.put(scan)
+        return scan
+
+    with executor:
+        try:
+            for path in file_paths:
+                cached = cache.get(path) if cache is not None else None
+                if cached is None:
+                    cached = executor.submit(scan_file, path, *scan_args)
+                pending.append(cached)
+                while pending and (
+                    len(pending) >= window
+                    or isinstance(pending[0], FileScan)
+                    or pending[0].done()
+                ):
+                    yield result(pending.popleft())
+            while pending:
+                yield result(pending.popleft())
+        finally:
+            # Files not started yet are not parsed when the consumer stops early
+            for item in pending:
+                if not isinstance(item, FileScan):
+                    item.cancel()
+
+def _skip_failed_scans(scans, quarantine=None) -> Iterator[FileScan]:
+    """Report files which couldn't be read (to the `quarantine` if given) and pass the other scans through."""
+    for scan in scans:
+        if not scan.error:
+            yield scan
+        elif quarantine is not None:
+            quarantine.add(scan)
+        else:
+            print(f"Error: {_scan_error(scan)}\nFile ignored.", file=sys.stderr)
+
+def _scan_error(scan: FileScan) -> str:
+    return scan.error if scan.path in scan.error else f"{scan.path}: {scan.error}"
+
+class Quarantine:
+    """
+    Files left out of a run because they couldn't be scanned, with the reason
+    and the number of their pages if it could still be read. Saved as JSON
+    in the output dir, so a partial table or partial output files are known as such.
+    """
+
+    def __init__(self):
+        self.files = []
+
+    def add(self, scan: FileScan):
+        """
+        Record a failed scan and report it.
+
+        :param scan: FileScan
+            The scan result with the `error` field set.
+        """
+        print(f"Error: {_scan_error(scan)}\nFile quarantined.", file=sys.stderr)
+        self.files.append({
+            "path": scan.path,
+            "reason": scan.error,
+            "pages": scan.skipped_pages if scan.skipped_pages >= 0 else None,
+        })
+
+    def skipped(self) -> dict:
+        """
+        Count what has been left out.
+
+        :return: dict
+            Returns the number of quarantined files, their known pages
+            and the number of files whose page count is unknown.
+        """
+        return {
+            "files": len(self.files),
+            "pages": sum(entry["pages"] or 0 for entry in self.files),
+            "unknown": sum(1 for entry in self.files if entry["pages"] is None),
+        }
+
+    def save(self, path: str):
+        """
+        Write the quarantine report, or remove the report of a previous run if no file failed.
+
+        :param path: str
+            The JSON filename.
+        """
+        if not self.files:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        mk_output_dir(os.path.dirname(path))
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"skipped": self.skipped(), "files": self.files}, f, ensure_ascii=False, indent=2
+            )
+
+def _isolated_worker(conn, max_memory: int, use_mmap: bool):
+    """Worker process loop of IsolatedScanner, scans files until it receives None."""
+    if max_memory > 0 and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        path = request
+        try:
+            scan = scan_pdf_file(path, False, use_mmap)
+        except MemoryError:
+            scan = FileScan(path, [], {}, "MemoryError: memory limit exceeded", skipped_pages=-1)
+        conn.send(scan)
+
+class IsolatedScanner:
+    """
+    Scans every file in a worker process under a time limit and a memory cap,
+    so a file which makes the parser loop, run out of memory or crash fails alone.
+    A worker which runs out of time or dies is replaced. scan() can be called
+    from several threads at once, one worker process is kept for each.
+    """
+
+    def __init__(self, timeout: float = 0, max_memory: int = 0, use_mmap: bool = False):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.use_mmap = use_mmap
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _spawn(self) -> tuple:
+        # A worker forked meanwhile by another thread would keep the child end open
+        with self.lock:
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=_isolated_worker, args=(child_conn, self.max_memory, self.use_mmap), daemon=True
+            )
+            proc.start()
+            child_conn.close()
+        return proc, conn
+
+    def _wait(self, proc, conn, start: float) -> bool:
+        """Wait for the result of a worker, False if it has run out of time or has died."""
+        while not conn.poll(WORKER_POLL_INTERVAL):
+            # Other processes forked at the same time may hold the pipe open,
+            # so a dead worker is not always seen as the end of the pipe
+            if self.timeout > 0 and time.perf_counter() - start >= self.timeout:
+                return False
+            if not proc.is_alive():
+                return conn.poll(0)
+        return True
+
+    def scan(self, file_path: str) -> FileScan:
+        """
+        Scan one file, like scan_pdf_file() without classifying the pages.
+
+        :param file_path: str
+            A PDF filename with full path.
+        :return: FileScan
+            Returns the scan result, with the `error` field set if the file can't be read,
+            has run out of time or has crashed the worker.
+        """
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        if worker is None:
+            worker = self._spawn()
+        proc, conn = worker
+        start = time.perf_counter()
+        reason = None
+        try:
+            conn.send(file_path)
+            if self._wait(proc, conn, start):
+                scan = conn.recv()
+                with self.lock:
+                    self.idle.append(worker)
+                return scan
+            if proc.is_alive():
+                reason = f"timed out after {self.timeout:g}s"
+        except (EOFError, OSError):
+            pass
+        proc.terminate()
+        proc.join()
+        conn.close()
+        if reason is None:
+            reason = f"worker died with exit code {proc.exitcode}"
+        return FileScan(file_path, [], {}, f"Quarantined: {reason}", time.perf_counter() - start, -1)
+
+    def close(self):
+        """Stop the idle worker processes."""
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for proc, conn in workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+            conn.close()
+
+def file_digest(file_path: str, max_bytes: int = 0) -> str:
+    """
+    Calculate the SHA-256 hash of a file content.
+
+    :param file_path: str
+        A filename with full path.
+    :param max_bytes: int, optional
+        Hash only the first `max_bytes` bytes (default is 0, the whole file).
+    :return: str
+        Returns the hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        if max_bytes > 0:
+            digest.update(f.read(max_bytes))
+        else:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def _hash_object(obj, digest, seen: set):
+    """Add a PDF object to a page fingerprint, following references once."""
+    if isinstance(obj, IndirectObject):
+        if (obj.idnum, obj.generation) in seen:
+            digest.update(b"R")
+            return
+        seen.add((obj.idnum, obj.generation))
+        obj = obj.get_object()
+    skip = ("/Parent",)  # leads back up the page tree, which isn't part of the page
+    if isinstance(obj, StreamObject):
+        # Streams are compared decoded, however they are compressed
+        data = obj.get_data()
+        digest.update(b"S%d:" % len(data) + data)
+        skip += ("/Filter", "/DecodeParms", "/Length")
+    if isinstance(obj, DictionaryObject):
+        digest.update(b"<<")
+        for key in sorted(obj):
+            if key not in skip:
+                digest.update(key.encode("utf-8", "replace"))
+                _hash_object(obj[key], digest, seen)
+        digest.update(b">>")
+    elif isinstance(obj, ArrayObject):
+        digest.update(b"[")
+        for item in obj:
+            _hash_object(item, digest, seen)
+        digest.update(b"]")
+    else:
+        digest.update(repr(obj).encode("utf-8", "replace"))
+
+def page_fingerprint(page) -> bytes:
+    """
+    A fingerprint of what a page shows: its size, rotation, content streams
+    and resources (fonts, images, form XObjects) with their decoded stream data.
+    Copies of a page from different files get the same fingerprint.
+
+    :param page: PageObject
+        A PDF page.
+    :return: bytes
+        Returns the SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((page_size(page), int(page.get("/Rotate", 0)))).encode())
+    seen = set()
+    for key in ("/Contents", "/Resources"):
+        digest.update(key.encode())
+        _hash_object(page.get(key), digest, seen)
+    return digest.digest()
+
+class Deduplicator:
+    """
+    Drops duplicate input files before they are parsed and, optionally, duplicate pages
+    before they are written, the first one found is kept. Files are compared by size,
+    then by a hash of their first `PARTIAL_HASH_SIZE` bytes, then by a full hash,
+    each step only among the files still alike, so most files are never read.
+    Pages are compared by page_fingerprint().
+    """
+
+    def __init__(self, level: int = DEDUPE_FILES, use_mmap: bool = False):
+        self.level = level
+        self.use_mmap = use_mmap
+        self.by_size = {}  # size -> kept files of that size
+        self.digests = {}  # (path, partial) -> hash
+        self.duplicates = {}  # duplicate file -> the kept file
+        self.bytes = 0
+        self.page_counts = {}
+        self.fingerprints = set()
+        self.dropped_pages = 0
+
+    def _digest(self, path: str, partial: bool):
+        key = (path, partial)
+        if key not in self.digests:
+            try:
+                self.digests[key] = file_digest(path, PARTIAL_HASH_SIZE if partial else 0)
+            except OSError:
+                self.digests[key] = None
+        return self.digests[key]
+
+    def _original(self, path: str):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        kept = self.by_size.setdefault(size, [])
+        for other in kept:
+            # The full hash tells apart only files longer than the partial one
+            if (
+                self._digest(path, True) is not None
+                and self._digest(path, True) == self._digest(other, True)
+                and (size <= PARTIAL_HASH_SIZE or self._digest(path, False) == self._digest(other, False))
+            ):
+                self.bytes += size
+                return other
+        kept.append(path)
+        return None
+
+    def files(self, file_paths) -> Iterator[str]:
+        """
+        Pass through the files which are not byte-identical to one passed before.
+
+        :param file_paths: list
+            A list (or any iterable) of PDF filenames with full paths.
+        :return: Iterator[str]
+            Yields the filenames of unique files.
+        """
+        for path in file_paths:
+            original = self._original(path)
+            if original is None:
+                yield path
+            else:
+                self.duplicates[path] = original
+
+    def add(self, scan: FileScan):
+        """Take the page count of a scanned file, duplicates of it have as many pages."""
+        self.page_counts[scan.path] = len(scan.boxes)
+
+    def feed(self, scans) -> Iterator[FileScan]:
+        """Take the page counts of file scans while passing them through, see add()."""
+        for scan in scans:
+            self.add(scan)
+            yield scan
+
+    def pages(self, pages) -> Iterator:
+        """
+        Pass through the pages which don't show the same as one passed before
+        (all pages unless the level is DEDUPE_PAGES).
+
+        :param pages: list
+            A list (or any iterable) of PageRef objects.
+        :return: Iterator[PageRef]
+            Yields the unique pages.
+        """
+        if self.level < DEDUPE_PAGES:
+            yield from pages
+            return
+        pool = ReaderPool(use_mmap=self.use_mmap)
+        try:
+            for pg in pages:
+                try:
+                    fingerprint = page_fingerprint(pool.get_page(pg))
+                except Exception:
+                    # A page that can't be fingerprinted is kept
+                    yield pg
+                    continue
+                if fingerprint in self.fingerprints:
+                    self.dropped_pages += 1
+                else:
+                    self.fingerprints.add(fingerprint)
+                    yield pg
+        finally:
+            pool.close()
+
+    def eliminated(self) -> dict:
+        """
+        Count what has been dropped.
+
+        :return: dict
+            Returns the number of duplicate files, the pages eliminated
+            (of duplicate files and duplicate pages) and the bytes of the duplicate files.
+        """
+        return {
+            "files": len(self.duplicates),
+            "pages": sum(self.page_counts.get(path, 0) for path in self.duplicates.values())
+            + self.dropped_pages,
+            "bytes": self.bytes,
+        }
+
+class ScanCache:
+    """
+    Persistent index of scanned PDF files in a SQLite database.
+    Records are keyed by file path, size and modification time
+    and can additionally be checked against the file content hash.
+    """
+
+    def __init__(self, db_path: str, verify_hash: bool = False):
+        mk_output_dir(os.path.dirname(db_path))
+        self.verify_hash = verify_hash
+        self.hits = 0
+        self.misses = 0
+        self.stats = {}
+        self.conn = sqlite3.connect(db_path)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT, boxes BLOB)"
+        )
+        self.entries = {
+            row[0]: row[1:]
+            for row in self.conn.execute("SELECT path, size, mtime_ns, digest, boxes FROM files")
+        }
+
+    def get(self, path: str):
+        """
+        Get the scan of an unchanged file from the index.
+
+        :param path: str
+            A PDF filename with full path.
+        :return: FileScan or None
+            Returns the stored scan or None if the file is new or has changed.
+        """
+        st = self.stats.get(path)
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.misses += 1
+                return None
+        # Keep the stat taken before parsing, a file changed meanwhile is parsed again next run
+        self.stats[path] = st
+        entry = self.entries.get(path)
+        if (
+            entry is None
+            or entry[:2] != (st.st_size, st.st_mtime_ns)
+            or (self.verify_hash and entry[2] != file_digest(path))
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        values = array("d")
+        values.frombytes(entry[3])
+        boxes = [
+            (width, height, int(rotate), user_unit)
+            for width, height, rotate, user_unit in zip(
+                values[0::4], values[1::4], values[2::4], values[3::4]
+            )
+        ]
+        return FileScan(path, boxes, count_formats(boxes))
+
+    def put(self, scan: FileScan):
+        """
+        Store the scan of a parsed file in the index.
+
+        :param scan: FileScan
+            The scan result, failed scans are not stored.
+        """
+        st = self.stats.get(scan.path)
+        if scan.error or st is None:
+            return
+        digest = file_digest(scan.path) if self.verify_hash else None
+        values = array("d", [v for box in scan.boxes for v in box])
+        entry = (st.st_size, st.st_mtime_ns, digest, values.tobytes())
+        self.entries[scan.path] = entry
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (scan.path,) + entry
+        )
+
+    def evict(self, file_paths: list):
+        """
+        Remove records of files which are no longer among the scanned ones.
+
+        :param file_paths: list
+            A list of PDF filenames with full paths found by the current run.
+        """
+        gone = set(self.entries) - set(file_paths)
+        for path in gone:
+            del self.entries[path]
+        self.conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in gone])
+        self.conn.commit()
+
+    def close(self):
+        """Save the index and close the database."""
+        self.conn.commit()
+        self.conn.close()
+
+def merge_format_info(scans) -> dict:
+    """
+    Merge per-file page counts for each format into the totals.
+
+    :param scans: list
+        A list (or any iterable) of FileScan objects.
+    :return: dict
+        Returns the dictionary where page format as the key and
+        their amount as the value.
+    """
+    format_info = {}
+    for scan in scans:
+        for fmt, cnt in scan.formats.items():
+            format_info[fmt] = format_info.get(fmt, 0) + cnt
+    return format_info
+
+def iter_page_boxes(
+    file_paths: list, jobs: int = 1, cache=None, use_mmap: bool = False
+) -> Iterator[PageRef]:
+    """
+    Stream page references of several pdf files one file at a time.
+    Only the page boxes are read, each reader is dropped before the next file is opened.
+
+    :param file_paths: list
+        A list of PDF filenames with full paths.
+    :param jobs: int, optional
+        The number of worker processes used to read the files (default is 1).
+    :param cache: ScanCache, optional
+        A persistent scan index, only new or changed files are parsed when given.
+    :param use_mmap: bool, optional
+        Memory-map the files instead of reading them into memory, see open_pdf().
+    :return: Iterator[PageRef]
+        Yields a PageRef for every page of the PDF files received from `file_paths` param.
+    """
+    return scans_to_page_refs(scan_pdf_files(file_paths, jobs, cache, use_mmap))
+
+def scans_to_page_refs(scans) -> Iterator[PageRef]:
+    """
+    Turn file scans into page references.
+
+    :param scans: list
+        A list (or any iterable) of FileScan objects.
+    :return: Iterator[PageRef]
+        Yields a PageRef for every page of the scanned files.
+    """
+    for scan in scans:
+        for i, box in enumerate(scan.boxes):
+            yield PageRef(scan.path, i, *effective_size(*box))
+
+def page_size(pg) -> tuple:
+    """
+    Get the width and height of a page as displayed, see effective_size().
+
+    :param pg: PageObject or PageRef
+        A PDF page or a reference to it.
+    :return: tuple
+        Returns a (width, height) tuple.
+    """
+    if isinstance(pg, PageRef):
+        return pg.width, pg.height
+    return effective_size(
+        float(pg.mediabox.width),
+        float(pg.mediabox.height),
+        int(pg.get("/Rotate", 0)),
+        float(pg.get("/UserUnit", 1)),
+    )
+
+class ReaderPool:
+    """
+    Resolves PageRef objects into pages while keeping at most `max_open`
+    source files open, the least recently used reader is dropped first.
+    """
+
+    def __init__(self, max_open: int = MAX_OPEN_READERS, use_mmap: bool = False):
+        self.max_open = max(1, max_open)
+        self.use_mmap = use_mmap
+        self.readers = OrderedDict()
+
+    def get_page(self, pg):
+        """
+        Get a page object for a page reference.
+
+        :param pg: PageObject or PageRef
+            A PDF page or a reference to it, pages are returned as is.
+        :return: PageObject
+            Returns the page object.
+        """
+        if not isinstance(pg, PageRef):
+            return pg
+        reader = self.readers.pop(pg.path, None)
+        if reader is None:
+            reader = open_pdf(pg.path, self.use_mmap)
+            while len(self.readers) >= self.max_open:
+                close_pdf(self.readers.popitem(last=False)[1])
+        self.readers[pg.path] = reader
+        return reader.pages[pg.index]
+
+    def page_bytes(self, path: str) -> float:
+        """
+        Average size of a page of an open source file.
+
+        :param path: str
+            A PDF filename with full path, opened by get_page().
+        :return: float
+            Returns the file size divided by its number of pages.
+        """
+        return os.path.getsize(path) / max(1, len(self.readers[path].pages))
+
+    def close(self):
+        """Drop all open readers."""
+        for reader in self.readers.values():
+            close_pdf(reader)
+        self.readers.clear()
+
+def peak_memory_mb():
+    """
+    Get the peak resident memory of the current process.
+
+    :return: float or None
+        Returns peak RSS in MiB or None if it can't be determined on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
 def find_fmt(iwidth: float, iheight: float, orient: bool = True) -> str:
     """
     Determine the page format from the `PaperSizes` dictionary, 
@@ -131,20 +1634,33 @@ def find_fmt(iwidth: float, iheight: float, orient: bool = True) -> str:
     :return: str
         Returns the standard page format or the approximately closest format.
     """
-    width: int = int(round(iwidth, 0))
-    height: int = int(round(iheight, 0))
+    paper_size_index()  # drops the memoized formats if `PaperSizes` has changed
+    return _find_fmt_memo(
+        int(round(iwidth, 0)), int(round(iheight, 0)), iwidth <= iheight, orient
+    )
+
+def find_fmt_rounded(width: int, height: int, portrait: bool, orient: bool = True) -> str:
+    """
+    Determine the page format for the already rounded width and height, see find_fmt().
 
-    w1, h1 = (width, height) if iwidth <= iheight else (height, width)
+    :param width: int
+        Rounded input width.
+    :param height: int
+        Rounded input height.
+    :param portrait: bool
+        True if the unrounded width is not greater than the unrounded height.
+    :param orient: bool, optional
+        Determine the paper orientation (default is True).
+    :return: str
+        Returns the standard page format or the approximately closest format.
+    """
+    w1, h1 = (width, height) if portrait else (height, width)
 
     str_width, str_height = str(w1), str(h1)
 
-    distances = {
-        (abs(w1 - s[0]) + abs(h1 - s[1])): key for key, s in PaperSizes.items()
-    }
-    closest_distance = min(distances.keys())
-    paper_size_key = distances[closest_distance]
+    _, paper_size_key, matched = paper_size_index().match(w1, h1)
 
-    if iwidth <= iheight:
+    if portrait:
         paper_orientation = paper_size_key + "-P" if orient else paper_size_key
         paper_size_str = (
             f"{PaperSizes[paper_size_key][0]}x{PaperSizes[paper_size_key][1]}"
@@ -155,52 +1671,683 @@ def find_fmt(iwidth: float, iheight: float, orient: bool = True) -> str:
             f"{PaperSizes[paper_size_key][1]}x{PaperSizes[paper_size_key][0]}"
         )
 
-    if closest_distance >= 0 and closest_distance <= 2:
+    if matched:
         return paper_orientation
 
     return f"{str_width}x{str_height} ~{paper_orientation}({paper_size_str})"
 
+def find_fmt_batch(sizes, orient: bool = True):
+    """
+    Determine the page formats of many pages in one call, the same way as find_fmt().
+    Each distinct page size is looked up once.
+
+    :param sizes: numpy.ndarray or list
+        An array of shape (N, 2) or a list of (width, height) pairs.
+    :param orient: bool, optional
+        Determine the paper orientation (default is True).
+    :return: numpy.ndarray or list
+        Returns an object array of formats for an array input, or a list of formats otherwise.
+    """
+    if numpy is not None and isinstance(sizes, numpy.ndarray):
+        dims = numpy.asarray(sizes, dtype=numpy.float64).reshape(-1, 2)
+        if not len(dims):
+            return numpy.empty(0, dtype=object)
+        rounded = numpy.rint(dims)
+        if rounded.min() < 0 or rounded.max() > BATCH_SIZE_RANGE:
+            return numpy.array(find_fmt_batch(dims.tolist(), orient), dtype=object)
+        # Widths and heights as contiguous rows, each is counted on its own
+        rounded = numpy.ascontiguousarray(rounded.T, dtype=numpy.int32)
+        # Number the distinct widths and heights by counting, no sorting of the pages,
+        # then every page gets one small key of its width, height and orientation
+        codes, values = [], []
+        for col in rounded:
+            seen = numpy.bincount(col) > 0
+            codes.append((numpy.cumsum(seen, dtype=numpy.int32) - 1)[col])
+            values.append(numpy.flatnonzero(seen).tolist())
+        heights = len(values[1])
+        keys = codes[0] * (2 * heights)
+        keys += codes[1] * 2
+        keys += dims[:, 0] <= dims[:, 1]
+        labels = numpy.empty(len(values[0]) * heights * 2, dtype=object)
+        for key in numpy.flatnonzero(numpy.bincount(keys)).tolist():
+            width, height = values[0][key // 2 // heights], values[1][key // 2 % heights]
+            labels[key] = find_fmt_rounded(width, height, bool(key & 1), orient)
+        return labels[keys]
+
+    memo = {}
+    formats = []
+    for width, height in sizes:
+        key = (int(round(width, 0)), int(round(height, 0)), width <= height)
+        fmt = memo.get(key)
+        if fmt is None:
+            fmt = memo[key] = find_fmt_rounded(*key, orient)
+        formats.append(fmt)
+    return formats
+
+def bucket_pages_by_format(pages: list) -> dict:
+    """
+    Group PDF pages by their format in a single pass over the pages.
+
+    :param pages: list
+        A list (or any iterable) of PDF pages or PageRef objects.
+    :return: dict
+        Returns the dictionary where page format as the key and
+        the list of pages of that format as the value.
+    """
+    buckets = {}
+    for pg in pages:
+        fmt = find_fmt(*page_size(pg), False)
+        if fmt in buckets:
+            buckets[fmt].append(pg)
+        else:
+            buckets[fmt] = [pg]
+    return buckets
+
+def page_count_range(count: int) -> str:
+    """
+    The range of `PAGE_COUNT_RANGES` a document page count falls in, e.g. "2-10" or "1001+".
+
+    :param count: int
+        The number of pages.
+    :return: str
+        Returns the range as string value.
+    """
+    low = 1
+    for high in PAGE_COUNT_RANGES:
+        if count <= high:
+            return str(high) if low == high else f"{low}-{high}"
+        low = high + 1
+    return f"{low}+"
+
+class PageGrouping:
+    """
+    Groups pages into output files by a list of `GROUP_KEYS`, every page goes to
+    the group of its values of all the keys in one pass over the scans:
+    format (as find_fmt() without orientation), orientation (P or L),
+    folder (the top-level folder of the source file, "." for files at the top)
+    and pages (the page count range of the source file, see page_count_range()).
+    A group is named by a template of the keys, the values joined by "_" by default,
+    output files are named after the groups as after the formats, see fmt_filename().
+    """
+
+    def __init__(self, keys: tuple = ("format",), template: str = None, dirpath: str = None):
+        keys = tuple(keys)
+        unknown = [key for key in keys if key not in GROUP_KEYS]
+        if not keys or unknown or len(set(keys)) != len(keys):
+            raise ValueError(
+                f"group keys must be a list of distinct keys of: {', '.join(GROUP_KEYS)}"
+            )
+        self.keys = keys
+        self.template = template or "_".join("{%s}" % key for key in keys)
+        fields = [field for _, field, _, _ in string.Formatter().parse(self.template) if field is not None]
+        if not fields or any(field not in keys for field in fields):
+            raise ValueError(f"group name template may use only the grouped keys: {', '.join(keys)}")
+        self.dirpath = os.path.abspath(dirpath) if dirpath else None
+        self.labels = {}
+
+    def _folder(self, path: str) -> str:
+        rel = os.path.relpath(os.path.dirname(path), self.dirpath or input_dir)
+        return rel.split(os.sep)[0]
+
+    def bucket(self, scans, page_filter=None) -> dict:
+        """
+        Group the pages of scanned files.
+
+        :param scans: list
+            A list (or any iterable) of FileScan objects.
+        :param page_filter: callable, optional
+            Takes and returns an iterable of PageRef objects of one file,
+            to leave out pages before grouping, e.g. Deduplicator.pages().
+        :return: dict
+            Returns the dictionary where group name as the key and
+            the list of PageRef objects of that group as the value.
+        """
+        buckets = {}
+        labels = self.labels
+        by_format = self.keys == ("format",)
+        for scan in scans:
+            refs = scans_to_page_refs([scan])
+            if page_filter is not None:
+                refs = page_filter(refs)
+            # Values of a file are taken once, of a page through the find_fmt() memo
+            values = {}
+            if "folder" in self.keys:
+                values["folder"] = self._folder(scan.path)
+            if "pages" in self.keys:
+                values["pages"] = page_count_range(len(scan.boxes))
+            file_key = tuple(values.items())
+            for pg in refs:
+                fmt = find_fmt(pg.width, pg.height, False)
+                if by_format:
+                    label = fmt
+                else:
+                    key = (fmt, pg.width <= pg.height, file_key)
+                    label = labels.get(key)
+                    if label is None:
+                        values["format"] = fmt
+                        values["orientation"] = "P" if pg.width <= pg.height else "L"
+                        # Output files are kept in one directory
+                        label = labels[key] = self.template.format(**values).replace(os.sep, "-")
+                if label in buckets:
+                    buckets[label].append(pg)
+                else:
+                    buckets[label] = [pg]
+        return buckets
+
+def natural_key(text: str) -> tuple:
+    """
+    Sort key of the natural order: runs of digits compare as numbers and the rest
+    case-insensitively, so "scan2.pdf" goes before "scan10.pdf".
+
+    :param text: str
+        A string such as a file path.
+    :return: tuple
+        Returns the text parts, numbers at the odd positions.
+    """
+    return tuple(int(part) if i % 2 else part.casefold() for i, part in enumerate(re.split(r"(\d+)", text)))
+
+def _mtime_key(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+def page_order_key(order):
+    """
+    Get the sort key of source files for an order of output pages.
+
+    :param order: str or callable
+        One of `PAGE_ORDERS`: path, natural (see natural_key()) or mtime (modification time),
+        or a custom function taking a source file path and returning its sort key.
+    :return: callable
+        Returns the function taking a source file path and returning its sort key.
+    """
+    if callable(order):
+        return order
+    if order == "path":
+        return str
+    if order == "natural":
+        return natural_key
+    if order == "mtime":
+        return _mtime_key
+    raise ValueError(f"page order must be one of: {', '.join(PAGE_ORDERS)} or a function")
+
+def order_pages(buckets: dict, order) -> dict:
+    """
+    Put the pages of every output file in the order of their source files, whatever order
+    the files were scanned in. Pages of one source file come in a run in page order,
+    as bucket_pages_by_format() and PageGrouping.bucket() leave them, so a bucket is
+    a k-way merge of these runs with heapq.merge(), the pages are never sorted one by one.
+    The key of each source file is taken once, files of equal keys go in path order.
+
+    :param buckets: dict
+        A dictionary where group name as the key and the list of PageRef objects as the value.
+    :param order: str or callable
+        The order of the source files, see page_order_key().
+    :return: dict
+        Returns the dictionary of the same groups with their pages in order.
+    """
+    key = page_order_key(order)
+    keys = {}
+
+    def file_key(pg: PageRef) -> tuple:
+        if pg.path not in keys:
+            keys[pg.path] = (key(pg.path), pg.path)
+        return keys[pg.path]
+
+    ordered = {}
+    for name, pages in buckets.items():
+        runs = [list(run) for _, run in groupby(pages, key=lambda pg: pg.path)]
+        ordered[name] = list(heapq.merge(*runs, key=file_key))
+    return ordered
+
 def get_format_info(pages: list) -> dict:
     """
     Collect information of the total number of pages for each format into a dict.
 
     :param pages: list
-        A list of PDF pages.
+        A list (or any iterable) of PDF pages or PageRef objects.
     :return: dict
         Returns the dictionary where page format as the key and 
         their amount as the value.
     """
-    format_info = {}
-    for pg in pages:
-        fmt = find_fmt(pg.mediabox.width, pg.mediabox.height, False)
-        if fmt in format_info:
-            format_info[fmt] += 1
+    return {fmt: len(pgs) for fmt, pgs in bucket_pages_by_format(pages).items()}
+
+def draw_format_info_tab(format_info: dict, file=None):
+    """
+    Draws a table with pages formats and their amount from a given dictionary.
+
+    :param format_info: dict
+        A dictionary where page format as a key and their amount as a value.
+    :param file: file, optional
+        The stream to print to (default is stdout).
+    """
+    if format_info:
+        output = "{:>27} {:>9}\n{}  --------\n".format("Format", "Count", ("-" * 27))
+        for fmt, cnt in sorted(format_info.items()):
+            output += f"{fmt:>27} {cnt:>9}\n"
+        if file is None:
+            print(output.rstrip("\n"))
+        else:
+            print(output.rstrip("\n"), file=file)
+
+class FormatReport:
+    """
+    Report of page counts for each format in one of the `REPORT_FORMATS`.
+    Machine-readable formats carry a per-file breakdown, CSV and NDJSON records
+    are written as soon as each file is scanned, followed by the totals.
+    """
+
+    def __init__(self, output_format: str = "text", stream=None):
+        if output_format not in REPORT_FORMATS:
+            raise ValueError(f"Unknown report format: {output_format}")
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.files = []
+        self.format_info = {}
+        self.file_count = 0
+        self.pages = 0
+        self.parse_time = 0.0
+        self.csv = None
+        if output_format == "csv":
+            self.csv = csv.writer(self.stream, lineterminator="\n")
+            self.csv.writerow(["path", "pages", "parse_time", "format", "count"])
+
+    def feed(self, scans) -> Iterator[FileScan]:
+        """
+        Add file scans to the report while passing them through.
+
+        :param scans: list
+            A list (or any iterable) of FileScan objects.
+        :return: Iterator[FileScan]
+            Yields the scans received from `scans` param.
+        """
+        for scan in scans:
+            self.add(scan)
+            yield scan
+
+    def add(self, scan: FileScan):
+        """
+        Add one file scan to the report.
+
+        :param scan: FileScan
+            The scan result of one file.
+        """
+        for fmt, cnt in scan.formats.items():
+            self.format_info[fmt] = self.format_info.get(fmt, 0) + cnt
+        self.file_count += 1
+        self.pages += len(scan.boxes)
+        self.parse_time += scan.parse_time
+        if self.output_format == "text":
+            return
+        record = {
+            "type": "file",
+            "path": scan.path,
+            "pages": len(scan.boxes),
+            "formats": dict(sorted(scan.formats.items())),
+            "parse_time": round(scan.parse_time, 6),
+        }
+        if self.output_format == "json":
+            self.files.append(record)
+        elif self.output_format == "ndjson":
+            print(json.dumps(record, ensure_ascii=False), file=self.stream, flush=True)
+        else:
+            for fmt, cnt in record["formats"].items():
+                self.csv.writerow([scan.path, record["pages"], record["parse_time"], fmt, cnt])
+            self.stream.flush()
+
+    def finish(self, skipped: dict = None, duplicates: dict = None):
+        """
+        Write the totals (and the whole document for the text and JSON formats).
+
+        :param skipped: dict, optional
+            The files left out of the report, see Quarantine.skipped(),
+            the totals are marked as partial if there are any.
+        :param duplicates: dict, optional
+            The duplicate files and pages eliminated, see Deduplicator.eliminated().
+        """
+        skipped = skipped if skipped and skipped["files"] else None
+        if self.output_format == "text":
+            draw_format_info_tab(self.format_info, self.stream)
+            if skipped:
+                unknown = f", {skipped['unknown']} files of unknown length" if skipped["unknown"] else ""
+                print(
+                    f"Partial: {skipped['files']} files skipped, {skipped['pages']} pages{unknown}",
+                    file=self.stream,
+                )
+            if duplicates is not None:
+                print(format_duplicates(duplicates), file=self.stream)
+            return
+        total = {
+            "type": "total",
+            "files": self.file_count,
+            "pages": self.pages,
+            "formats": dict(sorted(self.format_info.items())),
+            "parse_time": round(self.parse_time, 6),
+        }
+        if skipped:
+            total["skipped"] = skipped
+        if duplicates is not None:
+            total["duplicates"] = duplicates
+        if self.output_format == "json":
+            json.dump({"files": self.files, "total": total}, self.stream, ensure_ascii=False, indent=2)
+            print(file=self.stream)
+        elif self.output_format == "ndjson":
+            print(json.dumps(total, ensure_ascii=False), file=self.stream, flush=True)
+        else:
+            for fmt, cnt in total["formats"].items():
+                self.csv.writerow(["*", total["pages"], total["parse_time"], fmt, cnt])
+            if skipped:
+                self.csv.writerow(["*", skipped["pages"], "", "skipped", skipped["files"]])
+            if duplicates is not None:
+                self.csv.writerow(["*", duplicates["pages"], "", "duplicates", duplicates["files"]])
+            self.stream.flush()
+
+def format_duplicates(duplicates: dict) -> str:
+    """The line of the text report about the duplicates eliminated, see Deduplicator.eliminated()."""
+    return (
+        f"Duplicates eliminated: {duplicates['files']} files, "
+        f"{duplicates['pages']} pages, {duplicates['bytes']} bytes"
+    )
+
+def mk_output_dir(dirpath: str):
+    """
+    Makes output directory if it doesn't exists.
+
+    :param dirpath: str
+        Output directory name with full path.
+    """
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+
+def write_pdf_file(
+    filename: str,
+    pages: list,
+    meta: dict,
+    use_mmap: bool = False,
+    optimize: int = 0,
+    stats: dict = None,
+) -> str:
+    """
+    Writes one output PDF file from the given pages.
+    Source files are opened only for the pages of this file, so it can run
+    in a separate worker process for every output file.
+
+    :param filename: str
+        Output PDF filename with full path.
+    :param pages: list
+        A list of PDF pages or PageRef objects.
+    :param meta: dict
+        Dictionary with metadata for the output PDF file.
+    :param use_mmap: bool, optional
+        Memory-map the source files instead of reading them into memory, see open_pdf().
+    :param optimize: int, optional
+        Merge identical objects (and recompress content streams) before writing,
+        see optimize_writer() (default is 0, off).
+    :param stats: dict, optional
+        Bytes saved by `optimize` are added to its "bytes_saved" key.
+    :return: str
+        Returns the output filename.
+    """
+    writer = PdfWriter()
+    pool = ReaderPool(use_mmap=use_mmap)
+    for pg in pages:
+        writer.add_page(pool.get_page(pg))
+    pool.close()
+
+    writer.add_metadata(meta)
+    if optimize:
+        saved = optimize_writer(writer, optimize)
+        if stats is not None:
+            stats["bytes_saved"] = stats.get("bytes_saved", 0) + saved
+
+    mk_output_dir(os.path.dirname(filename))
+
+    write_atomic(writer, filename)
+    writer.close()
+    return filename
+
+def write_atomic(writer: PdfWriter, filename: str):
+    """
+    Writes an output file under a temporary name and renames it once complete,
+    so an interrupted run never leaves a truncated file under the final name.
+
+    :param writer: PdfWriter
+        A writer with all pages added.
+    :param filename: str
+        Output PDF filename with full path.
+    """
+    tmp_name = filename + PARTIAL_SUFFIX
+    with open(tmp_name, "wb") as f:
+        writer.write(f)
+    os.replace(tmp_name, filename)
+
+def remove_partial_files(dirpath: str):
+    """
+    Removes the temporary files left in the output dir by an interrupted run, see write_atomic().
+
+    :param dirpath: str
+        Output directory name with full path.
+    """
+    if not os.path.isdir(dirpath):
+        return
+    for entry in os.scandir(dirpath):
+        if entry.is_file() and entry.name.endswith(PARTIAL_SUFFIX):
+            os.remove(entry.path)
+
+def _writer_objects(writer: PdfWriter) -> list:
+    """
+    The indirect objects of a writer by object number, pypdf has no public access to them.
+    Every use goes through here, so a pypdf without the object list fails in one place.
+    """
+    objects = getattr(writer, "_objects", None)
+    if not isinstance(objects, list):
+        raise RuntimeError(f"pypdf {pypdf_version} is not supported: PdfWriter has no object list")
+    return objects
+
+def _objects_bytes(objects) -> int:
+    """Size of PDF objects as they will be written to an output file."""
+    buf = io.BytesIO()
+    count = 0
+    for obj in objects:
+        if obj is not None:
+            obj.write_to_stream(buf, None)
+            count += 1
+    return buf.tell() + count * PDF_OBJ_OVERHEAD
+
+def _written_bytes(writer: PdfWriter) -> int:
+    """Size of the output file a writer makes as of now."""
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.tell()
+
+def _replace_refs(obj, remap: dict, writer: PdfWriter):
+    """Point the references to merged objects inside a direct object at the kept ones."""
+    if isinstance(obj, DictionaryObject):
+        items = list(obj.items())
+    elif isinstance(obj, ArrayObject):
+        items = list(enumerate(obj))
+    else:
+        return
+    for key, value in items:
+        if isinstance(value, IndirectObject):
+            if value.idnum in remap:
+                obj[key] = IndirectObject(remap[value.idnum], 0, writer)
         else:
-            format_info[fmt] = 1
-    return format_info
+            _replace_refs(value, remap, writer)
 
-def draw_format_info_tab(format_info: dict):
+def optimize_writer(writer: PdfWriter, level: int = OPTIMIZE_DEDUPE) -> int:
     """
-    Draws a table with pages formats and their amount from a given dictionary.
+    Shrinks an output file before it is written: objects with the same content
+    (fonts, images, form XObjects shared by pages from different source files)
+    are kept once and all references are pointed at the kept copy.
+    Merging repeats until nothing changes, as objects become identical
+    once the objects they refer to have been merged.
+    With pypdf 4.3 or newer this is done by PdfWriter.compress_identical_objects(),
+    which also drops objects no longer referenced. Older versions merge here,
+    pages and annotations are never merged and merged objects are left as nulls.
 
-    :param format_info: dict
-        A dictionary where page format as a key and their amount as a value.
+    :param writer: PdfWriter
+        A writer with all pages added.
+    :param level: int, optional
+        OPTIMIZE_DEDUPE or OPTIMIZE_COMPRESS to also recompress page content streams.
+    :return: int
+        Returns the number of bytes saved in the written file.
     """
-    if format_info:
-        output = "{:>27} {:>9}\n{}  --------\n".format("Format", "Count", ("-" * 27))
-        for fmt, cnt in sorted(format_info.items()):
-            output += f"{fmt:>27} {cnt:>9}\n"
-        print(output.rstrip("\n"))
+    before = _written_bytes(writer)
+    if level >= OPTIMIZE_COMPRESS:
+        for page in writer.pages:
+            page.compress_content_streams()
+    objects = _writer_objects(writer)
+    if hasattr(writer, "compress_identical_objects"):
+        while True:
+            count = sum(obj is not None for obj in objects)
+            writer.compress_identical_objects()
+            if sum(obj is not None for obj in objects) == count:
+                break
+        return before - _written_bytes(writer)
+    while True:
+        kept, remap = {}, {}
+        for idnum, obj in enumerate(objects, start=1):
+            if obj is None or isinstance(obj, NullObject):
+                continue
+            if isinstance(obj, DictionaryObject) and obj.get("/Type") in KEEP_OBJECT_TYPES:
+                continue
+            buf = io.BytesIO()
+            obj.write_to_stream(buf, None)
+            first = kept.setdefault(hashlib.sha256(buf.getvalue()).digest(), idnum)
+            if first != idnum:
+                remap[idnum] = first
+        if not remap:
+            break
+        for obj in objects:
+            _replace_refs(obj, remap, writer)
+        for idnum in remap:
+            # A null object keeps the numbering, which the writer relies on
+            objects[idnum - 1] = NullObject()
+    return before - _written_bytes(writer)
 
-def mk_output_dir(dirpath: str):
+def write_pdf_chunks(
+    filename: str,
+    pages: list,
+    meta: dict,
+    max_bytes: int,
+    limit: int = 0,
+    use_mmap: bool = False,
+    optimize: int = 0,
+    stats: dict = None,
+) -> list:
     """
-    Makes output directory if it doesn't exists.
+    Writes the pages into output PDF files of at most `max_bytes` bytes (and `limit` pages),
+    streaming: the pages go into one writer until the next page would exceed the limits,
+    then the chunk is flushed to disk and a new one is started, so only one chunk
+    is in memory at a time. The size of a chunk is counted from the objects
+    each page adds to the writer, the size of the next page is guessed from
+    the pages of the same source file seen before.
+    A written file which still turns out too large is split again in halves.
+    Files are named as by fmt_file_jobs(): `filename` if all pages fit in one file,
+    otherwise with an index added. With `optimize` the chunks are counted before
+    optimize_writer() runs, so they may end up smaller than `max_bytes` allows.
 
-    :param dirpath: str
-        Output directory name with full path.
+    :param filename: str
+        Output PDF filename with full path.
+    :param pages: list
+        A list of PDF pages or PageRef objects.
+    :param meta: dict
+        Dictionary with metadata for the output PDF files.
+    :param max_bytes: int
+        The maximum allowed size of one output file in bytes, a single page larger
+        than that is written to a file of its own.
+    :param limit: int, optional
+        The maximum allowed number of pages per one output file.
+    :param use_mmap: bool, optional
+        Memory-map the source files instead of reading them into memory, see open_pdf().
+    :param optimize: int, optional
+        Optimize every chunk before writing it, see optimize_writer().
+    :param stats: dict, optional
+        Bytes saved by `optimize` are added to its "bytes_saved" key.
+    :return: list
+        Returns the list of written filenames.
     """
-    if not os.path.exists(dirpath):
-        os.makedirs(dirpath)
+    root, ext = os.path.splitext(filename)
+    written = []
+    pool = ReaderPool(use_mmap=use_mmap)
+    # Size of a page of each source file: the first one in a chunk carries
+    # the resources shared with the next ones
+    first_bytes, next_bytes = {}, {}
+
+    def new_writer():
+        writer = PdfWriter()
+        return writer, _objects_bytes(_writer_objects(writer)), set()
+
+    def add_page(writer, sources, pg) -> int:
+        objects = _writer_objects(writer)
+        start = len(objects)
+        writer.add_page(pool.get_page(pg))
+        added = _objects_bytes(objects[start:])
+        if isinstance(pg, PageRef):
+            (next_bytes if pg.path in sources else first_bytes)[pg.path] = added
+            sources.add(pg.path)
+        return added
+
+    def guess_bytes(sources, pg) -> float:
+        if not isinstance(pg, PageRef):
+            return 0
+        if pg.path in sources and pg.path in next_bytes:
+            return next_bytes[pg.path]
+        if pg.path in first_bytes:
+            return first_bytes[pg.path]
+        pool.get_page(pg)
+        return pool.page_bytes(pg.path)
+
+    def flush(writer, chunk):
+        # The first file gets an index only when a second one follows
+        if written == [filename]:
+            written[0] = f"{root}-0{ext}"
+            os.replace(filename, written[0])
+        name = f"{root}-{len(written)}{ext}" if written else filename
+        writer.add_metadata(meta)
+        saved = optimize_writer(writer, optimize) if optimize else 0
+        mk_output_dir(os.path.dirname(name))
+        write_atomic(writer, name)
+        writer.close()
+        if len(chunk) > 1 and os.path.getsize(name) > max_bytes:
+            os.remove(name)
+            half = len(chunk) // 2
+            for part in (chunk[:half], chunk[half:]):
+                part_writer, _, part_sources = new_writer()
+                for pg in part:
+                    add_page(part_writer, part_sources, pg)
+                flush(part_writer, part)
+        else:
+            written.append(name)
+            if stats is not None and optimize:
+                stats["bytes_saved"] = stats.get("bytes_saved", 0) + saved
+
+    writer, size, sources = new_writer()
+    chunk = []
+    for pg in pages:
+        if chunk and (
+            limit > 0 and len(chunk) >= limit or size + guess_bytes(sources, pg) > max_bytes
+        ):
+            flush(writer, chunk)
+            (writer, size, sources), chunk = new_writer(), []
+        added = add_page(writer, sources, pg)
+        if chunk and size + added > max_bytes:
+            # The guess was too small, write the chunk without this page
+            writer.close()
+            writer, size, sources = new_writer()
+            for prev in chunk:
+                size += add_page(writer, sources, prev)
+            flush(writer, chunk)
+            (writer, size, sources), chunk = new_writer(), []
+            added = add_page(writer, sources, pg)
+        size += added
+        chunk.append(pg)
+    if chunk:
+        flush(writer, chunk)
+    pool.close()
+    return written
 
 def subwrite_limit_fmt_file(
     fmt: str, pages: list, start: int, stop: int, i: int, meta: dict
@@ -213,7 +2360,7 @@ def subwrite_limit_fmt_file(
     :param fmt: str
         A page format as string value.
     :param pages: list
-        A list of PDF pages.
+        A list of PDF pages or PageRef objects.
     :param start: int
         The starting index of the page list slice.
     :param stop: int
@@ -223,19 +2370,62 @@ def subwrite_limit_fmt_file(
     :param meta: dict
         Dictionary with metadata for the output PDF file.
     """
-    subwriter = PdfWriter()
-    for wpg in pages[start:stop]:
-        subwriter.add_page(wpg)
-
-    subwriter.add_metadata(meta)
-
-    mk_output_dir(output_dir)
     dirname = os.path.basename(input_dir)
 
     # Save the new PDF to a file with index
-    with open(os.path.join(output_dir, f"{dirname}_{fmt}_pdf-{i}.pdf"), "wb") as f:
-        subwriter.write(f)
-    subwriter.close()
+    write_pdf_file(
+        os.path.join(output_dir, f"{dirname}_{fmt}_pdf-{i}.pdf"), pages[start:stop], meta
+    )
+
+def fmt_filename(fmt: str, index: int = None, dirpath: str = None) -> str:
+    """
+    The name of an output file, as written by write_fmt_file() and subwrite_limit_fmt_file().
+
+    :param fmt: str
+        A page format as string value.
+    :param index: int, optional
+        The index of a file split by a limit.
+    :param dirpath: str, optional
+        The input directory (default is the one set by init_dirs()).
+    :return: str
+        Returns the output filename with full path.
+    """
+    if dirpath:
+        dirpath = os.path.abspath(dirpath)
+        out_dir = get_output_dir(dirpath)
+    else:
+        dirpath, out_dir = input_dir, output_dir
+    suffix = "" if index is None else f"-{index}"
+    return os.path.join(out_dir, f"{os.path.basename(dirpath)}_{fmt}_pdf{suffix}.pdf")
+
+def fmt_file_jobs(
+    fmt: str, pages: list, limit: int = 0, max_bytes: int = 0, dirpath: str = None
+) -> list:
+    """
+    Split the pages of one format into output files,
+    following the naming of write_fmt_file() and subwrite_limit_fmt_file().
+
+    :param fmt: str
+        A page format as string value.
+    :param pages: list
+        A list of PDF pages or PageRef objects of the `fmt` format.
+    :param limit: int, optional
+        The maximum allowed number of pages per one output file.
+    :param max_bytes: int, optional
+        The maximum allowed size of one output file, the pages are kept in one job then
+        and split while being written, see write_pdf_chunks().
+    :param dirpath: str, optional
+        The input directory (default is the one set by init_dirs()).
+    :return: list
+        Returns a list of (output filename, pages) tuples.
+    """
+    np: int = len(pages)
+    if limit > 0 and limit < np and max_bytes <= 0:
+        return [
+            (fmt_filename(fmt, i, dirpath), pages[start:start + limit])
+            for i, start in enumerate(range(0, np, limit))
+        ]
+    return [(fmt_filename(fmt, None, dirpath), pages)]
 
 def write_fmt_file(fmt: str, pages: list, limit: int = 0):
     """
@@ -246,41 +2436,1567 @@ def write_fmt_file(fmt: str, pages: list, limit: int = 0):
     :param fmt: str
         A page format as string value.
     :param pages: list
-        A list of PDF pages.
+        A list of PDF pages or PageRef objects of the `fmt` format,
+        see bucket_pages_by_format().
     :param limit: int, optional
         The maximum allowed number of pages per one output file.
     """
-    writer = PdfWriter()
-    for pg in pages:
-        if find_fmt(pg.mediabox.width, pg.mediabox.height, False) == fmt:
-            writer.add_page(pg)
-
-    metadata = {
-        "/Creator": "PDFSort",
-        "/Producer": "PDFSort",
-    }
+    metadata = OUTPUT_METADATA
 
-    if limit > 0 and limit < len(writer.pages):
-        np: int = len(writer.pages)
+    if limit > 0 and limit < len(pages):
+        np: int = len(pages)
         fnum: int = np // limit
         fnum = fnum if np % limit == 0 else fnum + 1
         start: int = 0
         stop: int = limit
         for i in range(fnum):
             subwrite_limit_fmt_file(
-                fmt, writer.pages, start, stop if stop <= np else np, i, metadata
+                fmt, pages, start, stop if stop <= np else np, i, metadata
             )
             start += limit
             stop += limit
     else:
-        writer.add_metadata(metadata)  # Add the metadata
-        mk_output_dir(output_dir)
         dirname = os.path.basename(input_dir)
 
         # Save the new PDF to a file
-        with open(os.path.join(output_dir, f"{dirname}_{fmt}_pdf.pdf"), "wb") as f:
-            writer.write(f)
-    writer.close()
+        write_pdf_file(os.path.join(output_dir, f"{dirname}_{fmt}_pdf.pdf"), pages, metadata)
+
+class OutputManifest:
+    """
+    Manifest of the output files kept as JSON in the output dir: for every output file
+    the source pages it contains and the size and modification time of their source files.
+    Lets write_fmt_files() write again only the output files whose pages have changed.
+    Every output file is also appended to a journal as soon as it is written,
+    so a run interrupted before save() can be resumed from the last finished file.
+    Without `persist` a run starts from scratch and keeps only the journal while in progress.
+    """
+
+    def __init__(self, path: str, persist: bool = True):
+        self.path = path
+        self.persist = persist
+        self.journal_path = os.path.join(os.path.dirname(path), JOURNAL_FILENAME)
+        self.journal = None
+        self.outputs = {}
+        self.source_stats = {}
+        if not persist:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            return
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.outputs = data["outputs"]
+        self._replay()
+
+    def _replay(self):
+        """Apply the records of an interrupted run from the journal."""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may be cut off by the interruption
+                    break
+                if record["entry"] is None:
+                    self.outputs.pop(record["file"], None)
+                else:
+                    self.outputs[record["file"]] = record["entry"]
+
+    def _journal(self, key: str, entry):
+        if self.journal is None:
+            mk_output_dir(os.path.dirname(self.journal_path))
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+        self.journal.write(json.dumps({"file": key, "entry": entry}, ensure_ascii=False) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def _key(self, filename: str) -> str:
+        return os.path.relpath(filename, os.path.dirname(self.path))
+
+    def _source_stat(self, path: str) -> list:
+        if path not in self.source_stats:
+            try:
+                st = os.stat(path)
+                self.source_stats[path] = [st.st_size, st.st_mtime_ns]
+            except OSError:
+                self.source_stats[path] = None
+        return self.source_stats[path]
+
+    def entry(self, pages: list, split: dict = None) -> dict:
+        """
+        Describe the content of an output file.
+
+        :param pages: list
+            A list of PageRef objects.
+        :param split: dict, optional
+            The limits the pages were split into several files with, see write_pdf_chunks().
+        :return: dict
+            Returns the source pages and the stats of their source files.
+        """
+        entry = {
+            "pages": [[pg.path, pg.index] for pg in pages],
+            "sources": {path: self._source_stat(path) for path in sorted({pg.path for pg in pages})},
+        }
+        if split:
+            entry["split"] = split
+        return entry
+
+    def files(self, filename: str) -> list:
+        """
+        The files actually written for an output file: the file itself
+        or the chunks it was split into.
+
+        :param filename: str
+            Output PDF filename with full path.
+        :return: list
+            Returns a list of filenames with full paths.
+        """
+        entry = self.outputs.get(self._key(filename), {})
+        return [
+            os.path.join(os.path.dirname(self.path), key)
+            for key in entry.get("files", [self._key(filename)])
+        ]
+
+    def is_current(self, filename: str, pages: list, split: dict = None) -> bool:
+        """
+        Check that an output file exists and holds the same, unchanged source pages.
+
+        :param filename: str
+            Output PDF filename with full path.
+        :param pages: list
+            A list of PageRef objects the file is to contain.
+        :param split: dict, optional
+            The limits the pages are split into several files with.
+        :return: bool
+            Returns True if the file doesn't need to be written again.
+        """
+        entry = dict(self.outputs.get(self._key(filename), {}))
+        entry.pop("files", None)
+        return (
+            entry == self.entry(pages, split)
+            and all(os.path.exists(name) for name in self.files(filename))
+        )
+
+    def record(self, filename: str, pages: list, split: dict = None, files: list = None):
+        """
+        Record a written output file. Chunks of its previous record which
+        were not written again this time are removed.
+
+        :param filename: str
+            Output PDF filename with full path.
+        :param pages: list
+            A list of PageRef objects the file contains.
+        :param split: dict, optional
+            The limits the pages were split into several files with.
+        :param files: list, optional
+            The chunks the pages were written to instead of `filename`.
+        """
+        entry = self.entry(pages, split)
+        if files is not None:
+            entry["files"] = [self._key(name) for name in files]
+        old = self.files(filename) if self._key(filename) in self.outputs else []
+        self.outputs[self._key(filename)] = entry
+        self._journal(self._key(filename), entry)
+        written = set(self.files(filename))
+        for name in old:
+            if name not in written and os.path.exists(name):
+                os.remove(name)
+
+    def stale_outputs(self, filenames) -> list:
+        """
+        Find recorded output files which are not among the given ones.
+
+        :param filenames: set
+            Output PDF filenames with full paths of the current run.
+        :return: list
+            Returns a list of output filenames with full paths.
+        """
+        current = {self._key(filename) for filename in filenames}
+        return [
+            os.path.join(os.path.dirname(self.path), key)
+            for key in sorted(self.outputs)
+            if key not in current
+        ]
+
+    def remove_stale(self, filenames):
+        """
+        Remove the recorded output files which are not among the given ones,
+        except the files the given ones were written to. Called once the run
+        has written its files, so a file is never removed before it is replaced.
+
+        :param filenames: set
+            Output PDF filenames with full paths of the current run.
+        """
+        keep = set(filenames)
+        for filename in filenames:
+            if self._key(filename) in self.outputs:
+                keep.update(self.files(filename))
+        for filename in self.stale_outputs(filenames):
+            self.remove(filename, keep)
+
+    def remove(self, filename: str, keep: set = frozenset()):
+        """
+        Remove an output file (or all its chunks) and its record.
+
+        :param filename: str
+            Output PDF filename with full path.
+        :param keep: set, optional
+            Filenames with full paths not to remove, already written again under another record.
+        """
+        for name in self.files(filename):
+            if name not in keep and os.path.exists(name):
+                os.remove(name)
+        if self.outputs.pop(self._key(filename), None) is not None:
+            self._journal(self._key(filename), None)
+
+    def save(self):
+        """Write the manifest to the output dir (if persisted) and clear the journal, the run is complete."""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.persist:
+            mk_output_dir(os.path.dirname(self.path))
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": MANIFEST_VERSION, "outputs": self.outputs}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+def write_output_file(
+    filename: str,
+    pages: list,
+    meta: dict,
+    max_bytes: int = 0,
+    limit: int = 0,
+    use_mmap: bool = False,
+    optimize: int = 0,
+) -> tuple:
+    """
+    Writes one job of fmt_file_jobs(): a single output file, or with `max_bytes`
+    the chunks of write_pdf_chunks().
+
+    :param filename: str
+        Output PDF filename with full path.
+    :param pages: list
+        A list of PDF pages or PageRef objects.
+    :param meta: dict
+        Dictionary with metadata for the output PDF files.
+    :param max_bytes: int, optional
+        The maximum allowed size of one output file in bytes.
+    :param limit: int, optional
+        The maximum allowed number of pages per one output file, used with `max_bytes` only.
+    :param use_mmap: bool, optional
+        Memory-map the source files instead of reading them into memory, see open_pdf().
+    :param optimize: int, optional
+        Optimize the output files, see optimize_writer().
+    :return: tuple
+        Returns the list of written filenames, the number of bytes saved by `optimize`
+        and the time taken in seconds.
+    """
+    start = time.perf_counter()
+    stats = {"bytes_saved": 0}
+    if max_bytes > 0:
+        files = write_pdf_chunks(filename, pages, meta, max_bytes, limit, use_mmap, optimize, stats)
+    else:
+        files = [write_pdf_file(filename, pages, meta, use_mmap, optimize, stats)]
+    return files, stats["bytes_saved"], time.perf_counter() - start
+
+def write_fmt_files(
+    buckets: dict,
+    limit: int = 0,
+    jobs: int = 1,
+    manifest=None,
+    use_mmap: bool = False,
+    max_bytes: int = 0,
+    optimize: int = 0,
+    stats: dict = None,
+    dirpath: str = None,
+) -> list:
+    """
+    Writes the output PDF files of all formats, every output file
+    (and every `limit` chunk) is written by its own job in a pool of worker processes.
+    The files are the same as written one by one with write_fmt_file().
+    With `max_bytes` every format is one job which splits its pages into files
+    while writing them, see write_pdf_chunks().
+
+    :param buckets: dict
+        A dictionary where page format as the key and the list of
+        PDF pages or PageRef objects as the value, see bucket_pages_by_format().
+    :param limit: int, optional
+        The maximum allowed number of pages per one output file.
+    :param jobs: int, optional
+        The number of worker processes (default is 1, write in the current process).
+    :param manifest: OutputManifest, optional
+        Write incrementally: only output files whose source pages have changed are written,
+        output files which are no longer produced are removed. Pages must be PageRef objects.
+    :param use_mmap: bool, optional
+        Memory-map the source files instead of reading them into memory, see open_pdf().
+    :param max_bytes: int, optional
+        The maximum allowed size of one output file in bytes.
+    :param optimize: int, optional
+        Optimize the output files, see optimize_writer().
+    :param stats: dict, optional
+        Bytes saved by `optimize` are added to its "bytes_saved" key,
+        (filename, written files, seconds) of every output file to its "writes" key.
+    :param dirpath: str, optional
+        The input directory the output files are named after (default is the one set by init_dirs()).
+    :return: list
+        Returns the list of written filenames.
+    """
+    metadata = OUTPUT_METADATA
+    split = {"max_bytes": max_bytes, "limit": limit} if max_bytes > 0 else None
+    file_jobs = [
+        job
+        for fmt, pages in buckets.items()
+        for job in fmt_file_jobs(fmt, pages, limit, max_bytes, dirpath)
+    ]
+    outputs = {filename for filename, _ in file_jobs}
+    if manifest is not None:
+        # Files are replaced as they are written, old ones are only removed once done
+        file_jobs = [job for job in file_jobs if not manifest.is_current(*job, split)]
+    if not file_jobs:
+        if manifest is not None:
+            manifest.remove_stale(outputs)
+            manifest.save()
+        return []
+    # Create the output dirs up front, workers would race for them otherwise
+    for out_dir in sorted({os.path.dirname(filename) for filename, _ in file_jobs}):
+        mk_output_dir(out_dir)
+
+    def finished(job, result):
+        # Journaled at once, an interrupted run keeps every finished file
+        if manifest is not None:
+            filename, pages = job
+            manifest.record(filename, pages, split, result[0] if split else None)
+        return result
+
+    if jobs > 1 and len(file_jobs) > 1:
+        # Start the largest files first to keep all workers busy till the end
+        file_jobs.sort(key=lambda job: len(job[1]), reverse=True)
+        with ProcessPoolExecutor(max_workers=min(jobs, len(file_jobs))) as executor:
+            futures = {
+                executor.submit(
+                    write_output_file,
+                    filename, pages, metadata, max_bytes, limit, use_mmap, optimize,
+                ): i
+                for i, (filename, pages) in enumerate(file_jobs)
+            }
+            results = [None] * len(file_jobs)
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = finished(file_jobs[i], future.result())
+    else:
+        results = [
+            finished(job, write_output_file(*job, metadata, max_bytes, limit, use_mmap, optimize))
+            for job in file_jobs
+        ]
+    job_files = [files for files, _, _ in results]
+    if stats is not None:
+        stats["bytes_saved"] = stats.get("bytes_saved", 0) + sum(saved for _, saved, _ in results)
+        stats.setdefault("writes", []).extend(
+            (filename, files, seconds) for (filename, _), (files, _, seconds) in zip(file_jobs, results)
+        )
+
+    if manifest is not None:
+        manifest.remove_stale(outputs)
+        manifest.save()
+    return [name for files in job_files for name in files]
+
+class OutputPlan:
+    """
+    Dry run of a write (--plan): the output files which would be written with
+    their page counts and sizes, the free space of the disk and the time the write
+    would take. The size of a page is estimated as its share of the source file,
+    as by ReaderPool.page_bytes(), from the page counts of the scans, so only
+    the page boxes are read. The time is estimated from the throughput of
+    a small sample of pages written to memory, the only pages parsed in full.
+    """
+
+    def __init__(self, sample_pages: int = PLAN_SAMPLE_PAGES):
+        self.sample_pages = sample_pages
+        self.page_counts = {}
+        self.sizes = {}
+
+    def feed(self, scans) -> Iterator[FileScan]:
+        """
+        Add file scans to the plan while passing them through.
+
+        :param scans: list
+            A list (or any iterable) of FileScan objects.
+        :return: Iterator[FileScan]
+            Yields the scans received from `scans` param.
+        """
+        for scan in scans:
+            self.add(scan)
+            yield scan
+
+    def add(self, scan: FileScan):
+        """
+        Add the page count of one scanned file.
+
+        :param scan: FileScan
+            The scan result of one file.
+        """
+        self.page_counts[scan.path] = len(scan.boxes)
+
+    def page_bytes(self, path: str) -> float:
+        """
+        Estimated size of a page of a source file.
+
+        :param path: str
+            A scanned PDF filename with full path.
+        :return: float
+            Returns the file size divided by its number of pages.
+        """
+        size = self.sizes.get(path)
+        if size is None:
+            try:
+                size = os.path.getsize(path) / max(1, self.page_counts.get(path, 1))
+            except OSError:
+                size = 0.0
+            self.sizes[path] = size
+        return size
+
+    def _chunks(self, filename: str, pages: list, max_bytes: int, limit: int) -> list:
+        """Split a job into output files as write_pdf_chunks() would, by the estimated page sizes."""
+        chunks, chunk, chunk_bytes = [], [], 0.0
+        for pg in pages:
+            size = self.page_bytes(pg.path)
+            if chunk and (chunk_bytes + size > max_bytes or 0 < limit <= len(chunk)):
+                chunks.append((chunk, chunk_bytes))
+                chunk, chunk_bytes = [], 0.0
+            chunk.append(pg)
+            chunk_bytes += size
+        chunks.append((chunk, chunk_bytes))
+        if len(chunks) == 1:
+            return [(filename, len(pages), chunk_bytes)]
+        root, ext = os.path.splitext(filename)
+        return [(f"{root}-{i}{ext}", len(part), size) for i, (part, size) in enumerate(chunks)]
+
+    def sample(self, pages: list, use_mmap: bool = False, optimize: int = 0) -> dict:
+        """
+        Write pages to memory and measure the throughput.
+
+        :param pages: list
+            A list of PageRef objects, the first `sample_pages` of them are written.
+        :param use_mmap: bool, optional
+            Memory-map the source files, see open_pdf().
+        :param optimize: int, optional
+            Optimize the sample as an output file, see optimize_writer().
+        :return: dict
+            Returns the number of pages, their estimated and written bytes and the time taken in seconds.
+        """
+        pages = pages[:self.sample_pages]
+        start = time.perf_counter()
+        writer = PdfWriter()
+        pool = ReaderPool(use_mmap=use_mmap)
+        for pg in pages:
+            writer.add_page(pool.get_page(pg))
+        writer.add_metadata(OUTPUT_METADATA)
+        if optimize:
+            optimize_writer(writer, optimize)
+        buf = io.BytesIO()
+        writer.write(buf)
+        writer.close()
+        pool.close()
+        return {
+            "pages": len(pages),
+            "estimated_bytes": round(sum(self.page_bytes(pg.path) for pg in pages)),
+            "bytes": buf.tell(),
+            "seconds": round(time.perf_counter() - start, 6),
+        }
+
+    def plan(
+        self,
+        buckets: dict,
+        limit: int = 0,
+        max_bytes: int = 0,
+        jobs: int = 1,
+        use_mmap: bool = False,
+        optimize: int = 0,
+        dirpath: str = None,
+    ) -> dict:
+        """
+        Plan the write of the output files, see write_fmt_files() for the params.
+
+        :param buckets: dict
+            A dictionary where page format as the key and the list of PageRef objects
+            as the value, see bucket_pages_by_format().
+        :return: dict
+            Returns the output files with their page counts and estimated bytes, the totals,
+            the free bytes of the disk, the estimated write time in seconds and the sample measured.
+        """
+        outputs = []
+        for fmt, pages in buckets.items():
+            for filename, job_pages in fmt_file_jobs(fmt, pages, limit, max_bytes, dirpath):
+                if max_bytes > 0:
+                    chunks = self._chunks(filename, job_pages, max_bytes, limit)
+                else:
+                    chunks = [(filename, len(job_pages), sum(self.page_bytes(pg.path) for pg in job_pages))]
+                outputs.extend(
+                    {"file": name, "pages": count, "bytes": round(size)} for name, count, size in chunks
+                )
+        total_bytes = sum(output["bytes"] for output in outputs)
+        plan = {
+            "outputs": outputs,
+            "files": len(outputs),
+            "pages": sum(output["pages"] for output in outputs),
+            "bytes": total_bytes,
+            "free_bytes": shutil.disk_usage(dirpath or input_dir).free,
+            "seconds": 0.0,
+            "sample": None,
+        }
+        if outputs:
+            # Pages of the largest group stand for the rest
+            sample = self.sample(max(buckets.values(), key=len), use_mmap, optimize)
+            if sample["seconds"] > 0 and sample["estimated_bytes"] > 0:
+                rate = sample["estimated_bytes"] / sample["seconds"]
+                plan["seconds"] = round(total_bytes / rate / min(max(1, jobs), len(outputs)), 3)
+            plan["sample"] = sample
+        return plan
+
+def print_plan(plan: dict, output_format: str = "text", stream=None):
+    """
+    Prints a write plan of OutputPlan.plan() in one of the `REPORT_FORMATS`.
+
+    :param plan: dict
+        The write plan.
+    :param output_format: str, optional
+        Text draws a table of the output files followed by the totals,
+        CSV and NDJSON have a record of every output file and then of the totals.
+    :param stream: file, optional
+        The stream to print to (default is stdout).
+    """
+    stream = stream or sys.stdout
+    total = {key: value for key, value in plan.items() if key != "outputs"}
+    if output_format == "json":
+        json.dump(plan, stream, ensure_ascii=False, indent=2)
+        print(file=stream)
+    elif output_format == "ndjson":
+        for output in plan["outputs"]:
+            print(json.dumps(dict(type="file", **output), ensure_ascii=False), file=stream)
+        print(json.dumps(dict(type="total", **total), ensure_ascii=False), file=stream)
+    elif output_format == "csv":
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(["file", "pages", "bytes"])
+        for output in plan["outputs"]:
+            writer.writerow([output["file"], output["pages"], output["bytes"]])
+        writer.writerow(["*", plan["pages"], plan["bytes"]])
+    else:
+        if plan["outputs"]:
+            output = "{:<40} {:>9} {:>14}\n{}  {}  {}\n".format(
+                "Output file", "Pages", "Bytes", "-" * 40, "-" * 8, "-" * 13
+            )
+            for item in plan["outputs"]:
+                output += f"{os.path.basename(item['file']):<40} {item['pages']:>9} {item['bytes']:>14}\n"
+            print(output.rstrip("\n"), file=stream)
+        print(
+            f"Plan: {plan['files']} files, {plan['pages']} pages, ~{plan['bytes']} bytes "
+            f"({plan['free_bytes']} bytes free), ~{plan['seconds']:.1f}s to write",
+            file=stream,
+        )
+        if plan["bytes"] > plan["free_bytes"]:
+            print("Warning: the output files would not fit in the free disk space", file=stream)
+    stream.flush()
+
+class StageStats:
+    """Throughput and input queue depth of one stage of run_pipeline()."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self.max_depth = 0
+        self.depth_sum = 0
+
+    async def get(self, queue: asyncio.Queue):
+        """Take the next item from the input queue, sampling its depth."""
+        depth = queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_sum += depth
+        item = await queue.get()
+        if self.started is None:
+            self.started = time.perf_counter()
+        return item
+
+    def done(self, seconds: float):
+        """Count one item processed in `seconds`."""
+        self.items += 1
+        self.busy += seconds
+        self.finished = time.perf_counter()
+
+    def track(self, future):
+        """Count one item processed in an executor by _timed_call() once its `future` is done."""
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                self.done(future.result()[1])
+        future.add_done_callback(done)
+
+    def as_dict(self) -> dict:
+        """
+        The stage metrics.
+
+        :return: dict
+            Returns the number of items, the time spent on them (items processed
+            at once in an executor add up) and the elapsed time in seconds,
+            items per second over the elapsed time, the maximum and mean input queue depth.
+        """
+        elapsed = (self.finished - self.started) if self.items else 0.0
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "busy": round(self.busy, 6),
+            "elapsed": round(elapsed, 6),
+            "throughput": round(self.items / elapsed, 3) if elapsed > 0 else None,
+            "max_queue": self.max_depth,
+            "mean_queue": round(self.depth_sum / (self.items + 1), 3),
+        }
+
+_PIPELINE_DONE = object()  # end of stream marker passed down the queues
+
+def _timed_call(func, *args) -> tuple:
+    """Call a function in an executor of run_pipeline(), returning its result and run time."""
+    start = time.perf_counter()
+    return func(*args), time.perf_counter() - start
+
+def _done_future(loop, result):
+    future = loop.create_future()
+    future.set_result((result, 0.0))
+    return future
+
+def _readahead(file_path: str):
+    """Ask the OS to start reading a file before run_pipeline() parses it, where it's supported."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return  # reported by the parser
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+async def _pipeline_discover(loop, executor, file_paths, out_q, paths: list):
+    # The directory walk blocks, it runs in a thread one step at a time
+    it = iter(file_paths)
+    while True:
+        path = await loop.run_in_executor(executor, next, it, _PIPELINE_DONE)
+        if path is _PIPELINE_DONE:
+            break
+        paths.append(path)
+        await out_q.put(path)
+    await out_q.put(_PIPELINE_DONE)
+
+async def _pipeline_prefetch(loop, executor, in_q, out_q, cache, stats: StageStats):
+    while True:
+        path = await stats.get(in_q)
+        if path is _PIPELINE_DONE:
+            break
+        start = time.perf_counter()
+        # The lookup stats the file and may hash it, it must not hold up the loop
+        scan = await loop.run_in_executor(executor, cache.get, path) if cache is not None else None
+        if scan is not None:
+            pending = None
+            stats.done(time.perf_counter() - start)
+        else:
+            # Reads go ahead while the next stages are busy, up to the queue size
+            pending = loop.run_in_executor(executor, _timed_call, _readahead, path)
+            stats.track(pending)
+        await out_q.put((path, scan, pending))
+    await out_q.put(_PIPELINE_DONE)
+
+async def _pipeline_parse(loop, executor, in_q, out_q, scanner, use_mmap: bool, stats: StageStats):
+    while True:
+        item = await stats.get(in_q)
+        if item is _PIPELINE_DONE:
+            break
+        path, scan, pending = item
+        if scan is not None:
+            parsed = _done_future(loop, scan)
+            stats.done(0.0)
+        else:
+            await pending
+            # Workers open the file themselves, only the path and the scan cross the process boundary
+            if scanner is not None:
+                parsed = loop.run_in_executor(executor, _timed_call, scanner.scan, path)
+            else:
+                parsed = loop.run_in_executor(
+                    executor, _timed_call, scan_pdf_file, path, False, use_mmap
+                )
+            stats.track(parsed)
+        await out_q.put((scan is not None, parsed))
+    await out_q.put(_PIPELINE_DONE)
+
+async def _pipeline_classify(
+    loop, executor, in_q, out_q, cache, sinks: list, buckets, options: tuple, stats: StageStats
+):
+    limit, max_bytes, quarantine, dirpath, deduper, grouping, order = options
+    # The order of the output pages is known only when every file is scanned
+    early = limit > 0 and max_bytes <= 0 and order is None
+    emitted = {}  # output files of each format sent to the writer before the end
+    while True:
+        item = await stats.get(in_q)
+        if item is _PIPELINE_DONE:
+            break
+        cached, parsed = item
+        scan, _ = await parsed
+        start = time.perf_counter()
+        if not cached:
+            scan = scan._replace(formats=count_formats(scan.boxes))
+            if cache is not None:
+                cache.put(scan)
+        jobs = []
+        for scan in _skip_failed_scans([scan], quarantine):
+            for sink in sinks:
+                sink.add(scan)
+            if buckets is None:
+                continue
+            if deduper is not None and deduper.level >= DEDUPE_PAGES:
+                # Page fingerprints parse the page content, that runs off the loop
+                grouped = await loop.run_in_executor(executor, grouping.bucket, [scan], deduper.pages)
+            else:
+                grouped = grouping.bucket([scan])
+            for fmt, pages in grouped.items():
+                bucket = buckets.setdefault(fmt, [])
+                bucket.extend(pages)
+                # A `limit` chunk is final once the next chunk has started,
+                # only then the indexed names of fmt_file_jobs() are certain
+                while early and len(bucket) > (emitted.get(fmt, 0) + 1) * limit:
+                    i = emitted.get(fmt, 0)
+                    jobs.append((fmt_filename(fmt, i, dirpath), bucket[i * limit:(i + 1) * limit]))
+                    emitted[fmt] = i + 1
+        stats.done(time.perf_counter() - start)
+        for job in jobs:
+            await out_q.put(job)
+    if buckets and order is not None:
+        buckets.update(order_pages(buckets, order))
+    for fmt, pages in (buckets or {}).items():
+        for job in fmt_file_jobs(fmt, pages, limit, max_bytes, dirpath)[emitted.get(fmt, 0):]:
+            await out_q.put(job)
+    await out_q.put(_PIPELINE_DONE)
+
+def _journal_write(manifest, job: tuple, split, future):
+    """Record an output file of run_pipeline() in the manifest as soon as it is written."""
+    if not future.cancelled() and future.exception() is None:
+        filename, pages = job
+        (files, _, _), _ = future.result()
+        manifest.record(filename, pages, split, files if split else None)
+
+async def _pipeline_write(
+    loop, executor, in_q, manifest, options: tuple, results: list, stats: StageStats
+):
+    max_bytes, limit, use_mmap, optimize = options
+    split = {"max_bytes": max_bytes, "limit": limit} if max_bytes > 0 else None
+    pending = []
+    while True:
+        job = await stats.get(in_q)
+        if job is _PIPELINE_DONE:
+            break
+        filename, pages = job
+        if manifest is not None and manifest.is_current(filename, pages, split):
+            continue
+        mk_output_dir(os.path.dirname(filename))
+        future = loop.run_in_executor(
+            executor, _timed_call, write_output_file,
+            filename, pages, OUTPUT_METADATA, max_bytes, limit, use_mmap, optimize,
+        )
+        stats.track(future)
+        if manifest is not None:
+            future.add_done_callback(lambda future, job=job: _journal_write(manifest, job, split, future))
+        pending.append((job, future))
+    for job, future in pending:
+        result, _ = await future
+        results.append((job, result))
+
+def run_pipeline(
+    file_paths,
+    jobs: int = 1,
+    cache=None,
+    report=None,
+    write: bool = False,
+    limit: int = 0,
+    manifest=None,
+    use_mmap: bool = False,
+    max_bytes: int = 0,
+    optimize: int = 0,
+    profile=None,
+    quarantine=None,
+    scanner=None,
+    dirpath: str = None,
+    deduper=None,
+    grouping=None,
+    order=None,
+) -> dict:
+    """
+    Scans (and writes) a stream of PDF files as a pipeline of stages running at once:
+    discover files, prefetch file content, parse, classify, write output files.
+    Stages are connected by bounded queues, so a slow stage holds back the ones before it.
+    A pool of threads asks the OS to read the files ahead of the parser, which hides the read
+    latency of network storage, parsing and writing run in a pool of `jobs` processes.
+    With a page `limit` an output file is written as soon as its pages are known,
+    while the rest of the files are still being parsed.
+    The results are the same as of scan_pdf_files() followed by write_fmt_files().
+
+    :param file_paths: list
+        A list (or any iterable) of PDF filenames with full paths.
+    :param jobs: int, optional
+        The number of worker processes (default is 1, parse and write in a thread).
+    :param cache: ScanCache, optional
+        A persistent scan index, only new or changed files are read and parsed when given.
+    :param report: FormatReport, optional
+        A report to add the scans to.
+    :param write: bool, optional
+        Write the output files, see write_fmt_files().
+    :param limit: int, optional
+        The maximum allowed number of pages per one output file.
+    :param manifest: OutputManifest, optional
+        Write only output files whose source pages have changed.
+    :param use_mmap: bool, optional
+        Memory-map the files instead of reading them into memory, see open_pdf().
+    :param max_bytes: int, optional
+        The maximum allowed size of one output file in bytes.
+    :param optimize: int, optional
+        Optimize the output files, see optimize_writer().
+    :param profile: RunProfile, optional
+        A profile to add the scans, the written files and the busy time of every stage to.
+    :param quarantine: Quarantine, optional
+        Records the files which can't be read instead of only reporting them.
+    :param scanner: IsolatedScanner, optional
+        Parses every file in an isolated worker process under its time and memory limits,
+        `jobs` files at once.
+    :param dirpath: str, optional
+        The input directory the output files are named after (default is the one set by init_dirs()).
+    :param deduper: Deduplicator, optional
+        Drops duplicate pages before they are written. Duplicate files are dropped
+        by passing `file_paths` through it.
+    :param grouping: PageGrouping, optional
+        Groups the pages into output files (default is by format).
+    :param order: str or callable, optional
+        The order of the pages in output files by their source files, see order_pages()
+        (default is the order of `file_paths`). Output files are then written once
+        all the files are parsed.
+    :return: dict
+        Returns the written filenames, the bytes saved by `optimize`
+        and the metrics of every stage, see StageStats.
+    """
+    stages = [StageStats(name) for name in ("prefetch", "parse", "classify", "write")]
+    paths, results = [], []
+    buckets = {} if write else None
+    loop = asyncio.new_event_loop()
+    # Discovery, index lookups and page dedupe take a thread each beside the reads
+    io_pool = ThreadPoolExecutor(max_workers=PREFETCH_THREADS + 3)
+    cpu_pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else ThreadPoolExecutor(max_workers=1)
+    # Threads only wait on the isolated workers of the scanner
+    scan_pool = ThreadPoolExecutor(max_workers=jobs) if scanner is not None else cpu_pool
+    tasks = []
+
+    async def run_stages():
+        # Queues are made inside the loop, before Python 3.10 they bind to the current loop
+        queues = [asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in stages]
+        tasks.extend(
+            loop.create_task(coro)
+            for coro in (
+                _pipeline_discover(loop, io_pool, file_paths, queues[0], paths),
+                _pipeline_prefetch(loop, io_pool, queues[0], queues[1], cache, stages[0]),
+                _pipeline_parse(loop, scan_pool, queues[1], queues[2], scanner, use_mmap, stages[1]),
+                _pipeline_classify(
+                    loop, io_pool, queues[2], queues[3], cache, [sink for sink in (report, profile, deduper) if sink],
+                    buckets,
+                    (limit, max_bytes, quarantine, dirpath, deduper, grouping or PageGrouping(dirpath=dirpath), order),
+                    stages[2],
+                ),
+                _pipeline_write(
+                    loop, cpu_pool, queues[3], manifest,
+                    (max_bytes, limit, use_mmap, optimize), results, stages[3],
+                ),
+            )
+        )
+        await asyncio.gather(*tasks)
+
+    try:
+        try:
+            loop.run_until_complete(run_stages())
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            raise
+    finally:
+        loop.close()
+        io_pool.shutdown()
+        cpu_pool.shutdown()
+        scan_pool.shutdown()
+
+    if cache is not None:
+        cache.evict(paths)
+    summary = {"pipeline": [stage.as_dict() for stage in stages]}
+    if profile is not None:
+        for stage in stages:
+            profile.stages[stage.name] = profile.stages.get(stage.name, 0.0) + stage.busy
+        for (filename, _), (files, _, seconds) in results:
+            profile.add_write(filename, files, seconds)
+    if write:
+        if manifest is not None:
+            outputs = {
+                filename
+                for fmt, pages in buckets.items()
+                for filename, _ in fmt_file_jobs(fmt, pages, limit, max_bytes, dirpath)
+            }
+            manifest.remove_stale(outputs)
+            manifest.save()
+        summary["written"] = [name for _, (files, _, _) in results for name in files]
+        summary["bytes_saved"] = sum(saved for _, (_, saved, _) in results)
+    return summary
+
+class RunProfile:
+    """
+    Timings and counters of one sort_tree() run for the --profile report:
+    the time of each stage (excluding the stages nested in it), the parse time
+    of every input file, the write time of every output file, page, byte, index
+    and format memo counters, optionally a cProfile and a tracemalloc capture.
+    The captures cover the current process only, not the worker processes.
+    """
+
+    def __init__(self, top: int = PROFILE_TOP, cprofile_path: str = None, trace_malloc: bool = False):
+        self.top = top
+        self.cprofile_path = cprofile_path
+        self.trace_malloc = trace_malloc
+        self.stages = OrderedDict()
+        self.parse_times = {}
+        self.write_times = {}
+        self.counters = OrderedDict(
+            (name, 0)
+            for name in (
+                "files", "pages", "bytes_read", "output_files", "bytes_written",
+                "index_hits", "index_misses", "fmt_memo_hits", "fmt_memo_misses",
+            )
+        )
+        self.wall = 0.0
+        self.functions = []
+        self.allocations = []
+        self._stack = []
+        self._mark = 0.0
+        self._start = 0.0
+        self._memo = (0, 0)
+        self._profiler = None
+
+    def start(self):
+        """Start the wall clock and the captures."""
+        self._start = time.perf_counter()
+        self._memo = fmt_memo_stats()
+        if self.cprofile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        if self.trace_malloc:
+            tracemalloc.start()
+
+    def stop(self, index=None):
+        """
+        Stop the wall clock and the captures, collect the counters.
+
+        :param index: ScanCache, optional
+            The scan index of the run to take the hits and misses from.
+        """
+        self.wall = time.perf_counter() - self._start
+        hits, misses = fmt_memo_stats()
+        self.counters["fmt_memo_hits"] += hits - self._memo[0]
+        self.counters["fmt_memo_misses"] += misses - self._memo[1]
+        if index is not None:
+            self.counters["index_hits"] += index.hits
+            self.counters["index_misses"] += index.misses
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.cprofile_path)
+            stats = pstats.Stats(self._profiler).stats
+            self.functions = [
+                {
+                    "function": f"{path}:{line}({name})",
+                    "calls": calls,
+                    "own": round(own, 6),
+                    "cumulative": round(cumulative, 6),
+                }
+                for (path, line, name), (_, calls, own, cumulative, _) in sorted(
+                    stats.items(), key=lambda item: item[1][3], reverse=True
+                )[:self.top]
+            ]
+            self._profiler = None
+        if self.trace_malloc and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.counters["traced_peak_bytes"] = peak
+            self.allocations = [
+                {"where": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:self.top]
+            ]
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a stage, the time of the enclosing stage is paused meanwhile.
+
+        :param name: str
+            The stage name.
+        """
+        now = time.perf_counter()
+        if self._stack:
+            self._charge(self._stack[-1], now)
+        self._stack.append(name)
+        self._mark = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._charge(self._stack.pop(), now)
+            self._mark = now
+
+    def _charge(self, name: str, now: float):
+        self.stages[name] = self.stages.get(name, 0.0) + now - self._mark
+
+    def timed_iter(self, name: str, iterable) -> Iterator:
+        """
+        Time a lazy stage: the time spent producing every item of `iterable`.
+
+        :param name: str
+            The stage name.
+        :param iterable: Iterable
+            The stage output.
+        :return: Iterator
+            Yields the items of `iterable`.
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, scan: FileScan):
+        """
+        Count one scanned file, files served by the scan index have no parse time.
+
+        :param scan: FileScan
+            The scan result of one file.
+        """
+        self.counters["files"] += 1
+        self.counters["pages"] += len(scan.boxes)
+        if scan.parse_time:
+            self.parse_times[scan.path] = scan.parse_time
+            try:
+                self.counters["bytes_read"] += os.path.getsize(scan.path)
+            except OSError:
+                pass
+
+    def feed(self, scans) -> Iterator[FileScan]:
+        """Count file scans while passing them through, see add()."""
+        for scan in scans:
+            self.add(scan)
+            yield scan
+
+    def add_write(self, filename: str, files: list, seconds: float):
+        """
+        Count one written output file.
+
+        :param filename: str
+            Output PDF filename with full path.
+        :param files: list
+            The files actually written for it, more than one if split by size.
+        :param seconds: float
+            The time taken to write them.
+        """
+        self.write_times[filename] = seconds
+        self.counters["output_files"] += len(files)
+        self.counters["bytes_written"] += sum(os.path.getsize(name) for name in files)
+
+    def as_dict(self) -> dict:
+        """
+        The profile report.
+
+        :return: dict
+            Returns the wall time, the time and share of every stage, the counters,
+            the slowest files to parse and to write, the top functions and allocation sites.
+        """
+        total = sum(self.stages.values()) or 1.0
+
+        def slowest(times: dict) -> list:
+            return [
+                {"path": path, "seconds": round(seconds, 6)}
+                for path, seconds in sorted(times.items(), key=lambda item: item[1], reverse=True)
+            ][:self.top]
+
+        return {
+            "wall": round(self.wall, 6),
+            "stages": [
+                {"stage": name, "seconds": round(seconds, 6), "share": round(seconds / total, 4)}
+                for name, seconds in sorted(
+                    self.stages.items(),
+                    key=lambda item: PROFILE_STAGES.index(item[0])
+                    if item[0] in PROFILE_STAGES else len(PROFILE_STAGES),
+                )
+            ],
+            "counters": dict(self.counters),
+            "slowest_parse": slowest(self.parse_times),
+            "slowest_write": slowest(self.write_times),
+            "functions": self.functions,
+            "allocations": self.allocations,
+        }
+
+    def print_summary(self, stream=None):
+        """
+        Print the profile report as text.
+
+        :param stream: file, optional
+            The stream to print to (default is sys.stdout).
+        """
+        stream = stream or sys.stdout
+        data = self.as_dict()
+        print(f"Profile: {data['wall']:.3f}s wall", file=stream)
+        for stage in data["stages"]:
+            print(f"  {stage['stage']:<10} {stage['seconds']:10.3f}s {stage['share']:7.1%}", file=stream)
+        print("  " + ", ".join(f"{name}={value}" for name, value in data["counters"].items()), file=stream)
+        for title, key in (("Slowest to parse", "slowest_parse"), ("Slowest to write", "slowest_write")):
+            if data[key]:
+                print(f"{title}:", file=stream)
+                for item in data[key]:
+                    print(f"  {item['seconds']:10.3f}s  {item['path']}", file=stream)
+        if data["functions"]:
+            print("Top functions by cumulative time:", file=stream)
+            for item in data["functions"]:
+                print(
+                    f"  {item['cumulative']:10.3f}s {item['calls']:>9}  {item['function']}",
+                    file=stream,
+                )
+        if data["allocations"]:
+            print("Top allocation sites:", file=stream)
+            for item in data["allocations"]:
+                print(f"  {item['bytes']:>12} B {item['count']:>8}  {item['where']}", file=stream)
+
+    def save(self, path: str):
+        """
+        Export the profile report as JSON.
+
+        :param path: str
+            The JSON filename.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, ensure_ascii=False, indent=2)
+
+@contextmanager
+def _no_stage(name: str):
+    """Stand-in for RunProfile.stage() when the run isn't profiled."""
+    yield
+
+def snapshot_tree(dirpath: str, exclude: tuple = (), hidden: bool = False) -> dict:
+    """
+    Take the size and modification time of every PDF file in a directory tree.
+
+    :param dirpath: str
+        The directory to start find PDF files recursively.
+    :param exclude: tuple, optional
+        Glob patterns of files and directories to leave out, see iter_pdf_files().
+    :param hidden: bool, optional
+        Also take hidden files and directories.
+    :return: dict
+        Returns the dictionary where PDF filename as the key and (size, mtime) as the value.
+    """
+    stats = {}
+    for _ in iter_pdf_files(dirpath, exclude, (get_output_dir(dirpath),), hidden, stats=stats):
+        pass
+    return {path: (st.st_size, st.st_mtime_ns) for path, st in stats.items()}
+
+def watch_tree(dirpath: str, interval: float, **options):
+    """
+    Poll a directory tree and sort it again whenever PDF files are added, changed or removed.
+    Changes are batched: sorting starts once the tree has not changed for one interval.
+    Output files are written incrementally, runs until interrupted.
+
+    :param dirpath: str
+        The directory to watch.
+    :param interval: float
+        Polling interval in seconds.
+    :param options: dict
+        Options passed to sort_tree().
+    """
+    options["incremental"] = True
+    exclude, hidden = options.get("exclude", ()), options.get("hidden", False)
+    previous = None
+    while True:
+        current = snapshot_tree(dirpath, exclude, hidden)
+        if current != previous:
+            time.sleep(interval)
+            settled = snapshot_tree(dirpath, exclude, hidden)
+            if settled == current:
+                summary = sort_tree(dirpath, **options)
+                print(
+                    f"{time.strftime('%Y-%m-%d %H:%M:%S')} {len(settled)} input files, "
+                    f"{len(summary['written'])} output files written",
+                    file=sys.stderr,
+                    flush=True,
+                )
+                previous = settled
+            continue
+        time.sleep(interval)
+
+def sort_tree(
+    dirpath: str,
+    table: bool = False,
+    write: bool = False,
+    limit: int = 0,
+    jobs: int = 1,
+    cache: bool = False,
+    verify_hash: bool = False,
+    report_format: str = "text",
+    incremental: bool = False,
+    exclude: tuple = (),
+    hidden: bool = False,
+    use_mmap: bool = False,
+    max_bytes: int = 0,
+    optimize: int = 0,
+    pipeline: bool = False,
+    profile=None,
+    timeout: float = 0,
+    max_memory: int = 0,
+    dedupe: int = 0,
+    group_by: tuple = ("format",),
+    group_name: str = None,
+    order=None,
+    plan: bool = False,
+) -> dict:
+    """
+    Scans a directory tree once, reports the page formats and/or writes the output files.
+
+    :param dirpath: str
+        The directory to start find PDF files recursively.
+    :param table: bool, optional
+        Report page counts for each format.
+    :param write: bool, optional
+        Write PDF files with pages of only one size to the output dir.
+    :param limit: int, optional
+        The maximum allowed number of pages per one output file.
+    :param jobs: int, optional
+        The number of worker processes to scan and write files.
+    :param cache: bool, optional
+        Keep a persistent index of scanned files in the output dir.
+    :param verify_hash: bool, optional
+        Also check the content hash of indexed files.
+    :param report_format: str, optional
+        One of the `REPORT_FORMATS`.
+    :param incremental: bool, optional
+        Write only the output files whose source pages have changed, see OutputManifest.
+        This also resumes an interrupted run from its journal.
+    :param exclude: tuple, optional
+        Glob patterns of files and directories to leave out, see iter_pdf_files().
+    :param hidden: bool, optional
+        Also take hidden files and directories.
+    :param use_mmap: bool, optional
+        Memory-map the input files instead of reading them into memory, see open_pdf().
+    :param max_bytes: int, optional
+        The maximum allowed size of one output file in bytes.
+    :param optimize: int, optional
+        Optimize the output files, see optimize_writer().
+    :param pipeline: bool, optional
+        Read, parse and write at once in a staged pipeline, see run_pipeline().
+    :param profile: RunProfile, optional
+        Collect the stage timings and counters of the run.
+    :param timeout: float, optional
+        Scan every file in an isolated worker process and quarantine it
+        if it takes longer than `timeout` seconds, see IsolatedScanner.
+    :param max_memory: int, optional
+        Scan every file in an isolated worker process limited to `max_memory` bytes.
+    :param dedupe: int, optional
+        DEDUPE_FILES to scan byte-identical input files once, DEDUPE_PAGES to also write
+        pages showing the same content once, see Deduplicator.
+    :param group_by: tuple, optional
+        The keys to group pages into output files by, see PageGrouping.
+    :param group_name: str, optional
+        The template of the output group names, e.g. "{folder}-{format}{orientation}".
+    :param order: str or callable, optional
+        The order of the pages in output files by their source files, see order_pages()
+        (default is the order the tree is walked in, see iter_pdf_files()).
+    :param plan: bool, optional
+        Plan the write of the output files instead of writing them, see OutputPlan.
+    :return: dict
+        Returns a summary: index hits and misses, written filenames, bytes saved by `optimize`,
+        the metrics of the pipeline stages, files and pages skipped, see Quarantine.skipped(),
+        duplicates eliminated, see Deduplicator.eliminated(), the write plan, see OutputPlan.plan().
+    """
+    summary = {}
+    grouping = PageGrouping(group_by, group_name, dirpath)
+    stage = profile.stage if profile is not None else _no_stage
+    if profile is not None:
+        profile.start()
+    out_dir = get_output_dir(dirpath)
+    index = ScanCache(os.path.join(out_dir, INDEX_FILENAME), verify_hash) if cache else None
+    # Files go to the parser as soon as they are found
+    file_paths = iter_pdf_files(
+        dirpath, exclude, (out_dir,), hidden, jobs, index.stats if index is not None else None
+    )
+
+    deduper = None
+    if dedupe:
+        deduper = Deduplicator(dedupe, use_mmap)
+        file_paths = deduper.files(file_paths)
+    report = FormatReport(report_format) if table else None
+    # Files which can't be read are left out, the run goes on without them
+    quarantine = Quarantine()
+    scanner = None
+    if timeout > 0 or max_memory > 0:
+        scanner = IsolatedScanner(timeout, max_memory, use_mmap)
+    planner = OutputPlan() if plan else None
+    if planner is not None:
+        # Nothing is written, the tree is only scanned
+        write = pipeline = False
+    manifest = None
+    if write:
+        # Finished output files are journaled, an interrupted run is resumed incrementally
+        manifest = OutputManifest(os.path.join(out_dir, MANIFEST_FILENAME), persist=incremental)
+        remove_partial_files(out_dir)
+    try:
+        if pipeline:
+            summary.update(run_pipeline(
+                file_paths, jobs, index, report, write, limit, manifest, use_mmap, max_bytes,
+                optimize, profile, quarantine, scanner, dirpath, deduper, grouping, order,
+            ))
+        else:
+            # Scan the tree once, both the table and the output files are served
+            # from the same scans, source files are reopened only while writing
+            if profile is not None:
+                file_paths = profile.timed_iter("discover", file_paths)
+            scans = scan_pdf_files(file_paths, jobs, index, use_mmap, quarantine, scanner)
+            if profile is not None:
+                scans = profile.feed(profile.timed_iter("parse", scans))
+            if report is not None:
+                scans = report.feed(scans)
+            if deduper is not None:
+                scans = deduper.feed(scans)
+            if planner is not None:
+                scans = planner.feed(scans)
+            with stage("classify"):
+                if write or planner is not None:
+                    buckets = grouping.bucket(scans, deduper.pages if deduper is not None else None)
+                    if order is not None:
+                        buckets = order_pages(buckets, order)
+                else:
+                    for _ in scans:
+                        pass
+    finally:
+        if scanner is not None:
+            scanner.close()
+    summary["quarantine"] = quarantine.skipped()
+    quarantine.save(os.path.join(out_dir, QUARANTINE_FILENAME))
+    if deduper is not None:
+        summary["duplicates"] = deduper.eliminated()
+    if report is not None:
+        with stage("report"):
+            report.finish(summary["quarantine"], summary.get("duplicates"))
+
+    if index is not None:
+        index.close()
+        summary["index"] = (index.hits, index.misses)
+    if planner is not None:
+        with stage("write"):
+            summary["plan"] = planner.plan(buckets, limit, max_bytes, jobs, use_mmap, optimize, dirpath)
+    if write and not pipeline:
+        write_stats = {"bytes_saved": 0}
+        with stage("write"):
+            summary["written"] = write_fmt_files(
+                buckets, limit, jobs, manifest, use_mmap, max_bytes, optimize, write_stats, dirpath
+            )
+        summary["bytes_saved"] = write_stats["bytes_saved"]
+        if profile is not None:
+            for filename, files, seconds in write_stats.get("writes", []):
+                profile.add_write(filename, files, seconds)
+    if profile is not None:
+        profile.stop(index)
+    return summary
+
+class PDFSorter:
+    """
+    Sorts the PDF files of one directory tree, a reusable object for a long-running service.
+    Holds the options, the scans of the tree (page sizes and format counts of every file)
+    and the quarantine of the last scan. The scans are kept between calls,
+    scanning again parses only the files added or changed since.
+    Nothing is kept in module globals, so sorters of different trees can work at once.
+    scan(), format_counts(), plan() and write() are thread-safe: scans of the tree run one at a time,
+    so do writes to its output dir, format counts and plans are served from the current scans meanwhile.
+    """
+
+    def __init__(
+        self,
+        dirpath: str,
+        limit: int = 0,
+        jobs: int = 1,
+        cache: bool = False,
+        verify_hash: bool = False,
+        exclude: tuple = (),
+        hidden: bool = False,
+        use_mmap: bool = False,
+        max_bytes: int = 0,
+        optimize: int = 0,
+        timeout: float = 0,
+        max_memory: int = 0,
+        group_by: tuple = ("format",),
+        group_name: str = None,
+        order=None,
+    ):
+        self.dirpath = os.path.abspath(dirpath)
+        self.output_dir = get_output_dir(self.dirpath)
+        self.limit = limit
+        self.jobs = jobs
+        self.cache = cache
+        self.verify_hash = verify_hash
+        self.exclude = tuple(exclude)
+        self.hidden = hidden
+        self.use_mmap = use_mmap
+        self.max_bytes = max_bytes
+        self.optimize = optimize
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.grouping = PageGrouping(group_by, group_name, self.dirpath)
+        if order is not None:
+            page_order_key(order)  # an unknown order fails here, not on write
+        self.order = order
+        self.scans = None  # path -> FileScan, None until the first scan
+        self.file_stats = {}  # path -> (size, mtime) of the scanned files
+        self.quarantine = Quarantine()
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def scan(self) -> list:
+        """
+        Scan the tree, only the files added or changed since the last scan are parsed
+        (with `cache` all files are checked against the persistent index instead).
+        Files which can't be read are left out and recorded in `quarantine`.
+
+        :return: list
+            Returns the FileScan of every readable file.
+        """
+        with self.scan_lock:
+            index = None
+            if self.cache:
+                index = ScanCache(os.path.join(self.output_dir, INDEX_FILENAME), self.verify_hash)
+            stats = index.stats if index is not None else {}
+            paths = list(iter_pdf_files(
+                self.dirpath, self.exclude, (self.output_dir,), self.hidden, self.jobs, stats
+            ))
+            current = {path: (st.st_size, st.st_mtime_ns) for path, st in stats.items()}
+            with self.lock:
+                previous = dict(self.scans or {})
+            for path in list(previous):
+                if self.file_stats.get(path) != current.get(path):
+                    del previous[path]
+            quarantine = Quarantine()
+            scanner = None
+            if self.timeout > 0 or self.max_memory > 0:
+                scanner = IsolatedScanner(self.timeout, self.max_memory, self.use_mmap)
+            # The persistent index is kept in step with the whole tree
+            todo = paths if index is not None else [path for path in paths if path not in previous]
+            try:
+                fresh = {
+                    scan.path: scan
+                    for scan in scan_pdf_files(
+                        todo, self.jobs, index, self.use_mmap, quarantine, scanner
+                    )
+                }
+            finally:
+                if scanner is not None:
+                    scanner.close()
+                if index is not None:
+                    index.close()
+            scans = {}
+            for path in paths:
+                scan = fresh.get(path) or previous.get(path)
+                if scan is not None:
+                    scans[path] = scan
+            with self.lock:
+                self.scans = scans
+                self.file_stats = {path: current[path] for path in scans}
+                self.quarantine = quarantine
+            return list(scans.values())
+
+    def _current_scans(self) -> list:
+        with self.lock:
+            scans = self.scans
+        return list(scans.values()) if scans is not None else self.scan()
+
+    def format_counts(self) -> dict:
+        """
+        Page counts for each format, from the current scans (the tree is scanned on the first call).
+
+        :return: dict
+            Returns the dictionary where page format as the key and their amount as the value.
+        """
+        return merge_format_info(self._current_scans())
+
+    def write(self, incremental: bool = False) -> list:
+        """
+        Write the output files from the current scans (the tree is scanned on the first call),
+        call scan() first to take the latest changes of the tree.
+
+        :param incremental: bool, optional
+            Write only the output files whose source pages have changed, see OutputManifest.
+        :return: list
+            Returns the list of written filenames.
+        """
+        buckets = self.grouping.bucket(self._current_scans())
+        if self.order is not None:
+            buckets = order_pages(buckets, self.order)
+        with self.write_lock:
+            manifest = OutputManifest(
+                os.path.join(self.output_dir, MANIFEST_FILENAME), persist=incremental
+            )
+            remove_partial_files(self.output_dir)
+            written = write_fmt_files(
+                buckets, self.limit, self.jobs, manifest, self.use_mmap, self.max_bytes,
+                self.optimize, dirpath=self.dirpath,
+            )
+            self.quarantine.save(os.path.join(self.output_dir, QUARANTINE_FILENAME))
+        return written
+
+    def plan(self) -> dict:
+        """
+        Plan the write of the output files from the current scans without writing them.
+
+        :return: dict
+            Returns the write plan, see OutputPlan.plan().
+        """
+        scans = self._current_scans()
+        planner = OutputPlan()
+        buckets = self.grouping.bucket(planner.feed(scans))
+        if self.order is not None:
+            buckets = order_pages(buckets, self.order)
+        return planner.plan(
+            buckets, self.limit, self.max_bytes, self.jobs, self.use_mmap, self.optimize, self.dirpath
+        )
+
+def parse_size(text: str) -> int:
+    """
+    Parse a size in bytes with an optional binary unit suffix: K, M, G or T
+    (with or without B, case insensitive), for example 2G or 500MB.
+
+    :param text: str
+        The size as string value.
+    :return: int
+        Returns the size in bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"invalid size: {text!r}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit.upper() or " "))
 
 def usage():
     """Show usage help screen and exit"""
@@ -299,11 +4015,63 @@ def usage():
         DIRECTORY Provide directory path as argument or leave blank to use current dir.
 
     Options:
+        -c, --cache     Keep a persistent index of scanned files in the output dir
+                        and parse only new or changed files
+            --cache-hash  Also check the content hash of indexed files
+            --dedupe    Scan byte-identical input files (copies in different folders) once
+                        and report the files, pages and bytes eliminated
+            --dedupe-pages  Also write pages showing the same content once,
+                        implies --dedupe
+        -f, --format    Table output format: text (default), json, csv or ndjson,
+                        csv and ndjson records are streamed as each file is scanned
+        -g, --group-by KEYS  Group pages into output files by comma separated keys:
+                        format (default), orientation, folder (top-level folder) and
+                        pages (page count range of the input file: 1, 2-10, 11-100, ...)
+            --group-name TEMPLATE  Name output files by a template of the group keys,
+                        e.g. "{{folder}}-{{format}}{{orientation}}"
         -h, --help      Shows this help message and exit
+            --hidden    Also take hidden files and directories
+        -i, --incremental  Write only the output files whose source pages have changed,
+                        using a manifest in the output dir
+        -j, --jobs      Number of worker processes to scan and write files (default: number of CPUs)
         -l, --limit     Adds to write option limit of pages number per a file
+            --order KEY  Order the pages of output files by their source files:
+                        path, natural (numbers in names compare as numbers) or mtime,
+                        default is the order the directory tree is walked in
+            --max-bytes SIZE  Adds to write option limit of size per a file, e.g. 2G or 500M,
+                        files are split while written, one at a time
+            --max-memory SIZE  Scan every file in an isolated worker process limited to SIZE
+                        of memory, e.g. 1G, files over the limit are quarantined
+        -m, --mmap      Memory-map input files instead of reading them into memory
+            --optimize  Write objects shared by pages of different files (fonts, images,
+                        title blocks) once per output file and report the bytes saved
+            --compress  Also recompress page content streams, implies --optimize
+            --plan      Plan a write instead of running it: list the output files
+                        with their pages and estimated sizes, the free disk space and
+                        the estimated time, measured by writing a small sample to memory
+        -p, --pipeline  Overlap reading, parsing and writing in a pipeline of stages,
+                        input files are read ahead while others are parsed
+            --profile   Print stage timings, the slowest files to parse and to write
+                        and run counters at the end
+            --profile-json FILE  Also save the profile as JSON, implies --profile
+            --cprofile FILE  Run under cProfile, save the stats to FILE and list
+                        the top functions in the profile, implies --profile
+            --resume    Continue an interrupted write run: output files and --limit chunks
+                        finished before the interruption are kept, the rest is written,
+                        same as --incremental
+            --tracemalloc  List the top allocation sites in the profile, implies --profile
+            --sizes FILE  Use the paper sizes of a TOML or JSON registry file instead of
+                        the built-in ones, with per-size or per-family match tolerances
+        -s, --stats     Print run statistics (peak memory, index and format memo hits) at the end
         -t, --table     Draw a table with pages formats and their amount
+            --timeout SECONDS  Scan every file in an isolated worker process, files taking
+                        longer are quarantined, the run goes on without them
         -w, --write     Write PDF files with pages of only one size to output dir
         -v, --version   Shows current version of the program and exit
+            --watch SECONDS  Poll the directory and incrementally sort it again
+                        whenever PDF files are added, changed or removed
+        -x, --exclude   Leave out files and directories matching a glob pattern,
+                        can be given several times
     ''')
 
 def main():
@@ -311,7 +4079,15 @@ def main():
         try:
             # Parse the command line options and arguments
             opts, args = getopt.gnu_getopt(
-                sys.argv[1:], "hl:twv", ["help", "limit=", "table", "write", "version"]
+                sys.argv[1:], "cf:g:hij:l:mpstwvx:",
+                [
+                    "cache", "cache-hash", "dedupe", "dedupe-pages", "exclude=", "format=",
+                    "group-by=", "group-name=", "help", "hidden", "incremental",
+                    "jobs=", "limit=", "max-bytes=", "max-memory=", "mmap", "optimize", "order=", "compress",
+                    "pipeline", "plan", "profile", "profile-json=", "cprofile=", "resume", "sizes=", "tracemalloc",
+                    "stats", "table", "timeout=",
+                    "write", "version", "watch=",
+                ],
             )
         except getopt.GetoptError as err:
             # If there's an error, print the error message, help and exit
@@ -324,31 +4100,227 @@ def main():
         else:
             input_dir = os.path.abspath(args[0])
 
+        cache_flg: bool = False
+        hash_flg: bool = False
+        incremental_flg: bool = False
+        exclude: list = []
+        hidden_flg: bool = False
+        dedupe: int = 0
+        group_by: tuple = ("format",)
+        group_name: str = None
+        order: str = None
+        timeout: float = 0
+        max_memory: int = 0
+        mmap_flg: bool = False
+        watch: float = 0
+        report_format: str = "text"
+        jobs: int = os.cpu_count() or 1
         limit: int = 0
+        max_bytes: int = 0
+        optimize: int = 0
+        pipeline_flg: bool = False
+        plan_flg: bool = False
+        profile_flg: bool = False
+        profile_json: str = ""
+        cprofile_path: str = ""
+        tracemalloc_flg: bool = False
+        stats_flg: bool = False
+        table_flg: bool = False
         write_flg: bool = False
         for opt, arg in opts:
-            if opt in ("-h", "--help"):
+            if opt in ("-c", "--cache"):
+                cache_flg = True
+            elif opt == "--cache-hash":
+                cache_flg = hash_flg = True
+            elif opt == "--dedupe":
+                dedupe = max(dedupe, DEDUPE_FILES)
+            elif opt == "--dedupe-pages":
+                dedupe = DEDUPE_PAGES
+            elif opt in ("-f", "--format"):
+                if arg not in REPORT_FORMATS:
+                    print(f"option {opt} must be one of: {', '.join(REPORT_FORMATS)}")
+                    usage()
+                    sys.exit(2)
+                report_format = arg
+            elif opt in ("-g", "--group-by"):
+                group_by = tuple(key.strip() for key in arg.split(",") if key.strip())
+            elif opt == "--group-name":
+                group_name = arg
+            elif opt in ("-h", "--help"):
                 usage()
                 sys.exit()
+            elif opt == "--hidden":
+                hidden_flg = True
+            elif opt in ("-i", "--incremental"):
+                incremental_flg = True
+            elif opt == "--resume":
+                incremental_flg = True
+            elif opt in ("-j", "--jobs"):
+                jobs = int(arg) if arg.isdigit() and int(arg) > 0 else jobs
             elif opt in ("-l", "--limit"):
                 limit = int(arg) if arg.isdigit() else 0
+            elif opt == "--max-bytes":
+                try:
+                    max_bytes = parse_size(arg)
+                except ValueError:
+                    max_bytes = 0
+                if max_bytes <= 0:
+                    print(f"option {opt} requires a positive size")
+                    usage()
+                    sys.exit(2)
+            elif opt == "--max-memory":
+                try:
+                    max_memory = parse_size(arg)
+                except ValueError:
+                    max_memory = 0
+                if max_memory <= 0:
+                    print(f"option {opt} requires a positive size")
+                    usage()
+                    sys.exit(2)
+            elif opt in ("-m", "--mmap"):
+                mmap_flg = True
+            elif opt == "--optimize":
+                optimize = max(optimize, OPTIMIZE_DEDUPE)
+            elif opt == "--order":
+                if arg not in PAGE_ORDERS:
+                    print(f"option {opt} must be one of: {', '.join(PAGE_ORDERS)}")
+                    usage()
+                    sys.exit(2)
+                order = arg
+            elif opt == "--compress":
+                optimize = OPTIMIZE_COMPRESS
+            elif opt in ("-p", "--pipeline"):
+                pipeline_flg = True
+            elif opt == "--plan":
+                plan_flg = True
+            elif opt == "--profile":
+                profile_flg = True
+            elif opt == "--profile-json":
+                profile_flg, profile_json = True, arg
+            elif opt == "--cprofile":
+                profile_flg, cprofile_path = True, arg
+            elif opt == "--tracemalloc":
+                profile_flg = tracemalloc_flg = True
+            elif opt == "--sizes":
+                try:
+                    use_paper_sizes(load_paper_sizes(arg))
+                except (OSError, ValueError) as err:
+                    print(f"option {opt}: {err}")
+                    sys.exit(2)
+            elif opt in ("-s", "--stats"):
+                stats_flg = True
             elif opt in ("-t", "--table"):
-                draw_format_info_tab(
-                    get_format_info(collect_pdf_content(list_files_recursive(input_dir)))
-                )
+                table_flg = True
+            elif opt == "--timeout":
+                try:
+                    timeout = float(arg)
+                except ValueError:
+                    timeout = 0
+                if timeout <= 0:
+                    print(f"option {opt} requires a positive number of seconds")
+                    usage()
+                    sys.exit(2)
             elif opt in ("-w", "--write"):
                 write_flg = True
             elif opt in ("-v", "--version"):
                 print('PDFSort version: %s' % __version__)
                 sys.exit()
+            elif opt == "--watch":
+                try:
+                    watch = float(arg)
+                except ValueError:
+                    watch = 0
+                if watch <= 0:
+                    print(f"option {opt} requires a positive number of seconds")
+                    usage()
+                    sys.exit(2)
+            elif opt in ("-x", "--exclude"):
+                exclude.append(arg)
             else:
                 # If an unknown option is passed, raise an error
                 assert False, "Unhandled option"
 
-        if write_flg:
-            for fmt in get_format_info(collect_pdf_content(list_files_recursive(input_dir))):
-                write_fmt_file(
-                    fmt, collect_pdf_content(list_files_recursive(input_dir)), limit if limit else 0
+        try:
+            PageGrouping(group_by, group_name)
+        except ValueError as err:
+            print(f"option --group-by/--group-name: {err}")
+            sys.exit(2)
+
+        if watch > 0:
+            try:
+                watch_tree(
+                    input_dir, watch, table=table_flg, write=True, limit=limit, jobs=jobs,
+                    cache=True, verify_hash=hash_flg, report_format=report_format,
+                    exclude=tuple(exclude), hidden=hidden_flg, use_mmap=mmap_flg,
+                    max_bytes=max_bytes, optimize=optimize, pipeline=pipeline_flg,
+                    timeout=timeout, max_memory=max_memory, dedupe=dedupe,
+                    group_by=group_by, group_name=group_name, order=order,
+                )
+            except KeyboardInterrupt:
+                pass
+            sys.exit()
+
+        summary = {}
+        profile = None
+        if profile_flg:
+            profile = RunProfile(cprofile_path=cprofile_path or None, trace_malloc=tracemalloc_flg)
+        if table_flg or write_flg or plan_flg:
+            summary = sort_tree(
+                input_dir, table=table_flg, write=write_flg, limit=limit, jobs=jobs,
+                cache=cache_flg, verify_hash=hash_flg, report_format=report_format,
+                incremental=incremental_flg, exclude=tuple(exclude), hidden=hidden_flg,
+                use_mmap=mmap_flg, max_bytes=max_bytes, optimize=optimize,
+                pipeline=pipeline_flg, profile=profile, timeout=timeout, max_memory=max_memory,
+                dedupe=dedupe, group_by=group_by, group_name=group_name, order=order,
+                plan=plan_flg,
+            )
+
+        if "duplicates" in summary and not table_flg:
+            print(format_duplicates(summary["duplicates"]))
+
+        if "plan" in summary:
+            print_plan(summary["plan"], report_format)
+
+        skipped = summary.get("quarantine")
+        if skipped and skipped["files"]:
+            print(
+                f"Warning: results are partial, {skipped['files']} files "
+                f"({skipped['pages']} known pages) skipped, see {QUARANTINE_FILENAME} in the output dir",
+                file=sys.stderr,
+            )
+
+        if optimize and "written" in summary:
+            out = sys.stdout if report_format == "text" else sys.stderr
+            print(f"Optimized: {summary['bytes_saved']} bytes saved", file=out)
+
+        if profile is not None and (table_flg or write_flg or plan_flg):
+            profile.print_summary(sys.stdout if report_format == "text" else sys.stderr)
+            if profile_json:
+                profile.save(profile_json)
+
+        if stats_flg:
+            # Keep machine-readable reports on stdout clean
+            out = sys.stdout if report_format == "text" else sys.stderr
+            peak = peak_memory_mb()
+            print(f"Peak memory: {peak:.1f} MiB" if peak is not None else "Peak memory: n/a", file=out)
+            if "index" in summary:
+                print("Index: {} files reused, {} files parsed".format(*summary["index"]), file=out)
+            if "written" in summary:
+                print(f"Output files written: {len(summary['written'])}", file=out)
+            for stage in summary.get("pipeline", []):
+                throughput = stage["throughput"]
+                print(
+                    f"Stage {stage['stage']}: {stage['items']} items, busy {stage['busy']:.3f}s, "
+                    + (f"{throughput:.1f} items/s, " if throughput is not None else "")
+                    + f"queue max {stage['max_queue']} mean {stage['mean_queue']:.1f}",
+                    file=out,
+                )
+            hits, misses = fmt_memo_stats()
+            if hits + misses:
+                print(
+                    f"Format lookups: {hits + misses}, "
+                    f"memo hit rate: {hits / (hits + misses):.1%} ({misses} distinct sizes)",
+                    file=out,
                 )
 
 if __name__ == "__main__":
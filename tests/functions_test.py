@@ -1,8 +1,14 @@
 #!/usr/bin/env python
+import io
+import re
 import os
+import time
+import json
+import shutil
 import pytest
 from pdfsort import *
 
+from pypdf import PdfReader, PdfWriter
 from pypdf._page import PageObject
 from pypdf.generic import RectangleObject
 
@@ -34,6 +40,69 @@ def test_list_files_recursive():
     assert os.path.abspath("tests/data/sub11/sub12/sub13/export_highlights.pdf") in pdf_files
 
 
+def test_iter_pdf_files(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    root = str(tmp_path / "in")
+    os.makedirs(os.path.join(root, ".hidden"))
+    shutil.copy(os.path.join(root, "Binder1.pdf"), os.path.join(root, ".hidden", "Hidden.PDF"))
+    shutil.copy(os.path.join(root, "Binder1.pdf"), os.path.join(root, "sub11", "notes.txt"))
+
+    found = list(iter_pdf_files(root))
+    assert found == [
+        os.path.join(root, "Binder1.pdf"),
+        os.path.join(root, "sub11", "sub12", "sub13", "export_highlights.pdf"),
+        os.path.join(root, "sub21", "sub22", "sub23", "sub24", "tst_highlights.pdf"),
+    ]
+    assert list(iter_pdf_files(root, jobs=3)) == found
+    walking = iter_pdf_files(root, jobs=3)
+    assert [next(walking), next(walking)] == found[:2]
+    walking.close()  # the walker threads stop
+    assert os.path.join(root, ".hidden", "Hidden.PDF") in iter_pdf_files(root, hidden=True)
+    assert list(iter_pdf_files(root, exclude=("sub1*",))) == [found[0], found[2]]
+    assert list(iter_pdf_files(root, exclude=("sub21/sub22",))) == found[:2]
+    assert list(iter_pdf_files(root, skip=(os.path.join(root, "sub11"),))) == [found[0], found[2]]
+
+    stats = {}
+    list(iter_pdf_files(root, stats=stats))
+    assert sorted(stats) == sorted(found)
+    assert stats[found[0]].st_size == os.path.getsize(found[0])
+
+def test_iter_pdf_files_streams(tmp_path, monkeypatch):
+    import threading
+
+    for sub in ("a", "b"):
+        os.makedirs(str(tmp_path / sub / "slow"))
+        shutil.copy("tests/data/Binder1.pdf", str(tmp_path / sub / "first.pdf"))
+        shutil.copy("tests/data/Binder1.pdf", str(tmp_path / sub / "slow" / "last.pdf"))
+    release = threading.Event()
+    scandir = os.scandir
+
+    def slow_scandir(path):
+        if os.path.basename(path) == "slow":
+            release.wait(10)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", slow_scandir)
+    found = iter_pdf_files(str(tmp_path), jobs=2)
+    first = []
+    thread = threading.Thread(target=lambda: first.append(next(found)))
+    thread.start()
+    thread.join(5)
+    # paths come before the walk of their subtree is done
+    assert first == [str(tmp_path / "a" / "first.pdf")]
+    release.set()
+    assert list(found) == [
+        str(tmp_path / "a" / "slow" / "last.pdf"),
+        str(tmp_path / "b" / "first.pdf"),
+        str(tmp_path / "b" / "slow" / "last.pdf"),
+    ]
+
+def test_list_files_recursive_skips_output_dir(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    os.makedirs(str(tmp_path / "in" / "in-PDFs"))
+    shutil.copy("tests/data/Binder1.pdf", str(tmp_path / "in" / "in-PDFs" / "in_A4_pdf.pdf"))
+    assert len(list_files_recursive(str(tmp_path / "in"))) == 3
+
 def test_collect_pdf_content():
     # Test case 1: Check if the function returns the correct number of pages
     pdf_pages = collect_pdf_content([os.path.abspath("tests/data/Binder1.pdf")])
@@ -61,6 +130,154 @@ def test_collect_pdf_content():
     )
     assert len(pdf_pages) == 8
 
+def test_iter_page_boxes():
+    refs = list(iter_page_boxes(
+        [
+            os.path.abspath("tests/data/Binder1.pdf"),
+            os.path.abspath("tests/data/NonExistent.pdf"),
+            os.path.abspath("tests/data/sub21/sub22/sub23/sub24/tst_highlights.pdf"),
+        ]
+    ))
+    assert len(refs) == 8 + 1
+    assert refs[0] == PageRef(os.path.abspath("tests/data/Binder1.pdf"), 0, 595.32, 841.92)
+    assert refs[-1].index == 0
+    assert get_format_info(refs) == get_format_info(
+        collect_pdf_content(list({ref.path for ref in refs}))
+    )
+
+def _scan_data(scans) -> list:
+    # everything but the parse time
+    return [scan._replace(parse_time=0.0) for scan in scans]
+
+def test_scan_pdf_files_parallel_order():
+    file_paths = list_files_recursive("tests/data")
+    serial = list(scan_pdf_files(file_paths))
+    parallel = list(scan_pdf_files(file_paths, jobs=2))
+    assert _scan_data(serial) == _scan_data(parallel)
+    assert [scan.path for scan in parallel] == file_paths
+    assert merge_format_info(parallel) == get_format_info(collect_pdf_content(file_paths))
+
+def test_scan_pdf_files_streams(tmp_path):
+    path = os.path.abspath("tests/data/Binder1.pdf")
+    taken = []
+
+    def found(count):
+        for _ in range(count):
+            taken.append(path)
+            yield path
+
+    scans = scan_pdf_files(found(100), jobs=2)
+    assert next(scans).path == path
+    # only a bounded window of files is scanned ahead
+    assert len(taken) <= 2 * SCAN_CHUNKSIZE * 2
+    assert len(list(scans)) == 99
+
+    cache = ScanCache(str(tmp_path / "index.sqlite"))
+    list(scan_pdf_files([path], cache=cache))
+    taken.clear()
+    scans = scan_pdf_files(found(3), jobs=2, cache=cache)
+    # an unchanged file is looked up as soon as it is found
+    assert next(scans).path == path
+    assert len(taken) == 1
+    assert len(list(scans)) == 2
+    assert list(cache.entries) == [path]
+    cache.close()
+
+def _write_page_tree_pdf(path: str):
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R 4 0 R] /Count 3 /MediaBox [0 0 595 842] /Rotate 90 >>",
+        b"<< /Type /Page /Parent 2 0 R >>",
+        b"<< /Type /Pages /Parent 2 0 R /Kids [5 0 R 6 0 R] /Count 2 /MediaBox [0 0 842 1190] >>",
+        b"<< /Type /Page /Parent 4 0 R /Rotate 0 /UserUnit 2 >>",
+        b"<< /Type /Page /Parent 4 0 R /PieceInfo << /MediaBox [0 0 1 1] >> "
+        b"/T (>> /MediaBox [0 0 2 2]) /MediaBox [0 0 612 792] >>",
+    ]
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def test_read_page_boxes_page_tree(tmp_path):
+    path = str(tmp_path / "tree.pdf")
+    _write_page_tree_pdf(path)
+    boxes = read_page_boxes(PdfReader(path))
+    assert boxes == [(595, 842, 90, 1.0), (842, 1190, 0, 2.0), (612, 792, 90, 1.0)]
+    full = [
+        (float(pg.mediabox.width), float(pg.mediabox.height), int(pg.get("/Rotate", 0)))
+        for pg in PdfReader(path).pages
+    ]
+    assert [box[:3] for box in boxes] == full
+
+def test_scan_pdf_file_fallback():
+    path = os.path.abspath("tests/data/Binder1.pdf")
+    with patch("pdfsort.read_page_boxes", side_effect=ValueError):
+        fallback = scan_pdf_file(path)
+    assert _scan_data([fallback]) == _scan_data([scan_pdf_file(path)])
+
+def test_scan_pdf_file_missing():
+    scan = scan_pdf_file(os.path.abspath("tests/data/NonExistent.pdf"))
+    assert scan.error
+    assert scan.boxes == []
+
+def test_scan_cache(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    file_paths = list_files_recursive(str(tmp_path / "in"))
+    db_path = str(tmp_path / "index.sqlite")
+
+    cache = ScanCache(db_path)
+    cold = list(scan_pdf_files(file_paths, cache=cache))
+    cache.close()
+    assert cache.misses == 3
+
+    cache = ScanCache(db_path, verify_hash=True)
+    list(scan_pdf_files(file_paths, cache=cache))  # digests are stored on the first hashed run
+    cache.close()
+
+    cache = ScanCache(db_path, verify_hash=True)
+    with patch("pdfsort.scan_pdf_file") as mock_scan:
+        warm = list(scan_pdf_files(file_paths, cache=cache))
+        mock_scan.assert_not_called()
+    cache.close()
+    assert _scan_data(warm) == _scan_data(cold)
+    assert cache.hits == 3
+
+    changed = os.path.abspath(str(tmp_path / "in" / "Binder1.pdf"))
+    os.utime(changed, ns=(0, 0))
+    os.remove(str(tmp_path / "in" / "sub21" / "sub22" / "sub23" / "sub24" / "tst_highlights.pdf"))
+    file_paths = list_files_recursive(str(tmp_path / "in"))
+    cache = ScanCache(db_path)
+    rescanned = list(scan_pdf_files(file_paths, cache=cache))
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert sorted(cache.entries) == sorted(file_paths)
+    cache.close()
+    assert _scan_data(rescanned) == _scan_data(scan for scan in cold if scan.path in file_paths)
+
+def test_reader_pool_bounded():
+    path = os.path.abspath("tests/data/Binder1.pdf")
+    pool = ReaderPool(max_open=1)
+    page = pool.get_page(PageRef(path, 3, 1684, 1191))
+    assert page.mediabox.width == 1684
+    pool.get_page(PageRef(os.path.abspath("tests/data/sub21/sub22/sub23/sub24/tst_highlights.pdf"), 0, 612, 792))
+    assert list(pool.readers) == [os.path.abspath("tests/data/sub21/sub22/sub23/sub24/tst_highlights.pdf")]
+    pool.close()
+    assert not pool.readers
+
+def test_bucket_pages_by_format():
+    pages = set_pdf_pages(3)
+    pages[1].mediabox = RectangleObject([0, 0, 842, 1190])
+    buckets = bucket_pages_by_format(pages)
+    assert list(buckets) == ["A4", "A3"]
+    assert buckets["A4"] == [pages[0], pages[2]]
+    assert buckets["A3"] == [pages[1]]
+
 def test_get_format_info():
     pages = set_pdf_pages()
     formats_dict = get_format_info(pages)
@@ -100,32 +317,33 @@ def test_find_fmt_standard_paper_sizes():
     assert find_fmt(612, 792, False) == "Letter"
     assert find_fmt(612, 1008, False) == "Legal"
     assert find_fmt(792, 1224, False) == "Ledger"
-    assert find_fmt(842, 1785, False) == "A4х3"
-    assert find_fmt(842, 2383, False) == "A4х4"
-    assert find_fmt(842, 2978, False) == "A4х5"
-    assert find_fmt(842, 3573, False) == "A4х6"
-    assert find_fmt(842, 4168, False) == "A4х7"
-    assert find_fmt(842, 4766, False) == "A4х8"
-    assert find_fmt(842, 5361, False) == "A4х9"
-    assert find_fmt(1190, 2526, False) == "A3х3"
-    assert find_fmt(1190, 3371, False) == "A3х4"
-    assert find_fmt(1190, 4213, False) == "A3х5"
-    assert find_fmt(1190, 5055, False) == "A3х6"
-    assert find_fmt(1190, 5897, False) == "A3х7"
-    assert find_fmt(1684, 3573, False) == "A2х3"
-    assert find_fmt(1684, 4766, False) == "A2х4"
-    assert find_fmt(1684, 5956, False) == "A2х5"
-    assert find_fmt(2384, 6742, False) == "A1х3"
-    assert find_fmt(3370, 4768, False) == "A0х2"
-    assert find_fmt(3370, 7152, False) == "A0х3"
+    assert find_fmt(842, 1785, False) == "A4x3"
+    assert find_fmt(842, 2383, False) == "A4x4"
+    assert find_fmt(842, 2978, False) == "A4x5"
+    assert find_fmt(842, 3573, False) == "A4x6"
+    assert find_fmt(842, 4168, False) == "A4x7"
+    assert find_fmt(842, 4766, False) == "A4x8"
+    assert find_fmt(842, 5361, False) == "A4x9"
+    assert find_fmt(1190, 2526, False) == "A3x3"
+    assert find_fmt(1190, 3371, False) == "A3x4"
+    assert find_fmt(1190, 4213, False) == "A3x5"
+    assert find_fmt(1190, 5055, False) == "A3x6"
+    assert find_fmt(1190, 5897, False) == "A3x7"
+    assert find_fmt(1684, 3573, False) == "A2x3"
+    assert find_fmt(1684, 4766, False) == "A2x4"
+    assert find_fmt(1684, 5956, False) == "A2x5"
+    assert find_fmt(2384, 5055, False) == "A1x3"
+    assert find_fmt(2384, 6742, False) == "A1x4"
+    assert find_fmt(3370, 4768, False) == "A0x2"
+    assert find_fmt(3370, 7152, False) == "A0x3"
 
 def test_find_fmt_custom_sizes():
     # test for custom sizes
     assert find_fmt(600, 800) == "600x800 ~Letter-P(612x792)"
     assert find_fmt(620, 790) == "620x790 ~Letter-P(612x792)"
-    assert find_fmt(820, 2380) == "820x2380 ~A4х4-P(842x2383)"
+    assert find_fmt(820, 2380) == "820x2380 ~A4x4-P(842x2383)"
     assert find_fmt(1680, 2390) == "1680x2390 ~A1-P(1684x2384)"
-    assert find_fmt(3360, 4760) == "3360x4760 ~A0х2-P(3370x4768)"
+    assert find_fmt(3360, 4760) == "3360x4760 ~A0x2-P(3370x4768)"
 
 def test_find_fmt_paper_orientation():
     # test for paper orientation
@@ -159,24 +377,24 @@ def test_find_fmt_paper_orientation():
     assert find_fmt(612, 792) == "Letter-P"
     assert find_fmt(612, 1008) == "Legal-P"
     assert find_fmt(792, 1224) == "Ledger-P"
-    assert find_fmt(842, 1785) == "A4х3-P"
-    assert find_fmt(842, 2383) == "A4х4-P"
-    assert find_fmt(842, 2978) == "A4х5-P"
-    assert find_fmt(842, 3573) == "A4х6-P"
-    assert find_fmt(842, 4168) == "A4х7-P"
-    assert find_fmt(842, 4766) == "A4х8-P"
-    assert find_fmt(842, 5361) == "A4х9-P"
-    assert find_fmt(1190, 2526) == "A3х3-P"
-    assert find_fmt(1190, 3371) == "A3х4-P"
-    assert find_fmt(1190, 4213) == "A3х5-P"
-    assert find_fmt(1190, 5055) == "A3х6-P"
-    assert find_fmt(1190, 5897) == "A3х7-P"
-    assert find_fmt(1684, 3573) == "A2х3-P"
-    assert find_fmt(1684, 4766) == "A2х4-P"
-    assert find_fmt(1684, 5956) == "A2х5-P"
-    assert find_fmt(2384, 6742) == "A1х3-P"
-    assert find_fmt(3370, 4768) == "A0х2-P"
-    assert find_fmt(3370, 7152) == "A0х3-P"
+    assert find_fmt(842, 1785) == "A4x3-P"
+    assert find_fmt(842, 2383) == "A4x4-P"
+    assert find_fmt(842, 2978) == "A4x5-P"
+    assert find_fmt(842, 3573) == "A4x6-P"
+    assert find_fmt(842, 4168) == "A4x7-P"
+    assert find_fmt(842, 4766) == "A4x8-P"
+    assert find_fmt(842, 5361) == "A4x9-P"
+    assert find_fmt(1190, 2526) == "A3x3-P"
+    assert find_fmt(1190, 3371) == "A3x4-P"
+    assert find_fmt(1190, 4213) == "A3x5-P"
+    assert find_fmt(1190, 5055) == "A3x6-P"
+    assert find_fmt(1190, 5897) == "A3x7-P"
+    assert find_fmt(1684, 3573) == "A2x3-P"
+    assert find_fmt(1684, 4766) == "A2x4-P"
+    assert find_fmt(1684, 5956) == "A2x5-P"
+    assert find_fmt(2384, 6742) == "A1x4-P"
+    assert find_fmt(3370, 4768) == "A0x2-P"
+    assert find_fmt(3370, 7152) == "A0x3-P"
 
     assert find_fmt(3370, 2384) == "A0-L"
     assert find_fmt(2384, 1684) == "A1-L"
@@ -208,24 +426,128 @@ def test_find_fmt_paper_orientation():
     assert find_fmt(792, 612) == "Letter-L"
     assert find_fmt(1008, 612) == "Legal-L"
     assert find_fmt(1224, 792) == "Ledger-L"
-    assert find_fmt(1785, 842) == "A4х3-L"
-    assert find_fmt(2383, 842) == "A4х4-L"
-    assert find_fmt(2978, 842) == "A4х5-L"
-    assert find_fmt(3573, 842) == "A4х6-L"
-    assert find_fmt(4168, 842) == "A4х7-L"
-    assert find_fmt(4766, 842) == "A4х8-L"
-    assert find_fmt(5361, 842) == "A4х9-L"
-    assert find_fmt(2526, 1190) == "A3х3-L"
-    assert find_fmt(3371, 1190) == "A3х4-L"
-    assert find_fmt(4213, 1190) == "A3х5-L"
-    assert find_fmt(5055, 1190) == "A3х6-L"
-    assert find_fmt(5897, 1190) == "A3х7-L"
-    assert find_fmt(3573, 1684) == "A2х3-L"
-    assert find_fmt(4766, 1684) == "A2х4-L"
-    assert find_fmt(5956, 1684) == "A2х5-L"
-    assert find_fmt(6742, 2384) == "A1х3-L"
-    assert find_fmt(4768, 3370) == "A0х2-L"
-    assert find_fmt(7152, 3370) == "A0х3-L"
+    assert find_fmt(1785, 842) == "A4x3-L"
+    assert find_fmt(2383, 842) == "A4x4-L"
+    assert find_fmt(2978, 842) == "A4x5-L"
+    assert find_fmt(3573, 842) == "A4x6-L"
+    assert find_fmt(4168, 842) == "A4x7-L"
+    assert find_fmt(4766, 842) == "A4x8-L"
+    assert find_fmt(5361, 842) == "A4x9-L"
+    assert find_fmt(2526, 1190) == "A3x3-L"
+    assert find_fmt(3371, 1190) == "A3x4-L"
+    assert find_fmt(4213, 1190) == "A3x5-L"
+    assert find_fmt(5055, 1190) == "A3x6-L"
+    assert find_fmt(5897, 1190) == "A3x7-L"
+    assert find_fmt(3573, 1684) == "A2x3-L"
+    assert find_fmt(4766, 1684) == "A2x4-L"
+    assert find_fmt(5956, 1684) == "A2x5-L"
+    assert find_fmt(6742, 2384) == "A1x4-L"
+    assert find_fmt(4768, 3370) == "A0x2-L"
+    assert find_fmt(7152, 3370) == "A0x3-L"
+
+def test_find_fmt_tie_goes_to_first_size():
+    # 2066x4164 is 925 points away from both B0 and A3x5
+    assert find_fmt(2066, 4164) == "2066x4164 ~B0-P(2835x4008)"
+
+def test_find_fmt_runtime_paper_sizes():
+    assert find_fmt(700, 1000, False) != "Plotter"
+    PaperSizes["Plotter"] = [700, 1000]
+    try:
+        assert find_fmt(700, 1000, False) == "Plotter"
+        assert find_fmt(1000, 700) == "Plotter-L"
+    finally:
+        del PaperSizes["Plotter"]
+    assert find_fmt(700, 1000, False) != "Plotter"
+
+def test_find_fmt_memo():
+    hits, misses = fmt_memo_stats()
+    find_fmt(595.1, 842.2, False)
+    find_fmt(594.9, 841.8, False)
+    assert fmt_memo_stats()[0] >= hits + 1
+    saved = dict(PaperSizes)
+    PaperSizes["Plotter"] = [595, 842]
+    try:
+        # the memo is dropped, so the new size is found
+        assert find_fmt(594.9, 841.8, False) == "A4"
+        PaperSizes.pop("A4")
+        assert find_fmt(594.9, 841.8, False) == "Plotter"
+    finally:
+        PaperSizes.clear()
+        PaperSizes.update(saved)
+    assert find_fmt(594.9, 841.8, False) == "A4"
+
+def test_find_fmt_batch():
+    sizes = [(595.32, 841.92), (842, 595), (600, 800), (595.3, 595.2), (612, 792)]
+    expected = [find_fmt(w, h) for w, h in sizes]
+    assert find_fmt_batch(sizes) == expected
+    assert find_fmt_batch(sizes, False) == [find_fmt(w, h, False) for w, h in sizes]
+
+def test_find_fmt_batch_numpy():
+    numpy = pytest.importorskip("numpy")
+    sizes = [(595.32, 841.92), (842, 595), (600, 800), (595.3, 595.2), (612, 792)] * 3
+    formats = find_fmt_batch(numpy.array(sizes))
+    assert list(formats) == [find_fmt(w, h) for w, h in sizes]
+    assert list(find_fmt_batch(numpy.array(sizes), False)) == [find_fmt(w, h, False) for w, h in sizes]
+    assert len(find_fmt_batch(numpy.empty((0, 2)))) == 0
+    # sizes out of the counted range take the lookup of the list input
+    huge = [(595, 842), (3e6, 4e6)]
+    assert list(find_fmt_batch(numpy.array(huge))) == [find_fmt(w, h) for w, h in huge]
+
+def _report_scans() -> list:
+    return [
+        FileScan("/a.pdf", [(595, 842, 0, 1.0)] * 2, {"A4": 2}, parse_time=0.5),
+        FileScan("/b.pdf", [(842, 1190, 0, 1.0)], {"A3": 1}, parse_time=0.25),
+    ]
+
+def test_format_report_ndjson_streamed():
+    stream = io.StringIO()
+    report = FormatReport("ndjson", stream)
+    scans = report.feed(_report_scans())
+    next(scans)
+    # the first record is out before the next file is scanned
+    assert json.loads(stream.getvalue()) == {
+        "type": "file", "path": "/a.pdf", "pages": 2, "formats": {"A4": 2}, "parse_time": 0.5,
+    }
+    list(scans)
+    report.finish()
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [record["type"] for record in records] == ["file", "file", "total"]
+    assert records[-1] == {
+        "type": "total", "files": 2, "pages": 3, "formats": {"A3": 1, "A4": 2}, "parse_time": 0.75,
+    }
+
+def test_format_report_text_stream(capsys):
+    stream = io.StringIO()
+    report = FormatReport("text", stream)
+    list(report.feed(_report_scans()))
+    report.finish({"files": 1, "pages": 4, "unknown": 0})
+    lines = stream.getvalue().splitlines()
+    assert lines[2].split() == ["A3", "1"] and lines[-1].startswith("Partial:")
+    assert capsys.readouterr().out == ""
+
+def test_format_report_json_and_csv():
+    stream = io.StringIO()
+    report = FormatReport("json", stream)
+    list(report.feed(_report_scans()))
+    report.finish()
+    document = json.loads(stream.getvalue())
+    assert [record["path"] for record in document["files"]] == ["/a.pdf", "/b.pdf"]
+    assert document["total"]["formats"] == {"A3": 1, "A4": 2}
+
+    stream = io.StringIO()
+    report = FormatReport("csv", stream)
+    list(report.feed(_report_scans()))
+    report.finish()
+    assert stream.getvalue().splitlines() == [
+        "path,pages,parse_time,format,count",
+        "/a.pdf,2,0.5,A4,2",
+        "/b.pdf,1,0.25,A3,1",
+        "*,3,0.75,A3,1",
+        "*,3,0.75,A4,2",
+    ]
+
+    with pytest.raises(ValueError):
+        FormatReport("xml")
 
 @patch("builtins.print")
 def test_draw_format_info_tab_empty_dict(mock_print):
@@ -290,8 +612,9 @@ def test_mk_output_dir_already_exists():
 
 @patch("pdfsort.mk_output_dir")
 @patch("pdfsort.open", mock_open())
+@patch("pdfsort.os.replace")
 @patch("pdfsort.PdfWriter")
-def test_write_fmt_file(mock_pdf_writer, mock_mk_output_dir):
+def test_write_fmt_file(mock_pdf_writer, mock_replace, mock_mk_output_dir):
     pages = set_pdf_pages()
     writer = mock_pdf_writer.return_value
     writer.pages = pages
@@ -303,6 +626,7 @@ def test_write_fmt_file(mock_pdf_writer, mock_mk_output_dir):
     writer.add_metadata.assert_called_once()
     writer.write.assert_called_once()
     writer.close.assert_called_once()
+    mock_replace.assert_called_once()
 
 @patch("pdfsort.subwrite_limit_fmt_file")
 @patch("pdfsort.PdfWriter")
@@ -320,7 +644,8 @@ def test_write_fmt_file_with_limit(mock_pdf_writer, mock_subwrite_limit_fmt_file
 
     mock_subwrite_limit_fmt_file.assert_called()
     mock_subwrite_limit_fmt_file.assert_called_with("A4", pages, 4, 5, 2, metadata)
-    writer.close.assert_called_once()
+    # chunks are written straight from the pages, not copied from a full writer
+    mock_pdf_writer.assert_not_called()
 
 @patch("pdfsort.subwrite_limit_fmt_file")
 @patch("pdfsort.PdfWriter")
@@ -338,12 +663,14 @@ def test_write_fmt_file_with_limit_even(mock_pdf_writer, mock_subwrite_limit_fmt
 
     mock_subwrite_limit_fmt_file.assert_called()
     mock_subwrite_limit_fmt_file.assert_called_with("A4", pages, 2, 4, 1, metadata)
-    writer.close.assert_called_once()
+    # chunks are written straight from the pages, not copied from a full writer
+    mock_pdf_writer.assert_not_called()
 
 @patch("pdfsort.mk_output_dir")
 @patch("pdfsort.open", mock_open())
+@patch("pdfsort.os.replace")
 @patch("pdfsort.PdfWriter")
-def test_subwrite_limit_fmt_file(mock_pdf_writer, mock_mk_output_dir):
+def test_subwrite_limit_fmt_file(mock_pdf_writer, mock_replace, mock_mk_output_dir):
     pages = set_pdf_pages(5)
     subwriter = mock_pdf_writer.return_value
     subwriter.add_page.return_value = None
@@ -356,3 +683,641 @@ def test_subwrite_limit_fmt_file(mock_pdf_writer, mock_mk_output_dir):
     subwriter.add_metadata.assert_called_once()
     subwriter.write.assert_called_once()
     subwriter.close.assert_called_once()
+
+def _read_outputs(dirpath: str) -> dict:
+    return {
+        name: open(os.path.join(dirpath, name), "rb").read()
+        for name in sorted(os.listdir(dirpath))
+    }
+
+@pytest.mark.parametrize("limit", [0, 2])
+def test_write_fmt_files_parallel_identical(tmp_path, limit):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    buckets = bucket_pages_by_format(iter_page_boxes(list_files_recursive(str(tmp_path / "in"))))
+    out = os.path.join(str(tmp_path / "in"), "in-PDFs")
+
+    for fmt, pages in buckets.items():
+        write_fmt_file(fmt, pages, limit)
+    serial = _read_outputs(out)
+    shutil.rmtree(out)
+
+    written = write_fmt_files(buckets, limit, jobs=3)
+    assert len(written) == len(serial)
+    assert _read_outputs(out) == serial
+
+def test_mmap_identical(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    file_paths = list_files_recursive(str(tmp_path / "in"))
+    out = os.path.join(str(tmp_path / "in"), "in-PDFs")
+    empty = str(tmp_path / "in" / "empty.pdf")
+    open(empty, "wb").close()
+
+    assert _scan_data(scan_pdf_files(file_paths, use_mmap=True)) == _scan_data(scan_pdf_files(file_paths))
+    assert scan_pdf_file(empty, use_mmap=True).error
+
+    buckets = bucket_pages_by_format(iter_page_boxes(file_paths))
+    write_fmt_files(buckets, 2)
+    outputs = _read_outputs(out)
+    shutil.rmtree(out)
+    write_fmt_files(buckets, 2, use_mmap=True)
+    assert _read_outputs(out) == outputs
+
+def test_open_pdf_mmap_errors(monkeypatch):
+    import pdfsort
+
+    streams = []
+
+    def broken_reader(stream):
+        streams.append(stream)
+        raise ValueError("bad file")
+
+    monkeypatch.setattr(pdfsort, "PdfReader", broken_reader)
+    # a parse error is not taken for an unmappable file, the mapping is closed
+    with pytest.raises(ValueError, match="bad file"):
+        open_pdf(os.path.abspath("tests/data/Binder1.pdf"), use_mmap=True)
+    assert len(streams) == 1 and streams[0].closed
+
+def test_scan_pdf_file_closes_broken(monkeypatch):
+    import pdfsort
+
+    closed = []
+    close = pdfsort.close_pdf
+    monkeypatch.setattr(pdfsort, "close_pdf", lambda reader: closed.append(reader) or close(reader))
+    monkeypatch.setattr(pdfsort, "read_page_boxes", lambda reader: 1 / 0)
+    monkeypatch.setattr(PdfReader, "pages", property(lambda self: 1 / 0))
+    scan = scan_pdf_file(os.path.abspath("tests/data/Binder1.pdf"), use_mmap=True)
+    assert scan.error and scan.skipped_pages == 8
+    assert len(closed) == 1 and closed[0].stream.closed
+
+def test_write_fmt_files_max_bytes(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    buckets = bucket_pages_by_format(iter_page_boxes(list_files_recursive(str(tmp_path / "in"))))
+    out = os.path.join(str(tmp_path / "in"), "in-PDFs")
+
+    written = write_fmt_files(buckets, max_bytes=100000)
+    assert all(os.path.getsize(name) <= 100000 for name in written if len(PdfReader(name).pages) > 1)
+    chunks = [name for name in written if "_Letter_" in name]
+    assert [os.path.basename(name) for name in chunks] == [
+        f"in_Letter_pdf-{i}.pdf" for i in range(len(chunks))
+    ]
+    assert [page_size(pg) for name in chunks for pg in PdfReader(name).pages] == [
+        page_size(pg) for pg in buckets["Letter"]
+    ]
+
+    # everything fits in one file per format
+    shutil.rmtree(out)
+    assert write_fmt_files(buckets, max_bytes=2 ** 30) == write_fmt_files(buckets)
+
+    # a page limit still applies
+    shutil.rmtree(out)
+    assert all(
+        len(PdfReader(name).pages) <= 2 for name in write_fmt_files(buckets, 2, max_bytes=2 ** 30)
+    )
+
+def test_write_fmt_files_max_bytes_incremental(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    buckets = bucket_pages_by_format(iter_page_boxes(list_files_recursive(str(tmp_path / "in"))))
+    out = os.path.join(str(tmp_path / "in"), "in-PDFs")
+    manifest = OutputManifest(os.path.join(out, MANIFEST_FILENAME))
+
+    first = write_fmt_files(buckets, manifest=manifest, max_bytes=100000)
+    assert write_fmt_files(buckets, manifest=manifest, max_bytes=100000) == []
+    # chunks of the previous split are replaced
+    second = write_fmt_files(buckets, manifest=manifest, max_bytes=2 ** 30)
+    assert len(second) == len(buckets) < len(first)
+    assert sorted(name for name in os.listdir(out) if name.endswith(".pdf")) == sorted(
+        os.path.basename(name) for name in second
+    )
+
+def test_optimize_writer():
+    reader = PdfReader("tests/data/Binder1.pdf")
+    writer = PdfWriter()
+    # two readers of the same file, every object is copied twice
+    for _ in range(2):
+        for pg in PdfReader("tests/data/Binder1.pdf").pages:
+            writer.add_page(pg)
+    plain = io.BytesIO()
+    writer.write(plain)
+
+    saved = optimize_writer(writer, OPTIMIZE_COMPRESS)
+    optimized = io.BytesIO()
+    writer.write(optimized)
+    assert saved > 0
+    assert len(plain.getvalue()) - len(optimized.getvalue()) == saved
+
+    result = PdfReader(optimized)
+    assert [page_size(pg) for pg in result.pages] == [page_size(pg) for pg in reader.pages] * 2
+    assert [pg.extract_text() for pg in result.pages] == [pg.extract_text() for pg in reader.pages] * 2
+
+def test_write_fmt_files_optimize(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    shutil.copy("tests/data/Binder1.pdf", str(tmp_path / "in" / "copy.pdf"))
+    buckets = bucket_pages_by_format(iter_page_boxes(list_files_recursive(str(tmp_path / "in"))))
+    out = os.path.join(str(tmp_path / "in"), "in-PDFs")
+
+    write_fmt_files(buckets)
+    plain = {name: len(data) for name, data in _read_outputs(out).items()}
+    stats = {}
+    write_fmt_files(buckets, jobs=2, optimize=OPTIMIZE_DEDUPE, stats=stats)
+    optimized = {name: len(data) for name, data in _read_outputs(out).items()}
+    assert stats["bytes_saved"] > 0
+    assert sum(plain.values()) - sum(optimized.values()) == stats["bytes_saved"]
+
+@pytest.mark.parametrize(
+    "text, size", [("2048", 2048), ("2G", 2 * 2 ** 30), ("500mb", 500 * 2 ** 20), ("1.5K", 1536)]
+)
+def test_parse_size(text, size):
+    assert parse_size(text) == size
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        parse_size("2 pages")
+
+def _strip_parse_time(ndjson: str) -> list:
+    records = [json.loads(line) for line in ndjson.splitlines()]
+    for record in records:
+        record.pop("parse_time")
+    return records
+
+@pytest.mark.parametrize("limit, jobs", [(0, 1), (2, 1), (2, 3)])
+def test_sort_tree_pipeline(tmp_path, capsys, limit, jobs):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    out = os.path.join(in_dir, "in-PDFs")
+
+    sort_tree(in_dir, table=True, write=True, limit=limit, report_format="ndjson")
+    report = capsys.readouterr().out
+    outputs = _read_outputs(out)
+    shutil.rmtree(out)
+
+    summary = sort_tree(
+        in_dir, table=True, write=True, limit=limit, jobs=jobs, report_format="ndjson", pipeline=True
+    )
+    assert _strip_parse_time(capsys.readouterr().out) == _strip_parse_time(report)
+    assert _read_outputs(out) == outputs
+    assert sorted(summary["written"]) == sorted(os.path.join(out, name) for name in outputs)
+    stages = {stage["stage"]: stage for stage in summary["pipeline"]}
+    assert stages["parse"]["items"] == 3
+    assert stages["write"]["items"] == len(outputs)
+    assert all(stage["max_queue"] <= PIPELINE_QUEUE_SIZE for stage in stages.values())
+
+def test_run_pipeline_event_loops():
+    import asyncio
+    import threading
+
+    file_paths = list_files_recursive("tests/data")
+    report = FormatReport("json", io.StringIO())
+    # the pipeline runs on its own loop, whatever loop is current in the caller
+    other = asyncio.new_event_loop()
+    asyncio.set_event_loop(other)
+    try:
+        summary = run_pipeline(file_paths, report=report)
+    finally:
+        asyncio.set_event_loop(None)
+        other.close()
+    assert report.file_count == 3
+    assert {stage["stage"]: stage["items"] for stage in summary["pipeline"]}["parse"] == 3
+
+    # and in a thread without any loop
+    results = []
+    thread = threading.Thread(target=lambda: results.append(run_pipeline(file_paths)))
+    thread.start()
+    thread.join()
+    assert len(results) == 1
+
+def test_run_pipeline_parses_paths(tmp_path):
+    file_paths = list_files_recursive("tests/data")
+    cache = ScanCache(str(tmp_path / "index.sqlite"))
+    # workers open the files themselves, memory-mapped when asked
+    with patch("pdfsort.open_pdf", wraps=open_pdf) as mock_open:
+        run_pipeline(file_paths, cache=cache, use_mmap=True)
+    assert sorted(args for args, _ in mock_open.call_args_list) == sorted(
+        (path, True) for path in file_paths
+    )
+    report = FormatReport("json", io.StringIO())
+    with patch("pdfsort.scan_pdf_file") as mock_scan:
+        run_pipeline(file_paths, cache=cache, report=report)
+        mock_scan.assert_not_called()
+    cache.close()
+    assert (cache.hits, report.file_count) == (3, 3)
+
+def test_sort_tree_pipeline_incremental(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    options = dict(write=True, limit=2, cache=True, incremental=True, pipeline=True)
+
+    first = sort_tree(in_dir, **options)
+    assert first["index"] == (0, 3)
+    second = sort_tree(in_dir, **options)
+    assert second["index"] == (3, 0)
+    assert second["written"] == []
+    # switching to one file per format removes the chunks
+    sort_tree(in_dir, **dict(options, limit=0))
+    assert sorted(name for name in os.listdir(os.path.join(in_dir, "in-PDFs")) if name.endswith(".pdf")) == [
+        f"in_{fmt}_pdf.pdf" for fmt in sorted(("A0", "A1", "A2", "A4", "Letter"))
+    ]
+
+def test_run_profile_stages():
+    profile = RunProfile()
+    profile.start()
+    with profile.stage("write"):
+        time.sleep(0.02)
+        for _ in profile.timed_iter("parse", (time.sleep(0.05) for _ in range(2))):
+            pass
+    profile.stop()
+
+    stages = {stage["stage"]: stage for stage in profile.as_dict()["stages"]}
+    assert list(stages) == ["parse", "write"]
+    # the nested stage is not counted in the enclosing one
+    assert 0.1 <= stages["parse"]["seconds"] < 0.15
+    assert 0.02 <= stages["write"]["seconds"] < 0.05
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_sort_tree_profile(tmp_path, capsys, pipeline):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    profile = RunProfile(top=2, cprofile_path=str(tmp_path / "run.prof"), trace_malloc=True)
+
+    summary = sort_tree(in_dir, table=True, write=True, limit=2, pipeline=pipeline, profile=profile)
+    data = profile.as_dict()
+    assert data["counters"]["files"] == 3
+    assert data["counters"]["pages"] == 12
+    assert data["counters"]["bytes_read"] == sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk("tests/data") for name in names
+    )
+    assert data["counters"]["output_files"] == len(summary["written"])
+    assert data["counters"]["bytes_written"] == sum(os.path.getsize(name) for name in summary["written"])
+    assert {"parse", "classify", "write"} <= {stage["stage"] for stage in data["stages"]}
+    assert len(data["slowest_parse"]) == len(data["slowest_write"]) == 2
+    assert data["slowest_parse"][0]["seconds"] >= data["slowest_parse"][1]["seconds"]
+    assert len(data["functions"]) == 2 and len(data["allocations"]) == 2
+    assert os.path.exists(str(tmp_path / "run.prof"))
+
+    profile.save(str(tmp_path / "profile.json"))
+    with open(str(tmp_path / "profile.json")) as f:
+        assert json.load(f) == data
+
+def test_sort_tree_incremental(tmp_path):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    out = os.path.join(in_dir, "in-PDFs")
+
+    first = sort_tree(in_dir, write=True, incremental=True)["written"]
+    assert sorted(first) == sorted(os.path.join(out, name) for name in os.listdir(out) if name.endswith(".pdf"))
+    outputs = _read_outputs(out)
+    # outputs of the previous run are not taken as inputs
+    assert sort_tree(in_dir, write=True, incremental=True)["written"] == []
+    assert _read_outputs(out) == outputs
+
+    os.utime(os.path.join(in_dir, "sub21", "sub22", "sub23", "sub24", "tst_highlights.pdf"), ns=(0, 0))
+    assert sort_tree(in_dir, write=True, incremental=True)["written"] == [os.path.join(out, "in_Letter_pdf.pdf")]
+
+    os.remove(os.path.join(in_dir, "sub21", "sub22", "sub23", "sub24", "tst_highlights.pdf"))
+    os.remove(os.path.join(in_dir, "sub11", "sub12", "sub13", "export_highlights.pdf"))
+    assert sort_tree(in_dir, write=True, incremental=True)["written"] == []
+    assert not os.path.exists(os.path.join(out, "in_Letter_pdf.pdf"))
+    assert os.path.exists(os.path.join(out, "in_A4_pdf.pdf"))
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_sort_tree_quarantine(tmp_path, capsys, pipeline):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    with open(os.path.join(in_dir, "broken.pdf"), "wb") as f:
+        f.write(b"%PDF-1.4\nnot a pdf at all")
+
+    summary = sort_tree(in_dir, table=True, write=True, report_format="json", pipeline=pipeline)
+    assert summary["quarantine"] == {"files": 1, "pages": 0, "unknown": 1}
+    assert json.loads(capsys.readouterr().out)["total"]["skipped"] == summary["quarantine"]
+    with open(os.path.join(in_dir, "in-PDFs", QUARANTINE_FILENAME)) as f:
+        entry, = json.load(f)["files"]
+    assert entry["path"].endswith("broken.pdf") and entry["reason"]
+    assert sum(len(PdfReader(name).pages) for name in summary["written"]) == 12
+
+    # the report of the previous run is removed once no file fails
+    os.remove(os.path.join(in_dir, "broken.pdf"))
+    assert sort_tree(in_dir, table=True, pipeline=pipeline)["quarantine"]["files"] == 0
+    assert not os.path.exists(os.path.join(in_dir, "in-PDFs", QUARANTINE_FILENAME))
+
+def test_isolated_scanner(tmp_path, monkeypatch):
+    import pdfsort
+
+    scan_file = pdfsort.scan_pdf_file
+    def faulty_scan(file_path, *args):
+        if "hang" in file_path:
+            time.sleep(30)
+        if "crash" in file_path:
+            os._exit(3)
+        return scan_file(file_path, *args)
+
+    # workers are forked after the patch, so they run the faulty scan
+    monkeypatch.setattr(pdfsort, "scan_pdf_file", faulty_scan)
+    file_paths = sorted(list_files_recursive("tests/data"))
+    scanner = IsolatedScanner(timeout=2)
+    try:
+        scans = [scanner.scan(path) for path in ["hang.pdf", "crash.pdf"] + file_paths]
+    finally:
+        scanner.close()
+    assert scans[0].error == "Quarantined: timed out after 2s"
+    assert scans[1].error == "Quarantined: worker died with exit code 3"
+    assert [scan.boxes for scan in scans[2:]] == [scan_file(path).boxes for path in file_paths]
+
+    quarantine = Quarantine()
+    scanner = IsolatedScanner()
+    try:
+        scans = list(scan_pdf_files(file_paths + ["crash.pdf"], 2, quarantine=quarantine, scanner=scanner))
+    finally:
+        scanner.close()
+    assert len(scans) == len(file_paths)
+    assert quarantine.skipped() == {"files": 1, "pages": 0, "unknown": 1}
+
+def test_sort_tree_resume(tmp_path, monkeypatch):
+    import pdfsort
+
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    out = os.path.join(in_dir, "in-PDFs")
+    sort_tree(in_dir, write=True, limit=2)
+    outputs = _read_outputs(out)
+    shutil.rmtree(out)
+
+    write_file = pdfsort.write_output_file
+    calls = []
+    def interrupted_write(filename, *args):
+        calls.append(filename)
+        if len(calls) == 4:
+            # killed while writing, only the temporary file is left
+            open(filename + PARTIAL_SUFFIX, "wb").close()
+            raise KeyboardInterrupt
+        return write_file(filename, *args)
+
+    monkeypatch.setattr(pdfsort, "write_output_file", interrupted_write)
+    with pytest.raises(KeyboardInterrupt):
+        sort_tree(in_dir, write=True, limit=2)
+    assert os.path.exists(os.path.join(out, JOURNAL_FILENAME))
+    assert os.path.exists(calls[-1] + PARTIAL_SUFFIX) and not os.path.exists(calls[-1])
+    monkeypatch.undo()
+
+    written = sort_tree(in_dir, write=True, limit=2, incremental=True)["written"]
+    finished = {os.path.basename(name) for name in calls[:3]}
+    assert sorted(written) == sorted(os.path.join(out, name) for name in outputs if name not in finished)
+    resumed = _read_outputs(out)
+    assert resumed.pop(MANIFEST_FILENAME) and resumed == outputs
+    assert not os.path.exists(os.path.join(out, JOURNAL_FILENAME))
+
+@pytest.mark.parametrize("pipeline, incremental", [(False, False), (True, False), (False, True)])
+def test_sort_tree_interrupted_rerun(tmp_path, monkeypatch, pipeline, incremental):
+    import pdfsort
+
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    out = os.path.join(in_dir, "in-PDFs")
+    sort_tree(in_dir, write=True, incremental=incremental)
+    outputs = {name: data for name, data in _read_outputs(out).items() if name.endswith(".pdf")}
+    assert len(outputs) == 5
+    for path in list_files_recursive(in_dir):
+        # every output file is to be written again
+        os.utime(path, ns=(0, 0))
+
+    def interrupted_write(filename, *args):
+        open(filename + PARTIAL_SUFFIX, "wb").close()
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(pdfsort, "write_output_file", interrupted_write)
+    with pytest.raises(KeyboardInterrupt):
+        sort_tree(in_dir, write=True, pipeline=pipeline, incremental=incremental)
+    # the previous outputs are kept until they are replaced
+    kept = _read_outputs(out)
+    assert {name: kept[name] for name in outputs} == outputs
+
+def test_pdf_sorter_concurrent(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    for name in ("a", "b"):
+        shutil.copytree("tests/data", str(tmp_path / name))
+    os.remove(str(tmp_path / "b" / "sub21" / "sub22" / "sub23" / "sub24" / "tst_highlights.pdf"))
+    sorters = [PDFSorter(str(tmp_path / name), limit=2) for name in ("a", "b")]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        counts = list(executor.map(lambda sorter: sorter.format_counts(), sorters + sorters))
+        written = list(executor.map(lambda sorter: sorter.write(), sorters))
+    assert counts[0] == counts[2] and counts[1] == counts[3]
+    assert sum(counts[0].values()) == 12 and sum(counts[1].values()) < 12
+    for sorter, files in zip(sorters, written):
+        assert all(name.startswith(sorter.output_dir + os.sep) for name in files)
+
+    # each tree is written as by a separate run
+    outputs = _read_outputs(sorters[1].output_dir)
+    shutil.rmtree(sorters[1].output_dir)
+    sort_tree(str(tmp_path / "b"), write=True, limit=2)
+    assert _read_outputs(sorters[1].output_dir) == outputs
+
+def test_pdf_sorter_rescan(tmp_path, monkeypatch):
+    import pdfsort
+
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    sorter = PDFSorter(str(tmp_path / "in"))
+    first = sorter.format_counts()
+    parsed = []
+    scan_file = pdfsort.scan_pdf_file
+    monkeypatch.setattr(pdfsort, "scan_pdf_file", lambda path, *args: parsed.append(path) or scan_file(path, *args))
+
+    assert sorter.format_counts() == first and sorter.scan() and parsed == []
+    changed = str(tmp_path / "in" / "sub21" / "sub22" / "sub23" / "sub24" / "tst_highlights.pdf")
+    os.utime(changed, ns=(0, 0))
+    sorter.scan()
+    assert parsed == [changed]
+    assert sorter.format_counts() == first
+
+def test_deduplicator_files(tmp_path):
+    contents = {
+        "a.pdf": b"x" * 100000,
+        "b.pdf": b"x" * 99999 + b"y",  # same size and first bytes, differs at the end
+        "c.pdf": b"x" * 100000,
+        "d.pdf": b"z" * 100000,
+    }
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+    deduper = Deduplicator()
+    paths = [str(tmp_path / name) for name in contents]
+
+    assert list(deduper.files(paths)) == [paths[0], paths[1], paths[3]]
+    assert deduper.duplicates == {paths[2]: paths[0]}
+    # files of other sizes are never read
+    assert (paths[3], False) not in deduper.digests
+    assert deduper.eliminated() == {"files": 1, "pages": 0, "bytes": 100000}
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_sort_tree_dedupe(tmp_path, capsys, pipeline):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    source = os.path.join(in_dir, "sub11", "sub12", "sub13", "export_highlights.pdf")
+    shutil.copy(source, os.path.join(in_dir, "copy.pdf"))
+    # a re-exported copy of two pages, same content in a different file
+    writer = PdfWriter()
+    for pg in PdfReader(source).pages[:2]:
+        writer.add_page(pg)
+    writer.add_metadata({"/Title": "re-exported"})
+    with open(os.path.join(in_dir, "export.pdf"), "wb") as f:
+        writer.write(f)
+    pages = len(PdfReader(source).pages)
+
+    summary = sort_tree(in_dir, table=True, write=True, report_format="json", pipeline=pipeline, dedupe=DEDUPE_FILES)
+    duplicates = {"files": 1, "pages": pages, "bytes": os.path.getsize(source)}
+    assert summary["duplicates"] == duplicates
+    assert json.loads(capsys.readouterr().out)["total"]["duplicates"] == duplicates
+    assert sum(len(PdfReader(name).pages) for name in summary["written"]) == 12 + 2
+
+    summary = sort_tree(in_dir, write=True, pipeline=pipeline, dedupe=DEDUPE_PAGES)
+    assert summary["duplicates"]["pages"] == pages + 2
+    assert sum(len(PdfReader(name).pages) for name in summary["written"]) == 12
+
+def test_page_count_range():
+    assert [page_count_range(n) for n in (1, 2, 10, 11, 100, 1000, 1001)] == [
+        "1", "2-10", "2-10", "11-100", "11-100", "101-1000", "1001+",
+    ]
+
+def test_page_grouping():
+    scans = list(scan_pdf_files(list_files_recursive("tests/data")))
+    by_format = bucket_pages_by_format(scans_to_page_refs(scans))
+    assert PageGrouping(dirpath="tests/data").bucket(scans) == by_format
+
+    grouping = PageGrouping(("folder", "format", "orientation"), "{folder}-{format}{orientation}", "tests/data")
+    buckets = grouping.bucket(scans)
+    assert sum(map(len, buckets.values())) == sum(map(len, by_format.values()))
+    assert {name.split("-")[0] for name in buckets} == {".", "sub11", "sub21"}
+    assert all(name[-1] in "PL" for name in buckets)
+
+    with pytest.raises(ValueError):
+        PageGrouping(("format", "color"))
+    with pytest.raises(ValueError):
+        PageGrouping(("format",), "{folder}")
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_sort_tree_group_by(tmp_path, pipeline):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    summary = sort_tree(
+        in_dir, write=True, pipeline=pipeline,
+        group_by=("folder", "pages"), group_name="{folder}-{pages}",
+    )
+    names = sorted(os.path.basename(name) for name in summary["written"])
+    assert names == ["in_.-2-10_pdf.pdf", "in_sub11-2-10_pdf.pdf", "in_sub21-1_pdf.pdf"]
+    assert sum(len(PdfReader(name).pages) for name in summary["written"]) == 12
+
+def test_natural_key():
+    names = ["scan10.pdf", "Scan2.pdf", "scan1.pdf", "a/scan3.pdf"]
+    assert sorted(names, key=natural_key) == ["a/scan3.pdf", "scan1.pdf", "Scan2.pdf", "scan10.pdf"]
+
+def test_order_pages():
+    pages = lambda path, n: [PageRef(path, i, 595, 842) for i in range(n)]
+    # runs of files scanned out of order
+    buckets = {"A4": pages("b10.pdf", 2) + pages("b2.pdf", 1) + pages("a.pdf", 2)}
+    ordered = order_pages(buckets, "natural")["A4"]
+    assert [(pg.path, pg.index) for pg in ordered] == [
+        ("a.pdf", 0), ("a.pdf", 1), ("b2.pdf", 0), ("b10.pdf", 0), ("b10.pdf", 1),
+    ]
+    assert [pg.path for pg in order_pages(buckets, "path")["A4"]][2:4] == ["b10.pdf", "b10.pdf"]
+    custom = order_pages(buckets, lambda path: -len(path))["A4"]
+    assert [pg.path for pg in custom] == ["b10.pdf", "b10.pdf", "b2.pdf", "a.pdf", "a.pdf"]
+    with pytest.raises(ValueError):
+        order_pages(buckets, "size")
+
+def test_sort_tree_order_deterministic(tmp_path):
+    in_dir = tmp_path / "in"
+    in_dir.mkdir()
+    shutil.copy("tests/data/Binder1.pdf", str(in_dir / "part1.pdf"))
+    shutil.copy("tests/data/Binder1.pdf", str(in_dir / "part10.pdf"))
+    writer = PdfWriter()
+    for pg in reversed(PdfReader("tests/data/Binder1.pdf").pages):
+        writer.add_page(pg)
+    with open(str(in_dir / "part2.pdf"), "wb") as f:
+        writer.write(f)
+    outputs = []
+    for pipeline, jobs, order in ((False, 1, "natural"), (True, 1, "natural"), (True, 2, "natural"), (False, 1, "path")):
+        summary = sort_tree(str(in_dir), write=True, limit=3, jobs=jobs, pipeline=pipeline, order=order)
+        outputs.append({os.path.basename(name): open(name, "rb").read() for name in summary["written"]})
+        shutil.rmtree(get_output_dir(str(in_dir)))
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert outputs[0] != outputs[3]
+
+@pytest.mark.parametrize("max_bytes", [0, 100 * 1024])
+def test_sort_tree_plan(tmp_path, capsys, max_bytes):
+    shutil.copytree("tests/data", str(tmp_path / "in"))
+    in_dir = str(tmp_path / "in")
+    summary = sort_tree(in_dir, write=True, limit=3, max_bytes=max_bytes, plan=True)
+    plan = summary["plan"]
+    assert not os.path.exists(get_output_dir(in_dir))
+    assert "written" not in summary
+    assert plan["pages"] == sum(output["pages"] for output in plan["outputs"]) == 12
+    assert plan["files"] == len(plan["outputs"])
+    assert plan["bytes"] > 0 and plan["seconds"] > 0
+    assert plan["sample"]["pages"] > 0
+    assert PDFSorter(in_dir, limit=3, max_bytes=max_bytes).plan()["outputs"] == plan["outputs"]
+
+    print_plan(plan, "csv")
+    rows = capsys.readouterr().out.splitlines()
+    assert rows[0] == "file,pages,bytes" and rows[-1] == f"*,12,{plan['bytes']}"
+
+    if not max_bytes:
+        written = sort_tree(in_dir, write=True, limit=3)["written"]
+        assert sorted(written) == sorted(output["file"] for output in plan["outputs"])
+
+@pytest.fixture
+def paper_sizes():
+    saved = dict(PaperSizes)
+    yield
+    use_paper_sizes(saved)
+
+def test_load_paper_sizes(tmp_path, paper_sizes):
+    registry = tmp_path / "sizes.toml"
+    registry.write_text(
+        'tolerance = 1\n'
+        '[sizes]\n'
+        'Sheet = [500, 700]\n'
+        '[families.rolls]\n'
+        'tolerance = 20\n'
+        'sizes = { Roll = [2591, 5669], Wide = { width = 3000, height = 3001, tolerance = 0 } }\n',
+        encoding="utf-8",
+    )
+    sizes = load_paper_sizes(str(registry))
+    assert sizes == {"Sheet": [500, 700, 1], "Roll": [2591, 5669, 20], "Wide": [3000, 3001, 0]}
+
+    use_paper_sizes(sizes)
+    assert find_fmt(501, 700) == "Sheet-P"
+    assert find_fmt(502, 700) == "502x700 ~Sheet-P(500x700)"
+    assert find_fmt(5680, 2600) == "Roll-L"
+    # the closest size is out of its tolerance, a farther one is within its own
+    use_paper_sizes({"Near": [2600, 5690, 0], "Roll": [2591, 5669, 20]})
+    assert find_fmt(2595, 5680) == "Roll-P"
+
+    registry = tmp_path / "sizes.json"
+    registry.write_text(json.dumps({"builtin": True, "sizes": {"Roll": [2591, 5669]}}))
+    sizes = load_paper_sizes(str(registry))
+    assert sizes["A4"] == [595, 842] and sizes["Roll"] == [2591, 5669, FMT_TOLERANCE]
+
+@pytest.mark.parametrize("content, message", [
+    ('{"sizes": {"A1": [1, 2], "A1": [1, 3]}}', "duplicate key 'A1'"),
+    ('{"builtin": true, "sizes": {"A4": [595, 842]}}', "A4 is defined twice"),
+    ('{"sizes": {"Wide": [900, 600]}}', "width 900 is greater than height 600"),
+    ('{"sizes": {"Bad": [600]}}', "expected [width, height]"),
+    ('{"sizes": {"Bad": [600, "x"]}}', "must be numbers"),
+    ('{"size": {}}', "unknown keys: size"),
+])
+def test_load_paper_sizes_invalid(tmp_path, content, message):
+    registry = tmp_path / "sizes.json"
+    registry.write_text(content)
+    with pytest.raises(ValueError, match=re.escape(message)):
+        load_paper_sizes(str(registry))
+
+def test_effective_size():
+    assert effective_size(595, 842) == (595, 842)
+    assert effective_size(595, 842, 90) == (842, 595)
+    assert effective_size(595, 842, -270) == (842, 595)
+    assert effective_size(595, 842, 180, 2.0) == (1190, 1684)
+    assert count_formats([(842, 595, 90, 1.0), (595, 842, 0, 2.0)]) == {"A4": 1, "A2": 1}
+
+def test_usage(capsys):
+    usage()
+    out = capsys.readouterr().out
+    assert "--group-by KEYS" in out
+    assert '"{folder}-{format}{orientation}"' in out